@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import timeit
+
+import numpy as np
+import scipy.io as sio
+
+from pyvib.kernels import HAS_NUMBA
+from pyvib.pnlss import PNLSS
+from pyvib.signal import Signal
+from pyvib.subspace import Subspace
+
+"""Benchmark the Jacobian engines of the PNLSS model on the silverbox data.
+
+The per-parameter filtering of the alternative state-space models ('loop') is
+compared to the propagation of all sensitivities together ('numpy' and, if
+installed, 'numba'), see :func:`pyvib.pnlss.sensitivities`.
+
+The data preparation follows silverbox_benchmark.py. R sets the number of
+realizations used; the 'loop' engine takes minutes for all nine.
+"""
+
+R = 2         # number of realizations used for the benchmark (max 9)
+nrep = 3      # number of timings, the best is reported
+engines = ['loop', 'numpy'] + (['numba'] if HAS_NUMBA else [])
+
+data = sio.loadmat('data/SNLS80mV.mat')
+u = data['V1'].T
+y = data['V2'].T
+u -= u.mean()
+y -= y.mean()
+
+P = 1
+fs = 1e7/2**14
+m = 1
+p = 1
+npp = 8192
+Nini = 86
+Ntest = int(40e3)
+Nz = 100
+Ntr = 400
+lines = np.arange(1,2683,2)
+
+# estimation data
+u = np.delete(u, np.s_[:Nini+Ntr+Ntest])
+y = np.delete(y, np.s_[:Nini+Ntr+Ntest])
+uest = np.empty((npp,R,P))
+yest = np.empty((npp,R,P))
+for r in range(R):
+    u = np.delete(u, np.s_[:Nz+Ntr])
+    y = np.delete(y, np.s_[:Nz+Ntr])
+    uest[:,r] = u[:npp,None]
+    yest[:,r] = y[:npp,None]
+    u = np.delete(u, np.s_[:npp])
+    y = np.delete(y, np.s_[:npp])
+uest = uest.reshape(npp,m,R,P)
+yest = yest.reshape(npp,p,R,P)
+
+sig = Signal(uest,yest,fs=fs)
+sig.lines = lines
+sig.bla()
+um, ym = sig.average()
+
+linmodel = Subspace(sig)
+linmodel.estimate(2, 20)
+
+T1 = np.r_[2*npp, np.r_[0:(R-1)*npp+1:npp]]
+model = PNLSS(linmodel)
+model.nlterms('x', [2,3], 'full')
+model.nlterms('y', [2,3], 'empty')
+model.transient(T1)
+model.freq_weight = False
+x0 = model.flatten()
+# simulate to get the states used by the jacobian
+model.costfcn(x0)
+
+print(f"Silverbox jacobian, N = {R*npp}, npar = {len(x0)}")
+jac = {}
+for engine in engines:
+    # first call compiles the numba kernel
+    jac[engine] = model.jacobian(x0, engine=engine)
+    t = min(timeit.repeat(lambda: model.jacobian(x0, engine=engine),
+                          repeat=nrep, number=1))
+    print(f"{engine:6} | {t:8.3f} s")
+
+for engine in engines[1:]:
+    err = np.max(np.abs(jac[engine] - jac['loop']))
+    print(f"max difference {engine} vs loop: {err:.3e}")
@@ -4,7 +4,12 @@
 import numpy as np
 import math
 import itertools
-from scipy.linalg import svd, norm
+import os
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import (LinAlgError, cho_factor, cho_solve, eigh, norm, qr,
+                          svd)
+from scipy.optimize import minimize
+from scipy.sparse.linalg import LinearOperator, lsqr, svds
 
 
 # general messages for LM/etc optimization
@@ -238,8 +243,149 @@ def normalize_columns(mat):
     # mat /= scaling
     return mat/scaling, scaling
 
+def normalize_operator(op, scaling=None):
+    """Column normalization of a linear operator, see :func:`normalize_columns`
+
+    If `scaling` is not given, the rms value of each column is found by
+    multiplying `op` with the unit vectors, ie. one matrix-vector product per
+    column.
+    """
+    nrows, ncols = op.shape
+    if scaling is None:
+        scaling = np.empty(ncols)
+        e = np.zeros(ncols)
+        for j in range(ncols):
+            e[j] = 1
+            scaling[j] = norm(op.matvec(e)) / np.sqrt(nrows)
+            e[j] = 0
+        scaling[scaling == 0] = 1
+
+    def matvec(v):
+        return op.matvec(np.ravel(v) / scaling)
+
+    def rmatvec(v):
+        return op.rmatvec(v) / scaling
+
+    return LinearOperator(op.shape, matvec=matvec, rmatvec=rmatvec,
+                          dtype=float), scaling
+
+def column_norms(op, nprobe=20, seed=None):
+    """Estimate the column norms of a linear operator
+
+    Uses ``E[(Aᵀz)²] = ∑ᵢ Aᵢⱼ²`` for random z with independent ±1 entries,
+    ie. `nprobe` vector-matrix products independent of the number of columns.
+    The estimate is rough, but good enough for scaling.
+    """
+    rng = np.random.RandomState(seed)
+    nrows, ncols = op.shape
+    sumsq = np.zeros(ncols)
+    for i in range(nprobe):
+        z = rng.choice([-1., 1.], size=nrows)
+        sumsq += op.rmatvec(z)**2
+    scaling = np.sqrt(sumsq/nprobe)
+    scaling[scaling == 0] = 1
+    return scaling
+
+def save_checkpoint(fname, **state):
+    """Save the optimization state to a npz file
+
+    The file is first written to a temporary file and then renamed, such that
+    a killed job leaves the previous checkpoint intact. None is saved as an
+    empty array, except for 'lamb' which is saved as nan.
+    """
+    if state.get('lamb', 0) is None:
+        state['lamb'] = np.nan
+    state = {k: np.array([]) if v is None else v for k, v in state.items()}
+    tmp = f'{fname}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp, fname)
+
+def load_checkpoint(fname):
+    """Load the optimization state saved by :func:`save_checkpoint`"""
+    with np.load(fname) as data:
+        return {k: data[k] for k in data.files}
+
+# function evaluated by the workers of the parallel λ ladder in lm
+_lm_fun = None
+
+def _lm_init(fun, args, kwargs):
+    global _lm_fun
+    _lm_fun = (fun, args, kwargs)
+
+def _lm_err(x):
+    fun, args, kwargs = _lm_fun
+    return fun(x, *args, **kwargs)
+
+def lm_factorize(J, err, solver='svd'):
+    """Factorize the Jacobian once for all damping values λ in the LM sweep
+
+    Parameters
+    ----------
+    J : ndarray(m,n)
+        (column normalized) Jacobian
+    err : ndarray(m)
+        error vector
+    solver : {'svd', 'qr', 'chol'}
+        'svd' takes the thin SVD of J. 'qr' takes a thin QR of J first and
+        then the SVD of the small (n,n) factor R, which is faster for tall J.
+        'chol' forms the normal equations JᵀJ and solves the damped system by
+        a Cholesky factorization for each λ, with a fallback to the
+        eigendecomposition of JᵀJ if the factorization fails. Squaring J
+        squares the condition number, so 'chol' is the fastest, but least
+        accurate.
+
+    Returns
+    -------
+    step : callable
+        ``ds = step(lamb)`` returns the LM step minimizing
+        ``||J ds + err||² + λ²||ds||²``
+    s : ndarray
+        the non-zero singular values of J, in descending order
+    """
+    solvers = ('svd', 'qr', 'chol')
+    if solver not in solvers:
+        raise ValueError(f'Wrong solver {solver}. Should be one of {solvers}')
+
+    if solver == 'chol':
+        G = J.T @ J
+        g = J.T @ err
+        # eigenvalues of JᵀJ are the squared singular values of J
+        w, V = eigh(G)
+        w, V = w[::-1].clip(min=0), V[:,::-1]
+        s = np.sqrt(w)
+        Vg = V.T @ g
+        eye = np.eye(G.shape[0])
+
+        def step(lamb):
+            try:
+                return -cho_solve(cho_factor(G + lamb**2*eye), g)
+            except LinAlgError:
+                return -V @ (Vg / (w + lamb**2))
+    else:
+        if solver == 'qr':
+            Q, R = qr(J, mode='economic')
+            U, s, Vt = svd(R)
+            # projection of err on the left singular vectors UᵀQᵀerr
+            Ue = (err @ Q) @ U
+        else:
+            U, s, Vt = svd(J, full_matrices=False)
+            Ue = err @ U
+
+        def step(lamb):
+            sr = s[:r]
+            return -((Ue[:r] * sr / (sr**2 + lamb**2)) @ Vt[:r])
+
+    # determine rank of jacobian/estimate non-zero singular values(rank
+    # estimate)
+    tol = max(J.shape)*np.spacing(max(s))
+    r = np.sum(s > tol)
+    return step, s[:r]
+
 def lm(fun, x0, jac, info=2, nmax=50, lamb=None, ftol=1e-8, xtol=1e-8,
-       gtol=1e-8, args=(), kwargs={}):
+       gtol=1e-8, args=(), kwargs={}, solver='svd', krylov_tol=1e-10,
+       krylov_maxiter=None, workers=None, checkpoint=None,
+       checkpoint_every=1, checkpoint_data={}, resume=None):
     """Solve a nonlinear least-squares problem using levenberg marquardt
        algorithm. See also :scipy-optimize:func:`scipy.optimize.least_squares`
 
@@ -268,105 +414,194 @@ def lm(fun, x0, jac, info=2, nmax=50, lamb=None, ftol=1e-8, xtol=1e-8,
             * 0 (default) : work silently.
             * 1 : display a termination report.
             * 2 : display progress during iterations
+    solver : {'svd', 'qr', 'chol'}, optional
+        Factorization of the Jacobian, which is kept for all λ tried in an
+        iteration, see :func:`lm_factorize`. 'qr' and 'chol' are faster than
+        'svd' (default) for tall Jacobians.
+    krylov_tol : float, optional
+        Relative tolerance of the LSQR solve used when `jac` returns a
+        :class:`scipy.sparse.linalg.LinearOperator`.
+    krylov_maxiter : int, optional
+        Max number of LSQR iterations. Default is ``2*len(x0)``.
+    workers : int, optional
+        Number of processes used to evaluate a ladder of λ candidates
+        ``λ*√10**k, k=0..workers-1`` at once, accepting the best improving
+        step. `fun` (with `args` and `kwargs`) is sent once to each worker
+        and must only depend on its input, fx. :meth:`costfcn`. The error
+        of the accepted step is reused, thus `jac` can be called at
+        parameters last evaluated by a worker. Default is to try one λ at a
+        time.
+    checkpoint : str, optional
+        Save the state of the optimization to this npz file every
+        `checkpoint_every` iterations. The file is replaced atomically.
+    checkpoint_data : dict, optional
+        Additional arrays saved in the checkpoint, fx. the model structure.
+    resume : str, optional
+        Continue from the checkpoint in this file. `x0` and `lamb` are taken
+        from the checkpoint and `nmax` counts the previous iterations as
+        well. If `nmax` is not larger than the number of saved iterations,
+        the checkpoint is returned. Only the cost at the last accepted
+        parameters is recomputed.
+
+    Notes
+    -----
+    If `jac` returns a LinearOperator, the Jacobian is never formed. The
+    damped step ``min ||J ds + e||² + λ²||ds||²`` is then solved with LSQR,
+    which only needs Jacobian-vector and vector-Jacobian products, and the
+    largest singular value used to initialize λ is found by a Lanczos
+    iteration. The column scaling is computed once from the first Jacobian
+    and kept fixed, as it costs one product per parameter.
 
     """
+    niter = 0
+    if resume is not None:
+        state = load_checkpoint(resume)
+        x0, lamb = state['x'], state['lamb']
+        niter = int(state['niter'])
+        if np.isnan(lamb):
+            lamb = None
+
     # the error vector
     err_old = fun(x0, *args, **kwargs)
     # Maybe divide by 2 to match scipy's implementation of minpack
     cost = np.dot(err_old, err_old)
     cost_old = cost.copy()
+    err = err_old
 
     # Initialization of the Levenberg-Marquardt loop
-    niter = 0
     ninner_max = 10
     nfev = 1
     status = None
     message = ''
-    cost_vec = np.empty(nmax+1)
-    x0_mat = np.empty((nmax+1, len(x0)))
+    # a resumed run can have more iterations than nmax
+    cost_vec = np.empty(max(nmax, niter)+1)
+    x0_mat = np.empty((max(nmax, niter)+1, len(x0)))
     # save initial guess
     x0_mat[0] = x0.copy()
     cost_vec[0] = cost.copy()
+    # fixed column scaling of the matrix-free Jacobian
+    op_scaling = None
+    if resume is not None:
+        nfev = int(state['nfev']) + 1
+        x0_mat[:niter+1] = state['x_mat']
+        cost_vec[:niter+1] = state['cost_vec']
+        if state['scaling'].size:
+            op_scaling = state['scaling']
 
     if info == 2:
         print(f"{'i':3} | {'inner':5} | {'cost':12} | {'cond':12} |"
               f" {'lambda':6}")
 
-    stop = False
-    while niter < nmax and not stop:
-
-        J = jac(x0, *args, **kwargs)
-        J, scaling = normalize_columns(J)
-        U, s, Vt = svd(J, full_matrices=False)
-
-        if norm(J) < gtol:  # small jacobian
-            stop = True
-            status = 1
-
-        if lamb is None:
-            # Initialize lambda as largest sing. value of initial jacobian.
-            # pinleton2002
-            lamb = s[0]
-
-        # as long as the step is unsuccessful
-        ninner = 0
-        # determine rank of jacobian/estimate non-zero singular values(rank
-        # estimate)
-        tol = max(J.shape)*np.spacing(max(s))
-        r = np.sum(s > tol)
-
-        # step with direction from err
-        s = s[:r]
-        sr = s.copy()  # only saved to calculate cond. number later
-        while cost >= cost_old and ninner < ninner_max and not stop:
-            s /= (s**2 + lamb**2)
-            ds = -np.linalg.multi_dot((err_old, U[:,:r] * s, Vt[:r]))
-            ds /= scaling
-
-            x0test = x0 + ds
-            err = fun(x0test, *args, **kwargs)
-            cost = np.dot(err,err)
-
-            if cost >= cost_old:
-                # step unsuccessful, increase lambda, ie. Lean more towards
-                # gradient descent method(converges in larger range)
-                lamb *= np.sqrt(10)
-                s = sr.copy()
-            elif np.isnan(cost):
-                print('Unstable model. Increasing lambda')
-                cost = np.inf
-                lamb *= np.sqrt(10)
-                s = sr.copy()
+    pool = None
+    if workers is not None and workers > 1:
+        pool = ProcessPoolExecutor(workers-1, initializer=_lm_init,
+                                   initargs=(fun, args, kwargs))
+    try:
+        stop = False
+        while niter < nmax and not stop:
+
+            J = jac(x0, *args, **kwargs)
+            matfree = isinstance(J, LinearOperator)
+            if matfree:
+                J, op_scaling = normalize_operator(J, op_scaling)
+                scaling = op_scaling
+                if lamb is None:
+                    # largest singular value, see below
+                    lamb = svds(J, k=1, return_singular_vectors=False)[0]
             else:
-                # Lean more towards Gauss-Newton algorithm(converges faster)
-                lamb /= 2
-            ninner += 1
-
-            if norm(ds) < xtol:  # small step
-                stop = True
-                status = 3
-            if np.abs((cost-cost_old)/cost) < ftol:  # small change in costfcn
-                stop = True
-                status = 2 if status is None else 4
-
-        if info == 2:
-            jac_cond = sr[0]/sr[-1]
-            # {cost/2/nfd/R/p:12.3f} for freq weighting
-            print(f"{niter:3d} | {ninner:5d} | {cost:12.8g} | {jac_cond:12.3f}"
-                  f" | {lamb:6.3f}")
-
-        if cost < cost_old or stop:
-            cost_old = cost
-            err_old = err
-            x0 = x0test
-            # save intermediate models
-            x0_mat[niter+1] = x0.copy()
-            cost_vec[niter+1] = cost.copy()
-
-        niter += 1
-        nfev += ninner
-
-    if niter == nmax:
+                J, scaling = normalize_columns(J)
+                step, sr = lm_factorize(J, err_old, solver)
+
+                if norm(sr) < gtol:  # small jacobian
+                    stop = True
+                    status = 1
+
+                if lamb is None:
+                    # Initialize lambda as largest sing. value of initial
+                    # jacobian. pinleton2002
+                    lamb = sr[0]
+
+            # as long as the step is unsuccessful
+            ninner = 0
+            while cost >= cost_old and ninner < ninner_max and not stop:
+                # ladder of λ's tried at once. Only one without a pool.
+                nladder = 1 if pool is None else min(workers,ninner_max-ninner)
+                lambs = lamb * np.sqrt(10)**np.arange(nladder)
+                steps = []
+                for lamb in lambs:
+                    if matfree:
+                        ds, *_, anorm, jac_cond, _, _, _ = \
+                            lsqr(J, -err_old, damp=lamb, atol=krylov_tol,
+                                 btol=krylov_tol, iter_lim=krylov_maxiter)
+                        if anorm < gtol:  # small jacobian
+                            stop = True
+                            status = 1
+                    else:
+                        # step with direction from err
+                        ds = step(lamb)
+                    steps.append(ds / scaling)
+
+                # the pool evaluates the larger λ's while this process
+                # evaluates the smallest
+                futures = [pool.submit(_lm_err, x0 + ds) for ds in steps[1:]]
+                errs = ([fun(x0 + steps[0], *args, **kwargs)] +
+                        [f.result() for f in futures])
+                costs = [np.dot(e, e) for e in errs]
+                k = np.argmin(np.where(np.isnan(costs), np.inf, costs))
+                ds, err, cost, lamb = steps[k], errs[k], costs[k], lambs[k]
+                x0test = x0 + ds
+
+                if cost >= cost_old:
+                    # step unsuccessful, increase lambda, ie. Lean more towards
+                    # gradient descent method(converges in larger range)
+                    lamb = lambs[-1] * np.sqrt(10)
+                elif np.isnan(cost):
+                    print('Unstable model. Increasing lambda')
+                    cost = np.inf
+                    lamb = lambs[-1] * np.sqrt(10)
+                else:
+                    # Lean more towards Gauss-Newton algorithm(converges
+                    # faster)
+                    lamb /= 2
+                ninner += nladder
+
+                if norm(ds) < xtol:  # small step
+                    stop = True
+                    status = 3
+                # small change in costfcn
+                if np.abs((cost-cost_old)/cost) < ftol:
+                    stop = True
+                    status = 2 if status is None else 4
+
+            if info == 2:
+                if not matfree:
+                    jac_cond = sr[0]/sr[-1]
+                # {cost/2/nfd/R/p:12.3f} for freq weighting
+                print(f"{niter:3d} | {ninner:5d} | {cost:12.8g} |"
+                      f" {jac_cond:12.3f} | {lamb:6.3f}")
+
+            if cost < cost_old or stop:
+                cost_old = cost
+                err_old = err
+                x0 = x0test
+                # save intermediate models
+                x0_mat[niter+1] = x0.copy()
+                cost_vec[niter+1] = cost.copy()
+
+            niter += 1
+            nfev += ninner
+
+            if checkpoint is not None and (niter % checkpoint_every == 0 or
+                                           stop or niter == nmax):
+                save_checkpoint(checkpoint, x=x0, lamb=lamb, niter=niter,
+                                nfev=nfev, x_mat=x0_mat[:niter+1],
+                                cost_vec=cost_vec[:niter+1],
+                                scaling=op_scaling, **checkpoint_data)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if niter >= nmax:
         status = 0
     message = TERMINATION_MESSAGES[status]
     if info > 0:
@@ -378,3 +613,73 @@ def lm(fun, x0, jac, info=2, nmax=50, lamb=None, ftol=1e-8, xtol=1e-8,
            x0_mat[:niter], 'cost_vec':cost_vec[niter], 'message':message,
            'success':status > 0, 'nfev':nfev, 'njev':niter, 'status':status}
     return res
+
+def lbfgs(fun, x0, info=2, nmax=50, ftol=1e-8, gtol=1e-8, scaling=None,
+          args=(), kwargs={}):
+    """Minimize a cost function with the L-BFGS quasi-Newton method
+
+    Useful when the Jacobian is too large to form, but the gradient is cheap,
+    fx. computed by an adjoint pass. See
+    :scipy-optimize:func:`scipy.optimize.minimize`.
+
+    Parameters
+    ----------
+    fun : callable
+        Function returning the cost and its gradient, ``cost, grad = fun(x)``
+    nmax : int, optional
+        Max number of iterations
+    info : {0, 1, 2}, optional
+        Level of verbosity, see :func:`lm`
+    scaling : ndarray, optional
+        The problem is solved in the scaled variables ``x*scaling``. The
+        column norms of the Jacobian are a good choice, see
+        :func:`column_norms`. Without scaling the first step is often too
+        large.
+
+    Returns
+    -------
+    res : dict
+        Same fields as returned by :func:`lm`. 'x_mat' contains the
+        parameters at each iteration.
+    """
+    if scaling is None:
+        scaling = np.ones(len(x0))
+    x0_mat = [np.copy(x0)]
+    cost_vec = []
+    cost = [None]
+
+    if info == 2:
+        print(f"{'i':3} | {'cost':12} |")
+
+    def callback(zk):
+        # cost of last evaluation is the cost at xk
+        x0_mat.append(zk/scaling)
+        cost_vec.append(cost[0])
+        if info == 2:
+            print(f"{len(x0_mat)-2:3d} | {cost[0]:12.8g} |")
+
+    def fcost(z):
+        cost[0], grad = fun(z/scaling, *args, **kwargs)
+        if not cost_vec:  # first evaluation is at x0
+            cost_vec.append(cost[0])
+        if not np.isfinite(cost[0]) or not np.all(np.isfinite(grad)):
+            # unstable model. A large, but finite, cost makes the line search
+            # backtrack; L-BFGS-B stops on inf.
+            cost[0] = 1e10*cost_vec[0]
+            grad = np.zeros_like(grad)
+        return cost[0], grad/scaling
+
+    sol = minimize(fcost, x0*scaling, jac=True, method='L-BFGS-B',
+                   callback=callback,
+                   options={'maxiter': nmax, 'ftol': ftol, 'gtol': gtol})
+    if info > 0:
+        print(f"Terminated: {sol.message}")
+        print(f"Function evaluations {sol.nfev}, initial cost "
+              f"{cost_vec[0]:.4e}, final cost {sol.fun:.4e}")
+
+    niter = sol.nit
+    res = {'x':sol.x/scaling, 'cost': sol.fun, 'fun':None, 'niter': niter,
+           'x_mat': np.array(x0_mat), 'cost_vec':np.array(cost_vec),
+           'message':sol.message, 'success':sol.success, 'nfev':sol.nfev,
+           'njev':sol.nfev, 'status':sol.status}
+    return res
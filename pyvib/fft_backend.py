@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+"""
+FFT backend used throughout pyvib.
+
+All FFTs in pyvib go through the functions in this module, such that the
+backend and the number of threads can be set in one place with
+:func:`set_backend`. The backends are
+
+- 'scipy': :mod:`scipy.fft` (pocketfft). Multithreaded with `workers` and the
+  default when available.
+- 'pyfftw': :mod:`pyfftw.interfaces.scipy_fft`. Optional; used if installed
+  and selected. The FFTW plans are cached, see
+  :func:`pyfftw.interfaces.cache.enable`.
+- 'numpy': :mod:`numpy.fft`. Single threaded; `workers` is ignored.
+
+pocketfft caches the twiddle factors for repeated sizes itself, so plans are
+reused by all backends. Use the real transforms :func:`rfft`/:func:`irfft`
+for real data; they are about twice as fast as the complex transforms and
+only compute the positive half of the spectrum.
+"""
+
+try:
+    import scipy.fft as _scipy_fft
+    HAS_SCIPY_FFT = True
+except ImportError:
+    HAS_SCIPY_FFT = False
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as _pyfftw_fft
+    HAS_PYFFTW = True
+except ImportError:
+    HAS_PYFFTW = False
+
+_backend = 'scipy' if HAS_SCIPY_FFT else 'numpy'
+_workers = None
+
+
+def set_backend(backend='auto', workers=None):
+    """Select the FFT backend and the default number of threads
+
+    Parameters
+    ----------
+    backend : str {'auto', 'scipy', 'pyfftw', 'numpy'}
+        'auto' selects pyfftw if installed, otherwise scipy, otherwise numpy.
+    workers : int, optional
+        Default number of threads. Negative values count from the number of
+        cores, ie. -1 uses all cores. Default (None) is one thread.
+    """
+    global _backend, _workers
+    backends = ('auto', 'scipy', 'pyfftw', 'numpy')
+    if backend not in backends:
+        raise ValueError(f'Wrong backend {backend}. Should be one of '
+                         f'{backends}')
+    if backend == 'auto':
+        backend = ('pyfftw' if HAS_PYFFTW else
+                   'scipy' if HAS_SCIPY_FFT else 'numpy')
+    if backend == 'pyfftw' and not HAS_PYFFTW:
+        raise ImportError('pyfftw is not installed. Use backend="scipy"')
+    if backend == 'scipy' and not HAS_SCIPY_FFT:
+        raise ImportError('scipy.fft is not available. Use backend="numpy"')
+    if backend == 'pyfftw':
+        # keep the plans of repeated sizes
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(60)
+    _backend = backend
+    _workers = workers
+
+def get_backend():
+    """The current backend and default number of threads"""
+    return _backend, _workers
+
+def _call(name, x, n, axis, workers):
+    if workers is None:
+        workers = _workers
+    if _backend == 'numpy':
+        return getattr(np.fft, name)(x, n=n, axis=axis)
+    if workers is not None and workers < 0:
+        workers = max(os.cpu_count() + 1 + workers, 1)
+    module = _pyfftw_fft if _backend == 'pyfftw' else _scipy_fft
+    return getattr(module, name)(x, n=n, axis=axis, workers=workers)
+
+def fft(x, n=None, axis=-1, workers=None):
+    """Complex FFT, see :func:`numpy.fft.fft`"""
+    return _call('fft', x, n, axis, workers)
+
+def ifft(x, n=None, axis=-1, workers=None):
+    """Inverse complex FFT, see :func:`numpy.fft.ifft`"""
+    return _call('ifft', x, n, axis, workers)
+
+def rfft(x, n=None, axis=-1, workers=None):
+    """FFT of real data, the n//2+1 non-negative frequencies, see
+    :func:`numpy.fft.rfft`"""
+    return _call('rfft', x, n, axis, workers)
+
+def irfft(x, n=None, axis=-1, workers=None):
+    """Inverse of :func:`rfft`, see :func:`numpy.fft.irfft`"""
+    return _call('irfft', x, n, axis, workers)
+
+def fft_lines(x, lines, axis=0, workers=None):
+    """FFT of `x` along `axis` at the frequency `lines`
+
+    The real FFT is used if `x` is real and all lines are in the non-negative
+    half of the spectrum.
+    """
+    n = x.shape[axis]
+    if np.isrealobj(x) and np.max(lines) <= n//2:
+        X = rfft(x, axis=axis, workers=workers)
+    else:
+        X = fft(x, axis=axis, workers=workers)
+    return np.take(X, lines, axis=axis)
@@ -2,14 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.fft import fft
 from scipy.interpolate import interp1d
 from scipy.linalg import norm, solve
+from scipy.sparse.linalg import LinearOperator
 
 from .common import mmul_weight
+from .fft_backend import fft, rfft
 from .helper.modal_plotting import plot_frf, plot_stab
-from .polynomial import multEdwdx, nl_terms, poly_deriv
-from .statespace import NonlinearStateSpace, StateSpaceIdent
+from .kernels import adjoint, check_engine, tangent
+from .polynomial import MonomialPlan, multEdwdx, nl_terms, poly_deriv
+from .statespace import (NonlinearStateSpace, StateSpaceIdent, freq_weight,
+                         freq_weight_adjoint)
 from .subspace import modal_list, subspace
 
 
@@ -26,11 +29,13 @@ class FNSI(NonlinearStateSpace, StateSpaceIdent):
         self.yactive = np.array([],dtype=int)
         self.n_nx = len(self.xactive)
         self.n_ny = len(self.yactive)
+        self._plan = None
 
     def nlterms(self, eq, powers):
         if eq in ('state', 'x'):
             self.xpowers = np.atleast_2d(powers)
             self.xd_powers, self.xd_coeff = poly_deriv(self.xpowers)
+            self._plan = None
             self.n_nx = self.xpowers.shape[0]
             if self.E.size == 0:  # E and F is reinitialized when estimated
                 self.E = np.zeros((self.n, self.n_nx))
@@ -41,12 +46,28 @@ class FNSI(NonlinearStateSpace, StateSpaceIdent):
             if self.F.size == 0:
                 self.F = np.zeros((self.p, self.n_ny))
 
+    @property
+    def plan(self):
+        """Evaluation plan for the monomials in ζ(y)"""
+        if self._plan is None:
+            xpowers = self.xpowers
+            if xpowers.size == 0:
+                xpowers = np.empty(shape=(0,self.p), dtype=int)
+            self._plan = MonomialPlan(xpowers.shape[1], xpowers)
+        return self._plan
+
     def output(self, u, t=None, x0=None):
         return dnlsim(self, u, t=t, x0=x0)
 
+    def output_batch(self, u, x0=None, params=None, engine='auto'):
+        return dnlsim_batch(self, u, x0=x0, params=params, engine=engine)
+
     def jacobian(self, x0, weight=False):
         return jacobian(x0, self, weight=weight)
 
+    def jacobian_operator(self, x0, weight=False, engine='auto'):
+        return jacobian_operator(x0, self, weight=weight, engine=engine)
+
     def ext_input(self, fmin=None, fmax=None, vel=False):
         """Form the extended input and output
 
@@ -85,11 +106,11 @@ class FNSI(NonlinearStateSpace, StateSpaceIdent):
         # if the data is not truly periodic, there is a slight difference
         # between doing Y=fft(sig.y); Ymean = np.sum(Y) / sig.P and taking the
         # fft directly of the averaged time signal as here.
-        Umean = fft(sig.um,axis=0)
-        Ymean = fft(sig.ym,axis=0)
+        Umean = sig.mean_spectra('um')
+        Ymean = sig.mean_spectra('ym')
         # If the nonlinear force is formed using the velocity we add it to Yext
         if vel is True:
-            Ydmean = fft(sig.ydm,axis=0)
+            Ydmean = sig.mean_spectra('ydm')
 
         Yext = np.hstack((Ymean, Ydmean)) if vel is True else Ymean
 
@@ -157,6 +178,7 @@ class FNSI(NonlinearStateSpace, StateSpaceIdent):
         self.F = F
         if vel is True and self.xpowers.size == 0:
             self.xpowers = np.empty(shape=(0,self.p))
+        self._plan = None
         self.xactive = np.arange(E.size)
         self.yactive = np.arange(0)  # F.size)
 
@@ -303,6 +325,100 @@ def dnlsim(system, u, t=None, x0=None):
 
     return tout, yout, xout
 
+def dnlsim_batch(system, u, x0=None, params=None, engine='auto'):
+    """Simulate several independent records of a FNSI model in lock-step.
+
+    The states of all records, and optionally several parameter vectors, are
+    stored as a (K,n,R) matrix and each time step is a few matrix-matrix
+    products instead of R*K serial simulations, see :func:`dnlsim`.
+
+    Parameters
+    ----------
+    u : ndarray(R,N,m) or ndarray(N,m)
+        input of R records of N samples
+    x0 : ndarray, optional
+        initial state, broadcastable to (K,R,n). Default zero.
+    params : ndarray(K,npar), optional
+        flattened parameter vectors, see :meth:`flatten`. The records are
+        simulated for each parameter vector. Default is the current model.
+    engine : str {'auto', 'numpy', 'loop'}, optional
+        'numpy' integrates in lock-step. 'loop' simulates each record with
+        :func:`dnlsim`. There is no numba kernel for FNSI, so 'auto' is
+        'numpy' and 'numba' raises a ValueError.
+
+    Returns
+    -------
+    yout : ndarray(R,N,p) or ndarray(K,R,N,p) if params are given
+    xout : ndarray(R,N,n) or ndarray(K,R,N,n) if params are given
+    """
+    engine = 'numpy' if engine == 'auto' else check_engine(engine)
+    if engine == 'numba':
+        raise ValueError('FNSI has no numba engine. Use engine="numpy"')
+    u = np.asarray(u, dtype=float)
+    if u.ndim == 2:
+        u = u[None]
+    R, N, m = u.shape
+    n, p = system.n, system.p
+    plan = system.plan
+    nvar = plan.nvar
+
+    if params is None:
+        params = system.flatten()[None]
+        squeeze = True
+    else:
+        params = np.atleast_2d(params)
+        squeeze = False
+    K = len(params)
+    x_orig = system.flatten()
+    x0 = np.broadcast_to(np.zeros(n) if x0 is None else x0, (K, R, n))
+    if engine == 'loop':
+        xout = np.empty((K, R, N, n))
+        yout = np.empty((K, R, N, p))
+        for k, par in enumerate(params):
+            system._copy(*system.extract(par))
+            for r in range(R):
+                _, yout[k,r], xout[k,r] = dnlsim(system, u[r], x0=x0[k,r])
+        system._copy(*system.extract(x_orig))
+        if squeeze:
+            return yout[0], xout[0]
+        return yout, xout
+
+    A = np.empty((K,n,n))
+    B = np.empty((K,n,m))
+    C = np.empty((K,p,n))
+    D = np.empty((K,p,m))
+    # E acting on the work vector of the plan
+    Ew = np.zeros((K,n,plan.nwork))
+    for k, par in enumerate(params):
+        A[k], B[k], C[k], D[k], E, _ = system.extract(par)
+        if E.size:
+            np.add.at(Ew[k], (np.s_[:], plan.idx[0]), E)
+    system._copy(*system.extract(x_orig))
+
+    work = np.empty((K, plan.nwork, R))
+    work[:,nvar] = 1
+    # monomials along the first axis
+    work_m = work.transpose((1,0,2))
+    xb = np.empty((N, K, n, R))
+    yb = np.empty((N, K, p, R))
+    ub = u.transpose((1,2,0))[:,None]  # (N,1,m,R)
+    xb[0] = x0.transpose((0,2,1))
+    for i in range(N):
+        # y(t) = C*x(t) + D*u(t)
+        yb[i] = C @ xb[i] + D @ ub[i]
+        if i == N-1:
+            break
+        # x(t+1) = A*x(t) + B*u(t) + E*ζ(y(t),ẏ(t))
+        work[:,:nvar] = yb[i,:,:nvar]
+        plan.evaluate(work_m)
+        xb[i+1] = A @ xb[i] + B @ ub[i] + Ew @ work
+
+    xout = xb.transpose((1,3,0,2))
+    yout = yb.transpose((1,3,0,2))
+    if squeeze:
+        return yout[0], xout[0]
+    return yout, xout
+
 def jacobian(x0, system, weight=False):
     """Compute the Jacobians of a steady state gray-box state-space model
 
@@ -376,7 +492,7 @@ def jacobian(x0, system, weight=False):
                           order='F').swapaxes(1,2).reshape((-1,p,R*npar),
                                                            order='F')
         # select only the positive half of the spectrum
-        jac = fft(jac, axis=0)[:nfd]
+        jac = rfft(jac, axis=0)[:nfd]
         jac = mmul_weight(jac, weight)
         # (nfd,p,R*npar) -> (nfd,p,R,npar) -> (nfd,R,p,npar) -> (nfd*R*p,npar)
         jac = jac.reshape((-1,p,R,npar),
@@ -392,6 +508,81 @@ def jacobian(x0, system, weight=False):
 
     return J
 
+def jacobian_operator(x0, system, weight=False, engine='auto'):
+    """Jacobian of the (weighted) error as a matrix-free linear operator
+
+    See :func:`pyvib.pnlss.jacobian_operator`. The linearized model is
+
+        δx(t+1) = (A + E∂ζ∂y C) δx(t) + d(t) + E∂ζ∂y w(t)
+        δy(t)   = C δx(t) + w(t)
+
+    with ``d = δA x + δB u + δE ζ`` and ``w = δC x + δD u``. Contrary to
+    :func:`jacobian`, the influence of C and D through ζ(y) is included, as
+    ``J.T @ e`` is used for the gradient, see :meth:`FNSI.gradient`. F is
+    not used by :func:`dnlsim` and has zero derivative.
+
+    Returns
+    -------
+    J : scipy.sparse.linalg.LinearOperator
+    """
+    n, m, p = system.n, system.m, system.p
+    R, npp = system.signal.R, system.signal.npp
+    xact, yact = system.xactive, system.yactive
+
+    A, B, C, D, E, F = system.extract(x0)
+    y_trans = system.y_mod[system.idx_trans]
+    x_trans = system.x_mod[system.idx_trans]
+    u_trans = system.signal.um[system.idx_trans]
+    NT = u_trans.shape[0]
+    zeta = nl_terms(y_trans.T, system.xpowers).T  # (NT,n_nx)
+    # E∂ζ∂y (NT,n,p)
+    if E.size == 0:
+        Edwdy = np.zeros((NT,n,p))
+    else:
+        Edwdy = multEdwdx(y_trans.T, system.xd_powers, system.xd_coeff, E,
+                          p).transpose((2,0,1))
+    A_t = np.ascontiguousarray(A + Edwdy @ C)
+    C_t = np.ascontiguousarray(np.broadcast_to(C, (NT,p,n)))
+
+    rowidx = np.arange(p*NT)[system.idx_remtrans]
+    split = np.cumsum([n**2, n*m, p*n, p*m, len(xact)])
+    fweight = weight is not False and system.freq_weight
+    if weight is not False and not system.freq_weight:
+        raise ValueError('Time weighting not possible')
+    nrows = len(rowidx)
+    if fweight:
+        nrows = 2*(npp//2)*R*p
+
+    def matvec(v):
+        dA, dB, dC, dD, dE, dF = np.split(np.ravel(v), split)
+        Ef = np.zeros_like(E)
+        Ef.flat[xact] = dE
+        w = x_trans @ dC.reshape(p,n).T + u_trans @ dD.reshape(p,m).T
+        d = (x_trans @ dA.reshape(n,n).T + u_trans @ dB.reshape(n,m).T +
+             zeta @ Ef.T + (Edwdy @ w[...,None])[...,0])
+        out = tangent(A_t, C_t, d, engine) + w
+        out = out.T.ravel()[rowidx]
+        if fweight:
+            out = freq_weight(out, weight, npp, R, p)
+        return out
+
+    def rmatvec(e):
+        e = np.ravel(e)
+        if fweight:
+            e = freq_weight_adjoint(e, weight, npp, R, p)
+        g = np.zeros(p*NT)
+        g[rowidx] = e
+        g = g.reshape(p,NT).T
+        lam = adjoint(A_t, C_t, g, engine)
+        # gradient wrt. w
+        h = g + (lam[:,None] @ Edwdy)[:,0]
+        return np.hstack(((lam.T @ x_trans).ravel(), (lam.T @ u_trans).ravel(),
+                          (h.T @ x_trans).ravel(), (h.T @ u_trans).ravel(),
+                          (lam.T @ zeta).flat[xact], np.zeros(len(yact))))
+
+    return LinearOperator((nrows, len(x0)), matvec=matvec, rmatvec=rmatvec,
+                          dtype=float)
+
 def element_jacobian(samples, A, C, Edwdy, Fdwdy, active):
     """Compute Jacobian of the output y wrt. A, B, and E
 
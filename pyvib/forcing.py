@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.fft import ifft
+
+from .fft_backend import ifft, irfft
 
 """
 Example of a closure-function. See also partial from ...
@@ -206,11 +207,16 @@ def multisine(f1=0, f2=None, N=1024, fs=None, R=1, P=1, lines='full',rms=1, ngro
 
     nlines = len(_lines)
     # multisine generation - frequency domain implementation
-    U = np.zeros((R,N),dtype=complex)
-    # excite the selected frequencies
-    U[:,_lines] = np.exp(2j*np.pi*np.random.rand(R,nlines))
-
-    u = 2*np.real(ifft(U,axis=1))  # go to time domain
+    if _lines.max() < N/2:
+        # 2*real(ifft(U)) of the positive spectrum is irfft(U)
+        U = np.zeros((R,N//2+1),dtype=complex)
+        # excite the selected frequencies
+        U[:,_lines] = np.exp(2j*np.pi*np.random.rand(R,nlines))
+        u = irfft(U,n=N,axis=1)  # go to time domain
+    else:
+        U = np.zeros((R,N),dtype=complex)
+        U[:,_lines] = np.exp(2j*np.pi*np.random.rand(R,nlines))
+        u = 2*np.real(ifft(U,axis=1))
     u = rms*u / np.std(u[0])  # rescale to obtain desired rms/std
 
     # Because the ifft is for [0,2*pi[, there is no need to remove any point
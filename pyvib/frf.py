@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.fft import fft
 from numpy.linalg import pinv
 
+from .fft_backend import fft_lines, rfft
+
 def periodic(u, y, fs=None, fmin=None, fmax=None): # signal
     """Interface to periodic FRF
 
@@ -26,7 +27,7 @@ def periodic(u, y, fs=None, fmin=None, fmax=None): # signal
     else:
         npp = u.shape[0]
         freq = np.arange(npp) * fs/npp
-        flines = np.where((freq >= fmin) & (freq <= fmax))
+        flines = np.where((freq >= fmin) & (freq <= fmax))[0]
         freq = freq[flines]
 
     # If signal is cut, used that. Otherwise use the full signal.
@@ -37,8 +38,8 @@ def periodic(u, y, fs=None, fmin=None, fmax=None): # signal
     #     u = signal.u
     #     y = signal.y
 
-    U = fft(u, axis=0)[flines].transpose((1,2,3,0))
-    Y = fft(y, axis=0)[flines].transpose((1,2,3,0))
+    U = fft_lines(u, flines).transpose((1,2,3,0))
+    Y = fft_lines(y, flines).transpose((1,2,3,0))
     G, covG, covGn = bla_periodic(U, Y)
     G = G.transpose((2,0,1))
     if covG is not None:
@@ -49,7 +50,7 @@ def periodic(u, y, fs=None, fmin=None, fmax=None): # signal
     return freq, G, covG, covGn
 
 
-def bla_periodic(U, Y):  #(u, y, nper, fs, fmin, fmax):
+def bla_periodic(U, Y, chunk=None):  #(u, y, nper, fs, fmin, fmax):
     """Calculate the frequency response matrix, and the corresponding noise and
     total covariance matrices from the spectra of periodic input/output data.
 
@@ -60,26 +61,28 @@ def bla_periodic(U, Y):  #(u, y, nper, fs, fmin, fmax):
     G(f) = FRF(f) = Y(f)/U(f) (Y/F in classical notation)
     Y and U is the output and input of the system in frequency domain.
 
+    The R realizations are grouped in M = R//m blocks of m experiments, where
+    block k holds the realizations k, k+M, ..., k+(m-1)M. All frequencies are
+    handled at once using stacked (F,...) arrays. The covariances are for the
+    column stacked FRM, vec(G(f)).
+
     Parameters
     ----------
-    u : ndarray
-        Forcing signal
-    y : ndarray
-        Response signal (displacements)
-    fs : float
-        Sampling frequency
-    fmin : float
-        Starting frequency in Hz
-    fmax : float
-        Ending frequency in Hz
+    U : ndarray(m,R,P,F)
+        Input spectra
+    Y : ndarray(p,R,P,F)
+        Output spectra
+    chunk : int, optional
+        Process `chunk` frequencies at a time to bound the memory used for
+        intermediate results. Default is all frequencies at once.
 
     Returns
     -------
-    G : ndarray
+    G : ndarray(p,m,F)
         Frequency response matrix(FRM)
-    covGML : ndarray
+    covGML : ndarray(m*p,m*p,F)
         Total covariance (= stochastic nonlinear contributions + noise)
-    covGn : ndarray
+    covGn : ndarray(m*p,m*p,F)
         Noise covariance
     """
 
@@ -89,96 +92,299 @@ def bla_periodic(U, Y):  #(u, y, nper, fs, fmin, fmax):
     M = np.floor(R/m).astype(int)  # number of block of experiments
     if M*m != R:
         print('Warning: suboptimal number of experiments: B*m != M')
-    # Reshape in M blocks of m experiments
-    U = U[:,:m*M].reshape((m,m,M,P,F))
-    Y = Y[:,:m*M].reshape((p,m,M,P,F))
 
-    if P > 1:
-        # average input/output spectra over periods
-        U_mean = np.mean(U,axis=3)  # m x m x M x F
-        Y_mean = np.mean(Y,axis=3)
-
-        # Estimate noise spectra
-        # create new axis. We could have used U_m = np.mean(U,3, keepdims=True)
-        NU = U - U_mean[:,:,:,None,:]  # m x m x M x P x F
-        NY = Y - Y_mean[:,:,:,None,:]
-
-        # Calculate input/output noise (co)variances on averaged(over periods)
-        # spectra
-        covU = np.empty((m*m,m*m,M,F), dtype=complex)
-        covY = np.empty((p*m,p*m,M,F), dtype=complex)
-        covYU = np.empty((p*m,m*m,M,F), dtype=complex)
-        for mm in range(M):  # Loop over experiment blocks
-            # noise spectrum of experiment block mm (m x m x P x F)
-            NU_m = NU[:,:,mm]
-            NY_m = NY[:,:,mm]
-            for f in range(F):
-                # TODO extend this using einsum, so we avoid all loops
-                # TODO fx: NU_m[...,f].reshape(-1,*NU_m[...,f].shape[2:])
-                # flatten the m x m dimension and use einsum to take the outer
-                # product of m*m x m*m and then sum over the p periods.
-                tmpUU = NU_m[...,f].reshape(-1, P)  # create view
-                tmpYY = NY_m[...,f].reshape(-1, P)
-                covU[:,:,mm,f] = np.einsum('ij,kj->ik',tmpUU,tmpUU.conj()) / (P-1)/P
-                covY[:,:,mm,f] = np.einsum('ij,kj->ik',tmpYY,tmpYY.conj()) / (P-1)/P
-                covYU[:,:,mm,f] = np.einsum('ij,kj->ik',tmpYY,tmpUU.conj()) / (P-1)/P
-
-        # Further calculations with averaged spectra
-        U = U_mean  # m x m x M x F
-        Y = Y_mean
-    else:
-        U = U.squeeze(axis=3)
-        Y = Y.squeeze(axis=3)
-
-    # Compute FRM and noise and total covariance on averaged(over experiment
-    # blocks and periods) FRM
-    G = np.empty((p,m,F), dtype=complex)
-    covGML = np.empty((m*p,m*p,F), dtype=complex)
-    covGn = np.empty((m*p,m*p,F), dtype=complex)
-    Gm = np.empty((p,m,M), dtype=complex)
-    U_inv_m = np.empty((m,m,M), dtype=complex)
-    covGn_m = np.empty((m*p,m*p,M), dtype=complex)
-
-    for f in range(F):
-        # Estimate the frequency response matrix (FRM)
-        for mm in range(M):
-            # psudo-inverse by svd. A = usvᴴ, then A⁺ = vs⁺uᴴ where s⁺=1/s
-            U_inv_m[:,:,mm] = pinv(U[:,:,mm,f])
-            # FRM of experiment block m at frequency f
-            Gm[:,:,mm] = Y[:,:,mm,f] @ U_inv_m[:,:,mm]
-
-        # Average FRM over experiment blocks
-        G[:,:,f] = Gm.mean(2)
-
-        # Estimate the total covariance on averaged FRM
+    if chunk is None:
+        chunk = F
+    G = np.empty((F,p,m), dtype=complex)
+    covGML = np.empty((F,m*p,m*p), dtype=complex)
+    covGn = np.empty((F,m*p,m*p), dtype=complex)
+    for i in range(0, F, chunk):
+        fslice = slice(i, i+chunk)
+        Gf, covGMLf, covGnf = _bla_periodic(U[...,fslice], Y[...,fslice], M)
+        G[fslice] = Gf
         if M > 1:
-            NG = G[:,:,f,None] - Gm
-            tmp = NG.reshape(-1, M)
-            covGML[:,:,f] = np.einsum('ij,kj->ik',tmp,tmp.conj()) / M/(M-1)
-
-        # Estimate noise covariance on averaged FRM (only if P > 1)
+            covGML[fslice] = covGMLf
         if P > 1:
-            for mm in range(M):
-                U_invT = U_inv_m[:,:,mm].T
-                A = np.kron(U_invT, np.eye(p))
-                B = -np.kron(U_invT, Gm[:,:,mm])
-                AB = A @ covYU[:,:,mm,f] @ B.conj().T
-                covGn_m[:,:,mm] = A @ covY[:,:,mm,f] @ A.conj().T + \
-                    B @ covU[:,:,mm,f] @ B.conj().T + \
-                    (AB + AB.conj().T)
-
-            covGn[:,:,f] = covGn_m.mean(2)/M
+            covGn[fslice] = covGnf
 
+    G = G.transpose((1,2,0))
     # No total covariance estimate possible if only one experiment block
-    if M < 2:
-        covGML = None
+    covGML = covGML.transpose((1,2,0)) if M > 1 else None
     # No noise covariance estimate possible if only one period
-    if P == 1:
-        covGn = None
+    covGn = covGn.transpose((1,2,0)) if P > 1 else None
+
+    return G, covGML, covGn
+
+def _vec(X):
+    """Column stacking of the two last axes, (...,p,m) -> (...,p*m)"""
+    return X.swapaxes(-1,-2).reshape(*X.shape[:-2], -1)
+
+def _outer_sum(X, axis):
+    """Σ vec(X)vec(X)ᴴ over `axis` of the (...,k) array X"""
+    return np.einsum('...i,...j->...ij', X, X.conj()).sum(axis)
+
+def _bla_periodic(U, Y, M):
+    """BLA of the frequencies in U(m,R,P,F), Y(p,R,P,F). Returns G(F,p,m) and
+    the covariances (F,p*m,p*m); the covariances are not set if M < 2 or P < 2.
+    """
+    m, R, P, F = U.shape
+    p = Y.shape[0]
+    # Reshape in M blocks of m experiments, every M'th realization,
+    # (F,M,P,m,m) and (F,M,P,p,m)
+    U = U[:,:m*M].reshape((m,m,M,P,F)).transpose((4,2,3,0,1))
+    Y = Y[:,:m*M].reshape((p,m,M,P,F)).transpose((4,2,3,0,1))
+
+    # average input/output spectra over periods
+    U_mean = U.mean(axis=2)  # F x M x m x m
+    Y_mean = Y.mean(axis=2)
+
+    # Estimate the frequency response matrix (FRM) of each experiment block.
+    # psudo-inverse by svd. A = usvᴴ, then A⁺ = vs⁺uᴴ where s⁺=1/s
+    U_inv = pinv(U_mean)
+    Gm = Y_mean @ U_inv  # F x M x p x m
+
+    # Average FRM over experiment blocks
+    G = Gm.mean(axis=1)
+
+    # Estimate the total covariance on averaged FRM
+    covGML = None
+    if M > 1:
+        NG = _vec(Gm - G[:,None])
+        covGML = _outer_sum(NG, axis=1) / M/(M-1)
+
+    # Estimate noise covariance on averaged FRM (only if P > 1).
+    # The noise on the FRM of each block, vec(NG) = A*vec(NY) + B*vec(NU),
+    # with A = kron(U⁻ᵀ, I) and B = -kron(U⁻ᵀ, Gm), is vec((NY - Gm*NU)*U⁻¹).
+    # Thus A*covY*Aᴴ + B*covU*Bᴴ + A*covYU*Bᴴ + B*covUY*Aᴴ equals the sample
+    # covariance of the propagated noise spectra.
+    covGn = None
+    if P > 1:
+        NU = U - U_mean[:,:,None]  # F x M x P x m x m
+        NY = Y - Y_mean[:,:,None]
+        NG = _vec((NY - Gm[:,:,None] @ NU) @ U_inv[:,:,None])
+        covGn = _outer_sum(NG, axis=(1,2)) / (P-1)/P / M**2
 
     return G, covGML, covGn
 
-def covariance(y):
+class StreamingBLA():
+    """Streaming BLA of periodic data
+
+    Accumulates the BLA and its covariances one realization, or a few periods
+    of a realization, at a time. Only spectra at `lines` are stored, thus the
+    memory scales with the number of frequencies and not with the length of
+    the record.
+
+    The experiment blocks are the same as in :func:`bla_periodic`, block k
+    holds the realizations k, k+M, ..., k+(m-1)M, and the result equals
+    :func:`bla_periodic`. For m = 1 only running means and covariances over
+    the periods are stored. For m > 1 the period spectra of a block are kept
+    until the block is complete, as the noise covariance includes the
+    cross-covariances between the experiments of a block. This requires the
+    number of realizations R and the same number of periods in each
+    realization.
+
+    Parameters
+    ----------
+    lines : ndarray(F)
+        Excited lines
+    m : int
+        Number of inputs
+    p : int
+        Number of outputs
+    R : int, optional
+        Number of realizations. Required if m > 1.
+
+    Examples
+    --------
+    Realizations from a memory-mapped file with shape (npp,m,R,P)
+
+    >>> u = np.load('u.npy', mmap_mode='r')
+    >>> y = np.load('y.npy', mmap_mode='r')
+    >>> R = u.shape[2]
+    >>> bla = StreamingBLA(lines, m, p, R)
+    >>> for r in range(R):
+    ...     bla.add_realization(u[:,:,r], y[:,:,r])
+    >>> G, covG, covGn = bla.result()
+    """
+
+    def __init__(self, lines, m, p, R=None):
+        if m > 1 and R is None:
+            raise ValueError('The number of realizations R is required for '
+                             'm > 1 inputs')
+        self.lines = lines
+        self.m, self.p = m, p
+        # Number of experiment blocks
+        self.nblock = None if m == 1 else R//m
+        if m > 1 and self.nblock*m != R:
+            print('Warning: suboptimal number of experiments: B*m != M')
+        F = len(lines)
+        # Running mean and M2 = Σ(x - mean)(x - mean)ᴴ over blocks of vec(Gm)
+        self.M = 0
+        self._Gmean = np.zeros((F,p*m), dtype=complex)
+        self._GM2 = np.zeros((F,p*m,p*m), dtype=complex)
+        # Sum of the noise covariance of each block
+        self._covGn = np.zeros((F,p*m,p*m), dtype=complex)
+        # Sum of the output noise covariance of each realization
+        self.R = 0
+        self._covY = np.zeros((F,p,p), dtype=complex)
+        # Period spectra of the realizations of incomplete blocks, m > 1
+        self._blocks = {}
+        self._new_realization()
+
+    def _new_realization(self):
+        # Running mean and M2 over periods of x = [Y; U], (F,p+m)
+        F = len(self.lines)
+        self.P = 0
+        self._xmean = np.zeros((F,self.p+self.m), dtype=complex)
+        self._xM2 = np.zeros((F,self.p+self.m,self.p+self.m), dtype=complex)
+        self._X = []
+
+    def add(self, u, y):
+        """Add periods of the current realization
+
+        Parameters
+        ----------
+        u : ndarray(npp,m) or ndarray(npp,m,P)
+        y : ndarray(npp,p) or ndarray(npp,p,P)
+        """
+        if u.ndim == 2:
+            u, y = u[...,None], y[...,None]
+        U = fft_lines(u, self.lines)  # F x m x P
+        Y = fft_lines(y, self.lines)
+        X = np.concatenate((Y, U), axis=1).transpose((0,2,1))  # F x P x p+m
+        if self.m > 1:
+            self._X.append(X)
+
+        # merge the mean and M2 of the new periods with the running ones
+        nb = X.shape[1]
+        n = self.P + nb
+        mean_b = X.mean(axis=1)
+        NX = X - mean_b[:,None]
+        M2_b = np.einsum('fki,fkj->fij', NX, NX.conj())
+        delta = mean_b - self._xmean
+        self._xM2 += M2_b + np.einsum('fi,fj->fij', delta, delta.conj()) * \
+            self.P*nb/n
+        self._xmean += delta*nb/n
+        self.P = n
+
+    def next_realization(self):
+        """End the current realization. An experiment block is completed when
+        its m'th realization is added."""
+        if self.P == 0:
+            return
+        p = self.p
+        if self.P > 1:
+            self._covY += self._xM2[:,:p,:p] / (self.P-1)/self.P
+        r = self.R
+        self.R += 1
+        if self.m == 1:
+            self._add_block(self.P, self._xmean, self._xM2)
+        elif r < self.m*self.nblock:
+            block = self._blocks.setdefault(r % self.nblock, [])
+            block.append(np.concatenate(self._X, axis=1))
+            if len(block) == self.m:
+                self._add_block_mimo(self._blocks.pop(r % self.nblock))
+        self._new_realization()
+
+    def add_realization(self, u, y):
+        """Add all periods of one realization, see :meth:`add`"""
+        self.add(u, y)
+        self.next_realization()
+
+    def _update(self, Gm):
+        """Update the running mean and M2 of the FRM with block FRM Gm"""
+        self.M += 1
+        vG = _vec(Gm)
+        delta = vG - self._Gmean
+        self._Gmean += delta/self.M
+        self._GM2 += np.einsum('fi,fj->fij', delta, (vG - self._Gmean).conj())
+
+    def _add_block(self, P, xmean, xM2):
+        """Single input block from the running moments of one realization"""
+        p = self.p
+        U_inv = 1/xmean[:,p:]
+        Gm = xmean[:,:p,None] * U_inv[:,None]  # F x p x 1
+        self._update(Gm)
+        if P < 2:
+            return
+        # The noise on the FRM, vec(NG) = (NY - Gm*NU)/U, see bla_periodic.
+        T = np.concatenate((np.broadcast_to(np.eye(p), Gm.shape[:1]+(p,p)),
+                            -Gm), axis=2)  # F x p x p+1
+        W = T @ xM2 @ T.conj().transpose((0,2,1)) / (P-1)/P
+        self._covGn += W * np.abs(U_inv[:,:,None])**2
+
+    def _add_block_mimo(self, X):
+        """Block from the period spectra X (F,P,p+m) of its m experiments"""
+        p = self.p
+        if len({x.shape[1] for x in X}) > 1:
+            raise ValueError('The realizations of an experiment block must '
+                             'have the same number of periods')
+        X = np.stack(X, axis=-1).transpose((2,3,1,0))  # p+m x m x P x F
+        Gm, _, covGn = _bla_periodic(X[p:], X[:p], 1)
+        self._update(Gm)
+        if covGn is not None:
+            self._covGn += covGn
+
+    def result(self):
+        """BLA of the completed experiment blocks
+
+        Incomplete experiment blocks are not used.
+
+        Returns
+        -------
+        G : ndarray(F,p,m)
+            Frequency response matrix(FRM)
+        covG : ndarray(F,m*p,m*p)
+            Total covariance (= stochastic nonlinear contributions + noise).
+            None if there is less than two experiment blocks.
+        covGn : ndarray(F,m*p,m*p)
+            Noise covariance. None if there is only one period.
+        """
+        if self.M == 0:
+            raise ValueError('No complete experiment block is added')
+        F, p, m = len(self.lines), self.p, self.m
+        G = self._Gmean.reshape(F,m,p).transpose((0,2,1))
+        covG = None
+        if self.M > 1:
+            covG = self._GM2 / self.M/(self.M-1)
+        covGn = None
+        if np.any(self._covGn):
+            covGn = self._covGn / self.M**2
+        return G, covG, covGn
+
+    @property
+    def covY(self):
+        """Output noise covariance (F,p,p), averaged over realizations"""
+        return self._covY / max(self.R, 1)
+
+def bla_stream(records, lines, m, p, R=None):
+    """BLA from a stream of realizations
+
+    Parameters
+    ----------
+    records : iterable
+        of (u, y) pairs with the periods of one realization, (npp,m,P) and
+        (npp,p,P). Fx. a generator, or slices of memory-mapped arrays.
+    lines : ndarray(F)
+        Excited lines
+    m : int
+        Number of inputs
+    p : int
+        Number of outputs
+    R : int, optional
+        Number of realizations. Required if m > 1.
+
+    Returns
+    -------
+    G, covG, covGn
+        See :meth:`StreamingBLA.result`
+    """
+    bla = StreamingBLA(lines, m, p, R)
+    for u, y in records:
+        bla.add_realization(u, y)
+    return bla.result()
+
+def covariance(y, chunk=None, Y=None):
     """Compute covariance matrix output spectra due to noise from signal y
 
     The variation is calculated along the periods and averaged over the
@@ -190,6 +396,12 @@ def covariance(y):
         signal where npp is the number of points per period, p is the number of
         dofs, R is the number of  realizations, and P is the number of
         periods
+    chunk : int, optional
+        Transform `chunk` periods at a time and update a running covariance,
+        see :class:`StreamingCovariance`. Default is all periods at once.
+    Y : ndarray(nfd,p,R,P), optional
+        Spectra of y in the positive half of the spectrum, if already
+        computed.
 
     Returns
     -------
@@ -199,27 +411,75 @@ def covariance(y):
 
     # Number of samples, outputs, realizations, and periods
     npp,p,R,P = y.shape
-    Y = fft(y, axis=0)
+    if chunk is not None:
+        cov = StreamingCovariance(npp, p, R)
+        for i in range(0, P, chunk):
+            cov.add(y[...,i:i+chunk])
+        return cov.covY
+
     # Number of bins in positive half of the spectrum
     nfd = int(npp/2)
-    Y = Y[:nfd]
-    # average over periods
-    Ymean = Y.mean(3)
+    if Y is None:
+        Y = rfft(y, axis=0)[:nfd]
     # Variations over periods
-    NY = Y - Ymean[...,None]  # (npp,p,R,P)
-    # TODO fix NY
-    #NY = permute(NY,[2 3 4 1]); % p x R x P x NFD
-    covY = np.empty((p,p,R,nfd), dtype=complex)
-    for f in range(nfd):
-        for r in range(R):
-            tmpYY = NY[f,:,r,:].reshape(-1, P)
-            covY[...,r,f] = np.einsum('ij,kj->ik',tmpYY,tmpYY.conj()) / (P-1)/P
-
-    # average over all realizations
-    covY = covY.mean(2)
-    covY = covY.T
+    NY = Y - Y.mean(3, keepdims=True)  # (nfd,p,R,P)
+    # covY(f) = Σ NY*NYᴴ summed over periods, averaged over realizations.
+    # Note the order of the indices, covY(f,i,j) = Σ NY(f,j)*conj(NY(f,i))
+    covY = np.einsum('fjrk,firk->fij', NY, NY.conj()) / (P-1)/P/R
     return covY
 
+class StreamingCovariance():
+    """Running covariance of the output spectra over periods
+
+    Single pass version of :func:`covariance`. Periods are added with
+    :meth:`add`, and the mean and sum of squared deviations of the spectra are
+    updated with the stable pairwise (Welford/Chan) update. Only (nfd,R,p,p)
+    numbers are stored, independent of the number of periods.
+
+    Parameters
+    ----------
+    npp : int
+        Number of points per period
+    p : int
+        Number of outputs
+    R : int
+        Number of realizations
+    """
+
+    def __init__(self, npp, p, R):
+        self.npp = npp
+        nfd = int(npp/2)
+        self.P = 0
+        self._mean = np.zeros((nfd,p,R), dtype=complex)
+        self._M2 = np.zeros((nfd,R,p,p), dtype=complex)
+
+    def add(self, y):
+        """Add periods
+
+        Parameters
+        ----------
+        y : ndarray(npp,p,R) or ndarray(npp,p,R,P)
+        """
+        if y.ndim == 3:
+            y = y[...,None]
+        Y = rfft(y, axis=0)[:len(self._mean)]
+        nb = Y.shape[3]
+        n = self.P + nb
+        mean_b = Y.mean(3)
+        NY = Y - mean_b[...,None]
+        delta = mean_b - self._mean
+        self._M2 += np.einsum('fjrk,firk->frij', NY, NY.conj()) + \
+            np.einsum('fjr,fir->frij', delta, delta.conj()) * self.P*nb/n
+        self._mean += delta*nb/n
+        self.P = n
+
+    @property
+    def covY(self):
+        """covariance matrix (nfd,p,p), see :func:`covariance`"""
+        if self.P < 2:
+            raise ValueError('At least two periods are needed')
+        return self._M2.mean(1) / (self.P-1)/self.P
+
 def nonperiodic(u, y, N, fs, fmin, fmax):
     """Calculate FRF for a nonperiodic signal.
 
@@ -294,10 +554,10 @@ def nonperiodic(u, y, N, fs, fmin, fmax):
     u = np.reshape(u, (N, M))
     y = np.reshape(y, (N, M))
 
-    U = np.fft.fft(u, axis=0) / np.sqrt(N)
-    U = U[1:N/2+1,:]
-    Y = np.fft.fft(y, axis=0) / np.sqrt(N)
-    Y = Y[1:N/2+1,:]
+    U = rfft(u, axis=0) / np.sqrt(N)
+    U = U[1:N//2+1,:]
+    Y = rfft(y, axis=0) / np.sqrt(N)
+    Y = Y[1:N//2+1,:]
 
     U = np.diff(U, axis=0)
     Y = np.diff(Y, axis=0)
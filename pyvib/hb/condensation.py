@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from functools import partial
+
+import numpy as np
+from scipy.linalg import block_diag, lu_factor, lu_solve
+from scipy.sparse import issparse
+from scipy.sparse.linalg import splu
+
+from .hbcommon import fft_coeff
+
+
+class Condensation(object):
+    """Condensation of the linear DOFs of the harmonic balance equations.
+
+    The nonlinear forces only act on, and depend on, the nonlinear DOFs N.
+    For each harmonic the equations h(z,ω) = A(ω)z - b(z) = 0 are
+    partitioned into the linear DOFs L and N,
+
+        A_LL z_L + A_LN z_N = F_L
+        A_NL z_L + A_NN z_N = F_N - fnl_N(z_N)
+
+    and z_L is eliminated using the factorization of the dynamic stiffness
+    A_LL. This gives the reduced equations in the coefficients of N only
+
+        h̃(z_N,ω) = S z_N - F̃ + fnl_N(z_N) = 0
+        S = A_NN - A_NL A_LL⁻¹ A_LN,  F̃ = F_N - A_NL A_LL⁻¹ F_L
+
+    The reduced coefficients z_N are ordered as the full z, ie. as the Fourier
+    coefficients of a system with len(dofs) DOFs. The response of all DOFs is
+    recovered with :meth:`expand`.
+
+    Parameters
+    ----------
+    hb : HB
+        Harmonic balance object
+    dofs : array_like, optional
+        DOFs that are kept. Default is the nonlinear DOFs of hb.nonlin
+    """
+
+    def __init__(self, hb, dofs=None):
+        if dofs is None:
+            dofs = hb.nonlin.nldofs()
+        n = hb.n
+        NH = hb.NH
+        self.n = n
+        self.NH = NH
+        self.dofs = np.unique(np.asarray(dofs, dtype=int))
+        self.ldofs = np.setdiff1d(np.arange(n), self.dofs)
+        nd = len(self.dofs)
+        # index of the reduced coefficients in the full z
+        self.idx = (np.arange(2*NH+1)[:,None]*n + self.dofs).ravel()
+        self.nz = len(self.idx)
+
+        # index of N and L in the full z and of N in the reduced z, for each
+        # harmonic. One basis function for DC, sine and cosine for the others
+        self.blocks = []
+        for h in range(NH+1):
+            a = np.arange(1) if h == 0 else np.array([2*h-1, 2*h])
+            self.blocks.append(((a[:,None]*n + self.dofs).ravel(),
+                                (a[:,None]*n + self.ldofs).ravel(),
+                                (a[:,None]*nd + np.arange(nd)).ravel()))
+        self.S = None
+
+    def factor(self, A, force):
+        """Factorize the dynamic stiffness of the linear DOFs
+
+        Parameters
+        ----------
+        A : ndarray(nz, nz) or sparse matrix
+            Linear dynamics, see :meth:`HB.assembleA`. The blocks of the
+            linear DOFs are factorized by sparse LU if A is sparse.
+        force : ndarray(n, nt)
+            External force in time domain
+        """
+        F = fft_coeff(force, self.NH)
+        S = []
+        self.Ft = np.empty(self.nz)
+        self.solve, self.X, self.y, self.A_NL = [], [], [], []
+        if issparse(A):
+            A = A.tocsr()
+        for iN, iL, ir in self.blocks:
+            if issparse(A):
+                A_N, A_L = A[iN], A[iL]
+                A_NN, A_NL = A_N[:,iN].toarray(), A_N[:,iL]
+                A_LN = A_L[:,iN].toarray()
+                solve = splu(A_L[:,iL].tocsc()).solve if len(iL) else None
+            else:
+                A_NN, A_NL = A[np.ix_(iN, iN)], A[np.ix_(iN, iL)]
+                A_LN = A[np.ix_(iL, iN)]
+                solve = (partial(lu_solve, lu_factor(A[np.ix_(iL, iL)]))
+                         if len(iL) else None)
+            if solve is not None:
+                X = solve(A_LN)
+                y = solve(F[iL])
+            else:
+                X, y = np.empty((0, len(iN))), np.empty(0)
+            S.append(A_NN - A_NL @ X)
+            self.Ft[ir] = F[iN] - A_NL @ y
+            self.solve.append(solve)
+            self.X.append(X)
+            self.y.append(y)
+            self.A_NL.append(A_NL)
+        self.S = block_diag(*S)
+
+    def expand(self, zr):
+        """Recover the full coefficients z from the reduced zr"""
+        z = np.empty(self.n*(2*self.NH+1))
+        for (iN, iL, ir), X, y in zip(self.blocks, self.X, self.y):
+            z[iN] = zr[ir]
+            z[iL] = y - X @ zr[ir]
+        return z
+
+    def reduce(self, v):
+        """Schur complement v_N - A_NL A_LL⁻¹ v_L of a full vector v
+
+        Used to reduce the derivative of h wrt. a parameter, like ω.
+        """
+        vr = np.empty(self.nz)
+        for (iN, iL, ir), solve, A_NL in zip(self.blocks, self.solve,
+                                             self.A_NL):
+            vr[ir] = v[iN]
+            if solve is not None:
+                vr[ir] -= A_NL @ solve(v[iL])
+        return vr
@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from scipy.linalg import block_diag, kron, solve, lstsq, norm
-from scipy.sparse import csr_matrix
+from scipy.linalg import (block_diag, solve, lstsq, lu_factor,
+                          lu_solve, norm)
+from scipy.sparse import bmat, csr_matrix, issparse
+from scipy.sparse import block_diag as sp_block_diag
 from scipy.sparse.linalg import lsmr as splsmr
 
 from ..helper.plotting import Anim
 from ..forcing import sineForce, toMDOF
-from .hbcommon import fft_coeff, ifft_coeff, hb_signal, hb_components
+from ..fft_backend import rfft
+from .hbcommon import (SparseLU, aft_jacobian, fft_coeff, hb_basis,
+                       hb_resize, ifft_coeff, hb_signal,
+                       hb_components)
+from .condensation import Condensation
 from .stability import Hills
 from .bifurcation import Fold, NS, BP
 
@@ -17,7 +23,8 @@ class HB():
                  NH=3, npow2=8, nu=1, scale_x=1, scale_t=1,
                  amp0=1e-3, tol_NR=1e-6, max_it_NR=15,
                  stability=True, rcm_permute=False, anim=True,
-                 xstr='Hz',sca=1/(2*np.pi)):
+                 xstr='Hz',sca=1/(2*np.pi), jac='aft', condense=False,
+                 sparse=False):
         """Because frequency(in rad/s) and amplitude have different orders of
         magnitude, time and displacement have to be rescaled to avoid
         ill-conditioning.
@@ -30,8 +37,22 @@ class HB():
               samples
         nu: accounts for subharmonics of excitation freq w0
         amp0: amplitude of first guess
+        jac: {'aft', 'lsmr'}. How Γ⁺ ∂f/∂x Γ is computed in hjac. 'aft'
+             transforms ∂f/∂x to the frequency domain by FFT, 'lsmr' solves
+             a least squares problem for each column of Γ.
+        condense: Newton iterate only on the Fourier coefficients of the
+             nonlinear DOFs. The linear DOFs are eliminated for each
+             harmonic, see :class:`.condensation.Condensation`, and the full
+             solution is recovered after convergence. Bifurcation detection
+             is not supported.
+        sparse: assemble A and h_z as sparse matrices and solve the Newton
+             corrections by sparse LU, reusing the ordering of the first
+             factorization. For large models; the stability computation is
+             still dense and bifurcation detection is not supported.
 
         """
+        if jac not in ('aft', 'lsmr'):
+            raise ValueError(f"Wrong jac {jac}. Should be 'aft' or 'lsmr'")
 
         self.NH = NH
         self.npow2 = npow2
@@ -43,12 +64,20 @@ class HB():
         self.tol_NR = tol_NR * scale_x
         self.max_it_NR = max_it_NR
         self.rcm_permute = rcm_permute
+        self.jac = jac
+        self.condense = condense
+        self.sparse = sparse
+        self.cond = None
         self.nt = 2**npow2
+        self._basis = None
 
         self.M = M0 * scale_x / scale_t**2
         self.C = C0 * scale_x / scale_t
         self.K = K0 * scale_x
         self.n = M0.shape[0]
+        if sparse:
+            self.M, self.C, self.K = (csr_matrix(X) for X in
+                                      (self.M, self.C, self.K))
 
         self.nonlin = nonlin
         self.anim = anim
@@ -116,19 +145,9 @@ class HB():
         # Assemble A, describing the linear dynamics. eq (20)
         A = self.assembleA(omega2)
 
-        # Form Q(t), eq (8). Q is orthogonal trigonometric basis(harmonic
-        # terms) Then use Q to from the kron product Q(t) ⊗ Iₙ, eq (6)
-        mat_func_form = np.empty((n*nt, nz))
-        Q = np.empty((NH*2+1,1))
-        for i in range(nt):
-            Q[0] = 1
-            for ii in range(1,NH+1):
-                Q[ii*2-1] = np.sin(omega * t[i]*ii)
-                Q[ii*2] = np.cos(omega * t[i]*ii)
-
-            # Stack the kron prod, so each block row is for time(i)
-            mat_func_form[i*n:(i+1)*n,:] = kron(Q.T, np.eye(n))
-        self.mat_func_form_sparse = csr_matrix(mat_func_form)
+        # Γ = Q(t) ⊗ Iₙ, eq (6), is only needed for jac='lsmr' and is formed
+        # on first use, see mat_func_form_sparse
+        self._basis = None
 
         if stability:
             hills = Hills(self)
@@ -139,22 +158,30 @@ class HB():
         amp = np.ones(n)*amp0
         x_guess = amp[:,None] * np.sin(omega * t)/scale_x
 
-        # Initial guess for z, z = Γ⁺x as given by eq (26). Γ is found as
-        # Q(t)⊗Iₙ, eq 6
-        # TODO use mat_func_form_sparse
-        z_guess, *_ = lstsq(mat_func_form, x_guess.ravel())
+        # Initial guess for z, z = Γ⁺x as given by eq (26). Γ is orthogonal,
+        # so Γ⁺x are the scaled Fourier coefficients of x
+        z_guess = fft_coeff(x_guess, NH)
 
         # Solve h(z,ω)=A(ω)-b(z)=0 (ie find z-root), eq. (21)
         print('Newton-Raphson iterative solution')
 
+        if self.condense:
+            self.cond = Condensation(self)
+            self.cond.factor(A, force)
+            z_guess = z_guess[self.cond.idx]
+
         Obj = 1
         it_NR = 1
         z = z_guess
+        lu = SparseLU()
         while (Obj > tol_NR) and (it_NR <= max_it_NR):
-            H = self.state_sys(z, A, force)
-            H_z = self.hjac(z, A)
+            H = self._state_sys(z, A, force)
+            H_z = self._hjac(z, A)
 
-            zsol, *_ = lstsq(H_z,H)
+            if issparse(H_z):
+                zsol = lu.factor(H_z).solve(H)
+            else:
+                zsol, *_ = lstsq(H_z,H)
             z = z - zsol
 
             Obj = norm(H) / norm(z)
@@ -167,6 +194,12 @@ class HB():
                              " Change Harmonic Balance parameters".
                              format(max_it_NR))
 
+        if self.condense:
+            # recover the linear DOFs
+            z = self.cond.expand(z)
+            if stability:
+                H_z = self.hjac(z, A)
+
         if stability:
             B = hills.stability(omega, H_z)
             B_tilde, stab = hills.reduc(B)
@@ -192,16 +225,40 @@ class HB():
                      opt_it_NR=3, it_cont_max=1e4, adaptive_stepsize=True,
                      angle_max_pred=90, dof=0,
                      detect={'fold':False,'NS':False,'BP':False},
-                     default_bp=True):
+                     default_bp=True, adapt=None):
         """ Do continuation of periodic solution.
 
         Based on tangent prediction and Moore-Penrose correction.
+
+        Parameters
+        ----------
+        adapt: dict, optional
+            Adapt the number of harmonics NH and time samples nt along the
+            branch, see :meth:`truncation_error`. After each point, NH is
+            increased if the energy of the two highest harmonics relative to
+            all harmonics is above `tol_harm`, and decreased if it would be
+            below `tol_harm`/10 with NH-1 harmonics. nt is doubled if the
+            relative energy of the nonlinear force above nt/4 is above
+            `tol_alias`, and halved if it would be below `tol_alias`/10 with
+            nt/2 samples. The change applies from the next point. Keys and
+            defaults:
+            {'NH_min': 3, 'NH_max': 20, 'npow2_min': 4, 'npow2_max': 12,
+             'tol_harm': 1e-4, 'tol_alias': 1e-6}
         """
+        if ((self.condense or self.sparse or adapt is not None) and
+            any(detect.values())):
+            raise ValueError('Bifurcation detection is not supported for the'
+                             ' condensed, sparse or adaptive HB')
+        if adapt is not None:
+            adapt = {'NH_min': 3, 'NH_max': 20, 'npow2_min': 4,
+                     'npow2_max': 12, 'tol_harm': 1e-4, 'tol_alias': 1e-6,
+                     **adapt}
         self.detect = detect
         self.cont_dir = cont_dir
         self.dof = dof
 
-        z = self.z_vec[-1]
+        # the last point could have been found with fewer harmonics
+        z = hb_resize(self.z_vec[-1], self.n, self.NH)
         omega = self.omega_vec[-1]
 
         scale_x = self.scale_x
@@ -266,7 +323,16 @@ class HB():
         omega2 = omega/nu
         # samme A som fra periodic calculation
         A = self.assembleA(omega2)
+        if self.condense:
+            # iterate on the coefficients of the nonlinear DOFs
+            t = self.assemblet(omega2)
+            u, _ = sineForce(f_amp, omega=omega, t=t)
+            self.cond.factor(A, toMDOF(u, n, fdofs))
+            z = z[self.cond.idx]
+            nz = self.cond.nz
 
+        # the ordering of the sparse LU is reused for all steps
+        lu = SparseLU()
         it_cont = 1
         z_cont = z.copy()
         omega_cont = omega
@@ -285,12 +351,18 @@ class HB():
 
             # Assemble A from eq. 31
             if it_cont == 1:
-                J_z = self.hjac(z, A)
-                J_w = self.hjac_omega(omega, z)
-                A_pred = np.vstack((
-                    np.hstack((J_z, J_w[:,None])),
-                    np.ones(nz+1)))
-                tangent = solve(A_pred, np.append(np.zeros(nz),1))
+                J_z = self._hjac(z, A)
+                J_w = self._hjac_omega(omega, z)
+                rhs = np.append(np.zeros(nz),1)
+                if issparse(J_z):
+                    A_pred = bmat([[J_z, J_w[:,None]],
+                                   [np.ones((1,nz)), np.ones((1,1))]])
+                    tangent = lu.factor(A_pred).solve(rhs)
+                else:
+                    A_pred = np.vstack((
+                        np.hstack((J_z, J_w[:,None])),
+                        np.ones(nz+1)))
+                    tangent = solve(A_pred, rhs)
                 tangent = tangent/norm(tangent)
             # With Moore-Penrose corrections, it is not needed to explicit
             # calculate the tangent again, since the corrections also correct
@@ -326,28 +398,35 @@ class HB():
             A = self.assembleA(omega2)
             u, _ = sineForce(f_amp, omega=omega, t=t)
             force = toMDOF(u, n, fdofs)
+            if self.condense:
+                self.cond.factor(A, force)
 
             it_NR = 1
             V = tangent
-            H = self.state_sys(z, A, force)
+            H = self._state_sys(z, A, force)
             Obj = norm(H) / norm(z)
 
             # More-penrose updating
             while (Obj > tol_NR) and (it_NR <= max_it_NR):
-                H = self.state_sys(z, A, force)
+                H = self._state_sys(z, A, force)
                 H = np.append(H,0)
-                J_z = self.hjac(z, A)
-                J_w = self.hjac_omega(omega, z)
-                Hx = np.vstack((
-                    np.hstack((J_z, J_w[:,None])),
-                    V))
-                R = np.append(np.hstack((J_z, J_w[:,None])) @ V, 0)
-
-                dNR = solve(Hx, H)
-                dV = solve(Hx,R)
-                #lu, piv = linalg.lu_factor(Hx)
-                #dNR = linalg.lu_solve((lu, piv), H)
-                #dV = linalg.lu_solve((lu, piv), R)
+                J_z = self._hjac(z, A)
+                J_w = self._hjac_omega(omega, z)
+                R = np.append(J_z @ V[:nz] + J_w * V[nz], 0)
+                # one factorization for both corrections
+                if issparse(J_z):
+                    Hx = bmat([[J_z, J_w[:,None]],
+                               [V[None,:nz], V[None,nz:]]])
+                    lu.factor(Hx)
+                    dNR = lu.solve(H)
+                    dV = lu.solve(R)
+                else:
+                    Hx = np.vstack((
+                        np.hstack((J_z, J_w[:,None])),
+                        V))
+                    lu_piv = lu_factor(Hx)
+                    dNR = lu_solve(lu_piv, H)
+                    dV = lu_solve(lu_piv, R)
 
                 dz = dNR[:nz]
                 domega = dNR[nz]
@@ -360,7 +439,9 @@ class HB():
                 force = toMDOF(u, n, fdofs)
 
                 A = self.assembleA(omega2)
-                H = self.state_sys(z, A, force)
+                if self.condense:
+                    self.cond.factor(A, force)
+                H = self._state_sys(z, A, force)
                 Obj = norm(H) / norm(z)
                 # print('It. {} - Convergence test: {:e} ({:e})'.format(it_NR, Obj, tol_NR))
                 it_NR += 1
@@ -375,9 +456,12 @@ class HB():
                 continue
             tangent = V
             point = np.append(z,omega)
+            # full coefficients
+            zf = self.cond.expand(z) if self.condense else z
+            stab = None
             if stability:
-                if it_NR == 1:
-                    J_z = self.hjac(z, A)
+                if it_NR == 1 or self.condense:
+                    J_z = self.hjac(zf, A)
                 B = self.hills.stability(omega, J_z)
                 B_tilde, stab = self.hills.reduc(B)
                 self.lamb_vec.append(B_tilde)
@@ -422,18 +506,37 @@ class HB():
             omega_cont = omega
             point_pprev = point_prev
             point_prev = point
-            c, phi, _ = hb_components(scale_x*z, n, NH)
+            c, phi, _ = hb_components(scale_x*zf, n, self.NH)
             x = hb_signal(omega, t, c, phi)
             xamp = np.max(x, axis=1)
             self.xamp_vec.append(xamp)
             self.omega_vec.append(omega)
             self.step_vec.append(step)
-            self.z_vec.append(z)
+            self.z_vec.append(zf)
 
             print(' NR: {}\tFreq: {:0.3g}{}. Amp: {:0.3e}. Step: {:0.2g}. Stable: {}'
                   .format(it_NR-1, omega/scale_t*self.sca, self.xstr,
                           xamp[dof], step, stab))
 
+            if adapt is not None:
+                NH_new, npow2_new = self._adapt_size(zf, adapt)
+                if (NH_new, npow2_new) != (self.NH, self.npow2):
+                    print('Harmonics: {} -> {}. Time samples: {} -> {}'.
+                          format(self.NH, NH_new, self.nt, 2**npow2_new))
+                    # transfer the coefficients and the tangent
+                    nd = len(self.cond.dofs) if self.condense else n
+                    def resize(v):
+                        return np.append(hb_resize(v[:nz], nd, NH_new),
+                                         v[nz:])
+                    z, z_cont = resize(z), resize(z_cont)
+                    tangent = resize(tangent)
+                    tangent = tangent / norm(tangent)
+                    point_prev = resize(point_prev)
+                    if np.ndim(point_pprev):
+                        point_pprev = resize(point_pprev)
+                    self.resize(NH_new, npow2_new)
+                    nz = self.cond.nz if self.condense else self.nz
+
             if adaptive_stepsize:
                 step = step * opt_it_NR/it_NR
                 step = min(step_max, step)
@@ -444,6 +547,95 @@ class HB():
                             y=np.asarray(self.xamp_vec).T[dof])
             it_cont += 1
 
+    def truncation_error(self, z):
+        """Truncation errors of the harmonic balance solution z
+
+        Returns
+        -------
+        eh: float
+            Energy of the two highest harmonics of x relative to the energy
+            of all harmonics (without DC). The energy of harmonic k is c_k²,
+            the squared amplitude given by hb_components.
+        eh2: float
+            As eh, for the harmonics NH-2 and NH-1, ie. the indicator with
+            NH-1 harmonics.
+        ea: float
+            Energy of the nonlinear force above nt/4 relative to all
+            harmonics of the force. The AFT samples the force with nt points;
+            energy near the Nyquist frequency is folded back onto the
+            retained harmonics (aliasing).
+        ea2: float
+            As ea, above nt/8, ie. the aliasing indicator for nt/2 samples.
+        """
+        n = self.n
+        nt = self.nt
+        NH = self.NH
+
+        # c_k² = a_k² + b_k², the sine and cosine coefficients
+        e = np.sum(z.reshape(2*NH+1, n)[1:]**2, axis=1)
+        e = e[0::2] + e[1::2]
+        etot = np.sum(e) if np.sum(e) > 0 else 1
+        eh = np.sum(e[-2:]) / etot
+        eh2 = np.sum(e[-3:-1]) / etot
+
+        x = ifft_coeff(z, n, nt, NH)
+        xd_dummy = 0
+        fnl = self.nonlin.force(x*self.scale_x, xd_dummy).reshape(n, nt)
+        F = np.sum(np.abs(rfft(fnl, axis=1)[:,1:])**2, axis=0)
+        etot = np.sum(F)
+        if etot == 0:
+            return eh, eh2, 0, 0
+        k = np.arange(1, nt//2+1)
+        ea = np.sum(F[k > nt/4]) / etot
+        ea2 = np.sum(F[k > nt/8]) / etot
+        return eh, eh2, ea, ea2
+
+    def _adapt_size(self, z, adapt):
+        """New NH and npow2 from the truncation errors at z"""
+        eh, eh2, ea, ea2 = self.truncation_error(z)
+        NH = self.NH
+        npow2 = self.npow2
+        if eh > adapt['tol_harm'] and NH < adapt['NH_max']:
+            NH += 1
+        elif eh2 < adapt['tol_harm']/10 and NH > adapt['NH_min']:
+            NH -= 1
+        if ea > adapt['tol_alias'] and npow2 < adapt['npow2_max']:
+            npow2 += 1
+        elif (ea2 < adapt['tol_alias']/10 and npow2 > adapt['npow2_min'] and
+              2**(npow2-1) > 4*NH):
+            npow2 -= 1
+        # the retained harmonics are in the lower quarter of the spectrum
+        while 2**npow2 <= 4*NH:
+            npow2 += 1
+        return NH, npow2
+
+    def resize(self, NH, npow2):
+        """Change the number of harmonics and time samples
+
+        The coefficients of a solution are transferred with
+        :func:`.hbcommon.hb_resize`.
+        """
+        self.NH = NH
+        self.npow2 = npow2
+        self.nt = 2**npow2
+        self.nz = self.n * (2 * NH + 1)
+        self._basis = None
+        if self.stability:
+            self.hills = Hills(self)
+        if self.condense:
+            self.cond = Condensation(self, self.cond.dofs)
+
+    @property
+    def mat_func_form_sparse(self):
+        """Trigonometric basis Γ = Q(t)⊗Iₙ, eq (6) and (8)
+
+        Only used by jac='lsmr'. Γ has n*nt*(2NH+1) non-zeros, so it is formed
+        on first use and kept until the harmonics are changed.
+        """
+        if self._basis is None:
+            self._basis = hb_basis(self.n, self.NH, self.nt, self.nu)
+        return self._basis
+
     def state_sys(self, z, A, force):
         """Calculate the system matrix h(z,ω) = A(ω)z - b(z), given by eq. (21).
 
@@ -492,28 +684,31 @@ class HB():
         NH = self.NH
         n = self.n
         scale_x = self.scale_x
-        mat_func_form_sparse = self.mat_func_form_sparse
 
         if len(self.nonlin.nls) == 0:
             return A
-        else:
-            x = ifft_coeff(z, n, nt, NH)
-            xd_dummy = 0
-            dFnl_dx_tot_mat = self.nonlin.dforce(x*scale_x, xd_dummy) * scale_x
-            # the derivative ∂b/∂z
-            bjac = np.empty((nz, nz))
-            full_rhs = dFnl_dx_tot_mat @ mat_func_form_sparse
-
-            # TODO: mat_func_form is not square. But some factorization would
-            # be nice
-            for j in range(nz):
-                rhs = np.squeeze(np.asarray(full_rhs[:,j].todense()))
-                sol = splsmr(mat_func_form_sparse, rhs)
-                x = - sol[0]
-                bjac[:,j] = x
-
-            hjac = A - bjac
-            return hjac
+
+        x = ifft_coeff(z, n, nt, NH)
+        xd_dummy = 0
+        dFnl_dx_tot_mat = self.nonlin.dforce(x*scale_x, xd_dummy) * scale_x
+        if self.jac == 'aft':
+            # Γ⁺ ∂f/∂x Γ from the FFT of each non-zero element of ∂f/∂x
+            return A + aft_jacobian(dFnl_dx_tot_mat, n, nt, NH,
+                                    sparse=self.sparse)
+
+        # the derivative ∂b/∂z
+        mat_func_form_sparse = self.mat_func_form_sparse
+        bjac = np.empty((nz, nz))
+        full_rhs = dFnl_dx_tot_mat @ mat_func_form_sparse
+        for j in range(nz):
+            rhs = np.squeeze(np.asarray(full_rhs[:,j].todense()))
+            sol = splsmr(mat_func_form_sparse, rhs)
+            bjac[:,j] = - sol[0]
+
+        hjac = A - bjac
+        if self.sparse:
+            return csr_matrix(hjac)
+        return hjac
 
     def hjac_omega(self, omega, z):
         """ Calculate the derivative of h wrt ω, h_ω.
@@ -523,17 +718,68 @@ class HB():
         """
         M = self.M
         C = self.C
-        K = self.K
         NH = self.NH
-        A = np.zeros(K.shape)
+        blks = [0*M]
         for i in range(1,NH+1):
-            blk = np.vstack((
-                np.hstack((-2*i**2 * omega * M, -i * C)),
-                np.hstack((i * C, -2*i**2 * omega * M))))
-            A = block_diag(A, blk)
+            blks.append([[-2*i**2 * omega * M, -i * C],
+                         [i * C, -2*i**2 * omega * M]])
+        A = self._block_diag(blks)
 
         return A @ z
 
+    def state_sys_cond(self, z):
+        """Reduced system h̃(z_N,ω) = S z_N - F̃ + fnl_N(z_N) of the
+        condensed HB, see :class:`.condensation.Condensation`.
+
+        The nonlinear forces only depend on the nonlinear DOFs, so the AFT is
+        done for these DOFs only.
+        """
+        cond = self.cond
+        n = self.n
+        nt = self.nt
+        NH = self.NH
+
+        x = np.zeros((n, nt))
+        x[cond.dofs] = ifft_coeff(z, len(cond.dofs), nt, NH)
+        xd_dummy = 0
+        fnl = self.nonlin.force(x*self.scale_x, xd_dummy).reshape(n, nt)
+        H = cond.S @ z - cond.Ft + fft_coeff(fnl[cond.dofs], NH)
+        return H
+
+    def hjac_cond(self, z):
+        """Jacobian of the condensed system wrt. the reduced coefficients,
+        h̃_z = S + Γ⁺ ∂f/∂x Γ, with only the nonlinear DOFs in Γ.
+        """
+        cond = self.cond
+        n = self.n
+        nt = self.nt
+        NH = self.NH
+        scale_x = self.scale_x
+
+        x = np.zeros((n, nt))
+        x[cond.dofs] = ifft_coeff(z, len(cond.dofs), nt, NH)
+        xd_dummy = 0
+        dFnl_dx_tot_mat = self.nonlin.dforce(x*scale_x, xd_dummy) * scale_x
+        return cond.S + aft_jacobian(dFnl_dx_tot_mat, n, nt, NH,
+                                     dofs=cond.dofs)
+
+    def _state_sys(self, z, A, force):
+        if self.condense:
+            return self.state_sys_cond(z)
+        return self.state_sys(z, A, force)
+
+    def _hjac(self, z, A):
+        if self.condense:
+            return self.hjac_cond(z)
+        return self.hjac(z, A)
+
+    def _hjac_omega(self, omega, z):
+        if self.condense:
+            # h_ω of the linear DOFs is condensed as the forces
+            return self.cond.reduce(self.hjac_omega(omega,
+                                                    self.cond.expand(z)))
+        return self.hjac_omega(omega, z)
+
     def assembleA(self, omega2):
         """Assemble A, describing the linear dynamics. eq (20)
         """
@@ -542,13 +788,20 @@ class HB():
         K = self.K
         NH = self.NH
 
-        A = K
+        blks = [K]
         for i in range(1,NH+1):
-            blk = np.vstack((
-                np.hstack((K - (i * omega2)**2 * M, -i * omega2 * C)),
-                np.hstack((i * omega2 * C, K - (i * omega2)**2 * M))))
-            A = block_diag(A, blk)
-        return A
+            Kd = K - (i * omega2)**2 * M
+            blks.append([[Kd, -i * omega2 * C],
+                         [i * omega2 * C, Kd]])
+        return self._block_diag(blks)
+
+    def _block_diag(self, blks):
+        """Block diagonal matrix of the DC block and the 2x2 harmonic
+        blocks. Sparse (CSR) if self.sparse"""
+        if self.sparse:
+            return sp_block_diag([blks[0]] + [bmat(b) for b in blks[1:]],
+                                 format='csr')
+        return block_diag(blks[0], *[np.block(b) for b in blks[1:]])
 
     def assemblet(self, omega2):
         npow2 = self.npow2
@@ -558,12 +811,13 @@ class HB():
         scale_x = self.scale_x
         scale_t = self.scale_t
         n = self.n
-        NH = self.NH
         nu = self.nu
 
         if omega is None:
             omega = self.omega_vec[-1]
             z = self.z_vec[-1]
+        # the number of harmonics can vary along an adaptive branch
+        NH = (len(z)//n - 1) // 2
 
         c, phi, cnorm = hb_components(scale_x*z, n, NH)
 
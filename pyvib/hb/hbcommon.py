@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from functools import lru_cache
+
 import numpy as np
-from scipy.fftpack import fft, ifft
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.linalg import splu
+
+from ..fft_backend import fft, irfft, rfft
 
 def hb_components(z, n, NH):
     """Get HB coefficient c's
@@ -47,13 +52,67 @@ def hb_signal(omega, t, c, phi):
 
     return x
 
+def hb_basis(n, NH, nt, nu=1):
+    """Trigonometric basis Γ = Q(t)⊗Iₙ as a CSR matrix, eq (6) and (8)
+
+    Row t*n + i is time sample t of DOF i. Column a*n + i is basis function a
+    of DOF i; a=0 is DC, a=2k-1 is sin(kωt) and a=2k is cos(kωt). The time
+    samples span one period of ω/nu, so ωt = 2π nu t/nt only depends on the
+    sizes.
+    """
+    K = 2*NH + 1
+    # outer product of time and harmonic index
+    phase = 2*np.pi*nu/nt * np.outer(np.arange(nt), np.arange(1, NH+1))
+    Q = np.empty((nt, K))
+    Q[:,0] = 1
+    Q[:,1::2] = np.sin(phase)
+    Q[:,2::2] = np.cos(phase)
+
+    # each row has one element per basis function
+    indices = np.arange(K)[None,None,:]*n + np.arange(n)[None,:,None]
+    indices = np.broadcast_to(indices, (nt, n, K))
+    data = np.broadcast_to(Q[:,None,:], (nt, n, K))
+    indptr = np.arange(0, nt*n*K + 1, K)
+    return csr_matrix((data.ravel(), indices.ravel(), indptr),
+                      shape=(nt*n, K*n))
+
+def hb_project(x, NH, nu=1):
+    """Least squares projection z = Γ⁺x onto the basis :func:`hb_basis`
+
+    The columns of Γ are orthogonal, ΓᵀΓ = diag(nt, nt/2, ..)⊗Iₙ, as long as
+    nu*NH < nt/2. Then Γ⁺ = (ΓᵀΓ)⁻¹Γᵀ is found without solving.
+
+    Parameters
+    ----------
+    x : ndarray(n, nt)
+        Time signal of each DOF
+    """
+    n, nt = x.shape
+    if nu*NH >= nt/2:
+        raise ValueError(f'The basis is aliased, nu*NH={nu*NH} >= nt/2. '
+                         'Increase nt')
+    z = hb_basis(n, NH, nt, nu).T @ x.T.ravel()
+    z[:n] /= nt
+    z[n:] *= 2/nt
+    return z
+
+def hb_resize(z, n, NH):
+    """Transfer the coefficients z to NH harmonics
+
+    Harmonics above NH are truncated and new harmonics are zero.
+    """
+    nz = n*(2*NH + 1)
+    if len(z) >= nz:
+        return z[:nz].copy()
+    return np.append(z, np.zeros(nz - len(z)))
+
 def fft_coeff(x, NH):
     """ Extract FFT-coefficients from X=fft(x)
     """
     # n: dofs
     n, nt = x.shape
-    # Format of X after transpose: (nt, n)
-    X = fft(x).T / nt
+    # Format of X after transpose: (nt//2+1, n)
+    X = rfft(x).T / nt
 
     re_fft_im_fft = np.hstack([-2*np.imag(X[1:NH+1]),
                                2* np.real(X[1:NH+1])])
@@ -68,13 +127,166 @@ def ifft_coeff(z, n, nt, NH):
     """ extract iFFT-coefficients from x=ifft(X)
     """
 
-    X = np.zeros((n, nt), dtype='complex')
+    # x = real(ifft(X)) where X only holds the positive frequencies. This is
+    # the inverse real FFT with the non-zero frequencies halved.
+    X = np.zeros((n, nt//2+1), dtype='complex')
     X[:,0] = nt*z[:n]
 
     for i in range(NH):
-        X[:,i+1] = 2 * (nt/2   * z[(n*(2*i+1)+n): (n*(2*i+1)+2*n)] - \
-                        nt/2*1j* z[(n*(2*i+1))  : (n*(2*i+1)+n)])
+        X[:,i+1] = nt/2   * z[(n*(2*i+1)+n): (n*(2*i+1)+2*n)] - \
+                   nt/2*1j* z[(n*(2*i+1))  : (n*(2*i+1)+n)]
 
-    x = np.real(ifft(X))
+    x = irfft(X, n=nt)
 
     return x
+
+@lru_cache(maxsize=16)
+def _aft_weights(NH):
+    """Weights of the products of the Fourier basis, see :func:`aft_jacobian`
+
+    Returns WC, WS of shape (2NH+1, 2NH+1, 4NH+1), such that
+    (Γ⁺ g Γ)(a,b) = Σ_m WC(a,b,m)*C(m) + WS(a,b,m)*S(m)
+    where C(m), S(m) are the cosine and sine coefficients of g at harmonic
+    m = -2NH..2NH.
+    """
+    K = 2*NH + 1
+    # harmonic of each basis function, and if it is a sine. DC is cos(0)
+    h = (np.arange(K) + 1) // 2
+    sin = np.arange(K) % 2 == 1
+    WC = np.zeros((K,K,4*NH+1))
+    WS = np.zeros((K,K,4*NH+1))
+    for a in range(K):
+        # Γ⁺ scales DC by 1/nt and the harmonics by 2/nt
+        r = 0.5 if a == 0 else 1
+        for b in range(K):
+            ha, hb = h[a], h[b]
+            # product-to-sum of the basis functions
+            if not sin[a] and not sin[b]:
+                WC[a,b,2*NH+ha-hb] += r
+                WC[a,b,2*NH+ha+hb] += r
+            elif not sin[a] and sin[b]:
+                WS[a,b,2*NH+hb+ha] += r
+                WS[a,b,2*NH+hb-ha] += r
+            elif sin[a] and not sin[b]:
+                WS[a,b,2*NH+ha+hb] += r
+                WS[a,b,2*NH+ha-hb] += r
+            else:
+                WC[a,b,2*NH+ha-hb] += r
+                WC[a,b,2*NH+ha+hb] -= r
+    return WC, WS
+
+def aft_jacobian(dfdx, n, nt, NH, dofs=None, sparse=False):
+    """Fourier coefficients of a time-varying linear map, Γ⁺ ∂f/∂x Γ
+
+    Γ = Q(t)⊗Iₙ is the orthogonal trigonometric basis, such that x = Γz, see
+    :func:`ifft_coeff`, and Γ⁺ is the projection :func:`fft_coeff`. Instead
+    of forming Γ, each non-zero element g(t) = ∂fᵢ/∂xⱼ(t) is transformed by
+    FFT and the products of the basis functions are expanded into its
+    harmonics, ie. O(nnz*nt*log(nt)) for nnz non-zero elements in ∂f/∂x.
+
+    Parameters
+    ----------
+    dfdx : sparse matrix (n*nt, n*nt)
+        Block diagonal with the (n,n) blocks ∂f/∂x(tₖ), as returned by
+        :meth:`pyvib.nlforce.NL_force.dforce`
+    n : int
+        Number of DOFs
+    nt : int
+        Number of time samples
+    NH : int
+        Number of harmonics
+    dofs : array_like, optional
+        Only return the coefficients of these DOFs, ie. jac is ordered as a
+        vector of Fourier coefficients of len(dofs) DOFs. Elements of ∂f/∂x
+        outside `dofs` are ignored.
+    sparse : bool, optional
+        Return jac as a CSR matrix
+
+    Returns
+    -------
+    jac : ndarray(nz, nz) or csr_matrix
+        with nz = n*(2NH+1), or len(dofs)*(2NH+1)
+    """
+    K = 2*NH + 1
+    dfdx = dfdx.tocoo()
+    t = dfdx.row // n
+    i, j = dfdx.row % n, dfdx.col % n
+    if dofs is not None:
+        pos = np.full(n, -1)
+        pos[dofs] = np.arange(len(dofs))
+        i, j = pos[i], pos[j]
+        mask = (i >= 0) & (j >= 0)
+        i, j, t, data = i[mask], j[mask], t[mask], dfdx.data[mask]
+        n = len(dofs)
+    else:
+        data = dfdx.data
+    if len(data) == 0:
+        return csr_matrix((n*K, n*K)) if sparse else np.zeros((n*K, n*K))
+    # time signal g(t) of each non-zero element (i,j)
+    ij, idx = np.unique(i*n + j, return_inverse=True)
+    g = np.zeros((len(ij), nt))
+    np.add.at(g, (idx, t), data)
+
+    m = np.arange(-2*NH, 2*NH+1)
+    if 2*NH <= nt//2:
+        G = rfft(g, axis=1)[:,np.abs(m)] / nt
+        G[:,m < 0] = G[:,m < 0].conj()
+    else:
+        G = fft(g, axis=1)[:,m % nt] / nt
+    WC, WS = _aft_weights(NH)
+    blk = np.einsum('pm,abm->pab', G.real, WC) - \
+        np.einsum('pm,abm->pab', G.imag, WS)
+
+    # z is ordered as z[a*n + i] for basis function a and DOF i
+    i, j = ij // n, ij % n
+    rows = np.arange(K)[None,:,None]*n + i[:,None,None]
+    cols = np.arange(K)[None,None,:]*n + j[:,None,None]
+    if sparse:
+        rows, cols = np.broadcast_arrays(rows, cols)
+        return csr_matrix((blk.ravel(), (rows.ravel(), cols.ravel())),
+                          shape=(n*K, n*K))
+    jac = np.zeros((n*K, n*K))
+    jac[rows, cols] = blk
+    return jac
+
+class SparseLU(object):
+    """Sparse LU factorization of matrices with a fixed sparsity pattern
+
+    The pattern of the HB Jacobian does not change along a branch, so the
+    fill-reducing column ordering (COLAMD) of the first factorization is
+    kept and applied symmetrically to the following matrices. Only the
+    ordering is reused; SuperLU still does the symbolic analysis in every
+    factorization.
+
+    The bordered continuation system has a dense row (the tangent). With
+    strict partial pivoting this row is often chosen as pivot, which fills
+    the factors. A small pivoting threshold keeps the diagonal pivots.
+
+    Parameters
+    ----------
+    diag_pivot_thresh : float, optional
+        Threshold for partial pivoting, see :func:`scipy.sparse.linalg.splu`.
+        0 is no pivoting, 1 is partial pivoting.
+    """
+
+    def __init__(self, diag_pivot_thresh=1e-3):
+        self.diag_pivot_thresh = diag_pivot_thresh
+        self.perm = None
+
+    def factor(self, A):
+        """Factorize the sparse matrix A. Returns self"""
+        A = csc_matrix(A)
+        if self.perm is None or len(self.perm) != A.shape[0]:
+            lu = splu(A, permc_spec='COLAMD',
+                      diag_pivot_thresh=self.diag_pivot_thresh)
+            # the same ordering applied symmetrically
+            self.iperm = lu.perm_c
+            self.perm = np.argsort(self.iperm)
+        A = csc_matrix(A[self.perm][:,self.perm])
+        self.lu = splu(A, permc_spec='NATURAL',
+                       diag_pivot_thresh=self.diag_pivot_thresh)
+        return self
+
+    def solve(self, b):
+        """Solve Ax = b with the last factorization"""
+        return self.lu.solve(b[self.perm])[self.iperm]
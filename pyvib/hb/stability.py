@@ -3,8 +3,18 @@
 
 import numpy as np
 from scipy.linalg import eigvals, inv, block_diag, eig
+from scipy.sparse import issparse
 from scipy.sparse.csgraph import reverse_cuthill_mckee
 
+def _dense(hb):
+    """Unscaled M, C, K. Hills matrix is dense, also for a sparse HB"""
+    scale_t = hb.scale_t
+    scale_x = hb.scale_x
+    M0, C0, K0 = (X.toarray() if issparse(X) else X
+                  for X in (hb.M, hb.C, hb.K))
+    return (M0 * scale_t**2 / scale_x, C0 * scale_t / scale_x,
+            K0 / scale_x)
+
 class Hills(object):
     """Estimate Floquet multipliers from Hills method.
 
@@ -37,9 +47,7 @@ class Hills(object):
         scale_t = hb.scale_t
         scale_x = hb.scale_x
         NH = hb.NH
-        M0 = hb.M * scale_t**2 / scale_x
-        C0 = hb.C * scale_t / scale_x
-        K0 = hb.K / scale_x
+        M0, C0, K0 = _dense(hb)
 
         Delta2 = M0
         M_inv = inv(M0)
@@ -76,9 +84,7 @@ class Hills(object):
         """
         scale_x = self.hb.scale_x
         scale_t = self.hb.scale_t
-        M0 = self.hb.M * scale_t**2 / scale_x
-        C0 = self.hb.C * scale_t / scale_x
-        K0 = self.hb.K / scale_x
+        M0, C0, K0 = _dense(self.hb)
 
         n = self.hb.n
         rcm_permute = self.hb.rcm_permute
@@ -98,6 +104,8 @@ class Hills(object):
             Delta1 = block_diag(Delta1, blk)
 
         # eq. 45
+        if issparse(J_z):
+            J_z = J_z.toarray()
         A0 = J_z/scale_x
         A1 = Delta1
         A2 = Delta2
@@ -176,8 +176,10 @@ def plot_subspace_info(infodict, fig=None, ax=None, *args, **kwargs):
 
     return fig, ax
 
-def plot_subspace_model(models, G, covG, norm_freq, fs, *args, **kwargs):
-    """Plot identified subspace models"""
+def plot_subspace_model(models, G, covG, norm_freq, fs, *args,
+                        method='solve', **kwargs):
+    """Plot identified subspace models. `method` evaluates the FRF, see
+    :func:`~pyvib.lti_conversion.ss2frf`"""
     dictget = lambda d, *k: [d[i] for i in k]
     F, m, p = G.shape
 
@@ -196,7 +198,7 @@ def plot_subspace_model(models, G, covG, norm_freq, fs, *args, **kwargs):
     for k, model in models.items():
         fig, ax = plt.subplots(nrows=1, ncols=1)
         A, B, C, D = dictget(model, 'A', 'B', 'C', 'D')
-        Gss = ss2frf(A,B,C,D,norm_freq)
+        Gss = ss2frf(A,B,C,D,norm_freq,method=method)
 
         lsopt = {'ls':'none', 'marker':'.', 'mfc':'none'}
         figopt = {'fig':fig, 'ax':ax}
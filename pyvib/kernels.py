@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+"""
+Kernels for the time-step loops of the nonlinear state-space models.
+
+The loops are written in plain python on numpy arrays without any allocations,
+such that they can be compiled with numba. Numba is an optional dependency; if
+it is not installed, ``HAS_NUMBA`` is False and the callers fall back to their
+vectorized numpy implementation.
+
+All kernels work on the work vector of a
+:class:`pyvib.polynomial.MonomialPlan`, ie. ``work = [x, u, 1, monomials]``.
+"""
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _jit(func):
+    """Compile `func` with numba if available"""
+    if HAS_NUMBA:
+        return njit(cache=True, nogil=True)(func)
+    return func
+
+
+def check_engine(engine):
+    """Resolve the simulation engine
+
+    Parameters
+    ----------
+    engine : str {'auto', 'numba', 'numpy', 'loop'}
+        'auto' selects numba if it is installed, otherwise numpy.
+
+    """
+    engines = ('auto', 'numba', 'numpy', 'loop')
+    if engine not in engines:
+        raise ValueError(f'Wrong engine {engine}. Should be one of {engines}')
+    if engine == 'auto':
+        engine = 'numba' if HAS_NUMBA else 'numpy'
+    if engine == 'numba' and not HAS_NUMBA:
+        raise ImportError('numba is not installed. Use engine="numpy"')
+    return engine
+
+
+@_jit
+def _monomials(work, nvar, parent, var):
+    """Fill the monomials in the work vector, see MonomialPlan.evaluate"""
+    work[nvar] = 1.0
+    for k in range(parent.shape[0]):
+        work[nvar+1+k] = work[parent[k]] * work[var[k]]
+
+
+@_jit
+def pnlss_sim(M, parent, var, n, u, xout, yout, work):
+    """Simulate a PNLSS model given the combined system matrix M
+
+    [x(t+1); y(t)] = M @ [x(t), u(t), 1, ζη(x(t),u(t))]
+
+    xout[0] must contain the initial state. xout and yout are filled in place.
+    """
+    ns, m = u.shape
+    nout, nwork = M.shape
+    nvar = n + m
+    for i in range(ns):
+        for j in range(n):
+            work[j] = xout[i,j]
+        for j in range(m):
+            work[n+j] = u[i,j]
+        _monomials(work, nvar, parent, var)
+        for r in range(nout):
+            # no state update after the last sample
+            if r < n and i == ns-1:
+                continue
+            acc = 0.0
+            for c in range(nwork):
+                acc += M[r,c] * work[c]
+            if r < n:
+                xout[i+1,r] = acc
+            else:
+                yout[i,r-n] = acc
+
+
+@_jit
+def pnlss_jac(A_Edwdx, C_Fdwdx, samples, rows, cols, out, J, Jnext):
+    """Propagate the sensitivities of all active parameters together
+
+    J(t+1) = (A + E*∂ζ∂x)(t) J(t) + S(t)
+    out(t) = (C + F*∂η∂x)(t) J(t)
+
+    where S(t) has the element samples[t,cols[k]] at (rows[k], k), see
+    :func:`pyvib.pnlss.element_jacobian`.
+
+    A_Edwdx : ndarray(NT,n,n)
+    C_Fdwdx : ndarray(NT,p,n)
+    out : ndarray(p,NT,nactive). Filled in place.
+    J, Jnext : ndarray(n,nactive). Work arrays.
+    """
+    NT, p, n = C_Fdwdx.shape
+    nactive = rows.shape[0]
+    J[:] = 0.0
+    for k in range(nactive):
+        for c in range(p):
+            out[c,0,k] = 0.0
+    for t in range(1, NT):
+        for a in range(n):
+            for k in range(nactive):
+                Jnext[a,k] = 0.0
+            for b in range(n):
+                Aab = A_Edwdx[t-1,a,b]
+                if Aab != 0.0:
+                    for k in range(nactive):
+                        Jnext[a,k] += Aab * J[b,k]
+        for k in range(nactive):
+            Jnext[rows[k],k] += samples[t-1,cols[k]]
+        for c in range(p):
+            for k in range(nactive):
+                out[c,t,k] = 0.0
+            for b in range(n):
+                Ccb = C_Fdwdx[t,c,b]
+                if Ccb != 0.0:
+                    for k in range(nactive):
+                        out[c,t,k] += Ccb * Jnext[b,k]
+        J, Jnext = Jnext, J
+
+
+@_jit
+def lti_tangent(A_t, C_t, d, out):
+    """Filter `d` through the time-varying linear model
+
+    δx(t+1) = A(t) δx(t) + d(t),  δx(0) = 0
+    out(t) = C(t) δx(t)
+
+    This is the Jacobian-vector product of the model output, when `d` is the
+    perturbation of the state equation, see :func:`pyvib.pnlss.jacobian_operator`.
+
+    A_t : ndarray(NT,n,n)
+    C_t : ndarray(NT,p,n)
+    d : ndarray(NT,n)
+    out : ndarray(NT,p). Filled in place.
+    """
+    NT, p, n = C_t.shape
+    x = np.zeros(n)
+    xnext = np.zeros(n)
+    for t in range(NT):
+        for c in range(p):
+            acc = 0.0
+            for b in range(n):
+                acc += C_t[t,c,b] * x[b]
+            out[t,c] = acc
+        for a in range(n):
+            acc = d[t,a]
+            for b in range(n):
+                acc += A_t[t,a,b] * x[b]
+            xnext[a] = acc
+        for a in range(n):
+            x[a] = xnext[a]
+
+
+@_jit
+def lti_adjoint(A_t, C_t, g, out):
+    """Adjoint of :func:`lti_tangent`, ie. filter `g` backwards in time
+
+    λ(t) = A(t+1)ᵀ λ(t+1) + C(t+1)ᵀ g(t+1),  λ(NT-1) = 0
+
+    out(t) = λ(t) is the gradient of ``Σ g(t)ᵀ out(t)`` wrt. d(t).
+
+    g : ndarray(NT,p)
+    out : ndarray(NT,n). Filled in place.
+    """
+    NT, p, n = C_t.shape
+    lam = np.zeros(n)
+    lamnext = np.zeros(n)
+    for t in range(NT-1, -1, -1):
+        for a in range(n):
+            out[t,a] = lam[a]
+        for b in range(n):
+            acc = 0.0
+            for a in range(n):
+                acc += A_t[t,a,b] * lam[a]
+            for c in range(p):
+                acc += C_t[t,c,b] * g[t,c]
+            lamnext[b] = acc
+        for b in range(n):
+            lam[b] = lamnext[b]
+
+
+def tangent(A_t, C_t, d, engine='auto'):
+    """Filter `d` through the linearized model, see :func:`lti_tangent`
+
+    A_t : ndarray(NT,n,n)
+    C_t : ndarray(NT,p,n)
+    d : ndarray(NT,n)
+
+    Returns
+    -------
+    out : ndarray(NT,p)
+    """
+    NT, p, n = C_t.shape
+    out = np.empty((NT,p))
+    if check_engine(engine) == 'numba':
+        lti_tangent(A_t, C_t, d, out)
+        return out
+
+    x = np.zeros(n)
+    for t in range(NT):
+        out[t] = C_t[t] @ x
+        x = A_t[t] @ x + d[t]
+    return out
+
+def adjoint(A_t, C_t, g, engine='auto'):
+    """Filter `g` backwards through the adjoint of the linearized model, see
+    :func:`lti_adjoint`
+
+    Returns
+    -------
+    out : ndarray(NT,n)
+    """
+    NT, p, n = C_t.shape
+    out = np.empty((NT,n))
+    if check_engine(engine) == 'numba':
+        lti_adjoint(A_t, C_t, g, out)
+        return out
+
+    lam = np.zeros(n)
+    for t in range(NT-1, -1, -1):
+        out[t] = lam
+        lam = lam @ A_t[t] + g[t] @ C_t[t]
+    return out
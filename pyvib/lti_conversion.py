@@ -3,7 +3,7 @@
 
 import numpy as np
 from numpy.linalg import solve
-from scipy.linalg import eigvals, logm, norm
+from scipy.linalg import eig, eigvals, hessenberg, inv, logm, norm
 
 
 def is_stable(A, domain='z'):
@@ -50,7 +50,7 @@ def ss2phys(A, B, C, D=None):
     B = T @ B
     return A, B, C, T
 
-def ss2frf(A, B, C, D, freq):
+def ss2frf(A, B, C, D, freq, method='solve'):
     """Compute frequency response function from state-space parameters
     (discrete-time)
 
@@ -58,6 +58,20 @@ def ss2frf(A, B, C, D, freq):
     normalized frequencies `freq` from the state-space matrices `A`, `B`, `C`,
     and `D`. ```̂G(f) = C*inv(exp(2j*pi*f)*I - A)*B + D```
 
+    Parameters
+    ----------
+    A, B, C, D : ndarray
+        state-space matrices
+    freq : ndarray(F)
+        normalized frequencies
+    method : str {'auto', 'eig', 'hess', 'solve'}, optional
+        'eig' diagonalizes A once, ``A = V*Λ*V⁻¹``, and evaluates each
+        frequency in O(n). 'hess' reduces A once to upper Hessenberg form and
+        solves each frequency in O(n²). 'solve' solves the full (n,n) system
+        for each frequency in O(n³) and is the default. 'auto' uses 'eig' if
+        the eigenvectors are well conditioned, see :func:`eig_resolvent`,
+        otherwise 'hess'.
+
     Returns
     -------
     Gss : ndarray(F,p,m)
@@ -65,12 +79,93 @@ def ss2frf(A, B, C, D, freq):
 
     """
     # Z-transform variable
-    z = np.exp(2j*np.pi*freq)
-    In = np.eye(*A.shape)
-    # Use broadcasting. Much faster than for loop.
-    Gss = C @ solve((z*In[...,None] - A[...,None]).transpose((2,0,1)), B[None]) + D
+    z = np.exp(2j*np.pi*np.atleast_1d(freq))
+    if method in ('auto', 'eig'):
+        eigA = eig_resolvent(A)
+        if eigA is None and method == 'eig':
+            raise ValueError('A is defective. Use another method')
+        if eigA is not None:
+            lam, V, Vinv = eigA
+            d = 1/(z[:,None] - lam)  # (F,n)
+            Gss = np.einsum('ik,fk,kj->fij', C @ V, d, Vinv @ B) + D
+            return Gss
+        method = 'hess'
+
+    if method == 'hess':
+        H, Q = hessenberg(A, calc_q=True)
+        Gss = (C @ Q) @ hess_solve(H, z, Q.T @ B) + D
+    elif method == 'solve':
+        In = np.eye(*A.shape)
+        # Use broadcasting. Much faster than for loop.
+        Gss = C @ solve((z*In[...,None] - A[...,None]).transpose((2,0,1)),
+                        B[None]) + D
+    else:
+        raise ValueError(f'Wrong method {method}')
     return Gss
 
+def eig_resolvent(A, maxcond=1e4):
+    """Eigendecomposition of `A` used for evaluating the resolvent
+
+    ``(z*I - A)⁻¹ = V*diag(1/(z - λ))*V⁻¹``
+
+    The relative error of the resolvent is about ``cond(V)*eps``, so the
+    decomposition is only used when V is well conditioned.
+
+    Returns
+    -------
+    lam, V, Vinv : ndarray
+        eigenvalues, eigenvectors and the inverse of the eigenvectors. None is
+        returned if A is (close to) defective, ie. the condition number of V
+        is larger than `maxcond`.
+    """
+    lam, V = eig(A)
+    if not np.all(np.isfinite(lam)) or np.linalg.cond(V) > maxcond:
+        return None
+    return lam, V, inv(V)
+
+def hess_solve(H, z, X, chunk=4096):
+    """Solve ``(z(f)*I - H)*Y(f) = X`` for upper Hessenberg `H`
+
+    Gaussian elimination with pivoting between adjacent rows, vectorized over
+    frequencies. Each frequency costs O(n²) instead of the O(n³) of a full
+    solve. The frequencies are processed in chunks of `chunk` to limit memory.
+
+    Parameters
+    ----------
+    H : ndarray(n,n)
+        upper Hessenberg matrix
+    z : ndarray(F)
+    X : ndarray(n,m)
+
+    Returns
+    -------
+    Y : ndarray(F,n,m)
+    """
+    F, n = len(z), H.shape[0]
+    Y = np.empty((F,n,X.shape[1]), dtype=complex)
+    for i in range(0, F, chunk):
+        zc = z[i:i+chunk]
+        M = np.empty((len(zc),n,n), dtype=complex)
+        M[:] = -H
+        M[:,range(n),range(n)] += zc[:,None]
+        Yc = np.empty((len(zc),n,X.shape[1]), dtype=complex)
+        Yc[:] = X
+        # forward elimination of the subdiagonal
+        for k in range(n-1):
+            swap = np.abs(M[:,k+1,k]) > np.abs(M[:,k,k])
+            if np.any(swap):
+                M[swap,k:k+2] = M[swap,k:k+2][:,::-1]
+                Yc[swap,k:k+2] = Yc[swap,k:k+2][:,::-1]
+            l = M[:,k+1,k]/M[:,k,k]
+            M[:,k+1,k:] -= l[:,None]*M[:,k,k:]
+            Yc[:,k+1] -= l[:,None]*Yc[:,k]
+        # back substitution
+        for k in range(n-1,-1,-1):
+            Yc[:,k] -= np.einsum('fj,fjm->fm', M[:,k,k+1:], Yc[:,k+1:])
+            Yc[:,k] /= M[:,k,k,None]
+        Y[i:i+chunk] = Yc
+    return Y
+
 def discrete2cont(ad, bd, cd, dd, dt, method='zoh', alpha=None):
     """Convert linear system from discrete to continuous time-domain.
 
@@ -4,8 +4,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-from scipy.fftpack import fft, ifft
 from .common import next_pow2, db
+from .fft_backend import fft, ifft, rfft
 
 class WT():
     def __init__(self, signal):
@@ -65,49 +65,251 @@ def morletWT(x, fs, f1, f2, nf, f00, pad=0):
         Instantaneous frequency, ie. y-axis
     y: ndarray [nf, len(x)]
         FFT Amplitudes. Stored as [Freq, time]. Ie most likely to be used as y.T
+
+    Notes
+    -----
+    The filters are evaluated at the frequencies of the FFT bins, ``k*fs/N``.
+    Earlier versions used ``linspace(0, fs/2, N//2)``, which scales the
+    frequency axis by N/(N-2), such that the filters were centered below
+    ``f00/a``. For short records this moves the ridge by up to one frequency
+    step and changes its amplitude by a few percent.
     """
     x = np.squeeze(x)
+    finst, wtinst, time, freq, y = morletWT_batch(x[None], fs, f1, f2, nf,
+                                                  f00, pad)
+    return finst[0], wtinst[0], time, freq, y[0]
+
+def morletWT_batch(x, fs, f1, f2, nf, f00, pad=0, ridge=False, workers=None,
+                   maxsize=2**22):
+    """Morlet wavelet transform of several channels
+
+    The inverse FFTs are done as batched calls over channels and frequency
+    steps. Each call holds at most `maxsize` complex numbers, so the memory
+    needed for temporaries is bounded.
+
+    Parameters
+    ----------
+    x: ndarray(nc, NX)
+        Signals of nc channels
+    fs, f1, f2, nf, f00, pad
+        See :func:`morletWT`
+    ridge: bool, optional
+        Only return the ridge, `finst` and `wtinst`. The scalogram is not
+        stored.
+    workers: int, optional
+        Number of threads for the FFTs, see :mod:`pyvib.fft_backend`
+    maxsize: int, optional
+        Maximum size of one batched inverse FFT
+
+    Returns
+    -------
+    finst: ndarray(nc, NX)
+        Instantaneous frequency, ie. the ridge
+    wtinst: ndarray(nc, NX)
+        Amplitude at the ridge
+    time: ndarray(NX)
+    freq: ndarray(nf)
+    y: ndarray(nc, NX, nf)
+        Scalogram. Not returned if `ridge` is True.
+    """
+    x = np.atleast_2d(x)
+    nc, NX = x.shape
 
     dt = 1/fs
     df = (f2 - f1) / nf
     freq = np.linspace(f1, f2, nf)
 
-    a = f00 / (f1 + np.outer(np.arange(nf),df))
-    na = len(a) - 1
+    a = f00 / (f1 + np.arange(nf)*df)
 
     k = 2**pad
-    NX = len(x)
     NX2 = next_pow2(NX)
     N = 2**NX2
     N = k*N
 
-    time = np.arange(N)*dt
-    f = np.linspace(0, fs/2, N//2)
+    time = np.arange(NX)*dt
+    # frequencies of the FFT bins
+    f = np.arange(N//2)*fs/N
     omega = f*2*np.pi
 
-    filt = np.sqrt(2*a @ np.ones((1,N//2))) * \
-        np.exp(-0.5*(a @ omega[None,:] - 2*np.pi*f00)**2)
+    filt = np.sqrt(2*a[:,None]) * \
+        np.exp(-0.5*(a[:,None]*omega - 2*np.pi*f00)**2)
     filt[np.isnan(filt)] = 0
+    filt = np.conj(filt)
+
+    # channels and frequency steps per batch
+    nfb = min(nf, max(1, maxsize // N))
+    ncb = max(1, maxsize // (nfb*N))
+
+    wtinst = np.full((nc, NX), -np.inf)
+    imax = np.zeros((nc, NX), dtype=int)
+    if not ridge:
+        y = np.empty((nc, NX, nf), dtype=complex)
+    for i in range(0, nc, ncb):
+        X = rfft(x[i:i+ncb], N, axis=1, workers=workers)[:,None,:N//2]
+        for j in range(0, nf, nfb):
+            yb = ifft(filt[j:j+nfb] * X, N, axis=2, workers=workers)
+            yb = yb[...,:NX]  # (ncb, nfb, NX)
+            mod = np.abs(yb)
+            jmax = np.argmax(mod, axis=1)
+            mmax = np.take_along_axis(mod, jmax[:,None], axis=1)[:,0]
+            # first maximum, as argmax over all frequency steps
+            new = mmax > wtinst[i:i+ncb]
+            wtinst[i:i+ncb][new] = mmax[new]
+            imax[i:i+ncb][new] = j + jmax[new]
+            if not ridge:
+                y[i:i+ncb,:,j:j+nfb] = yb.transpose((0,2,1))
+
+    finst = f00 / a[imax]
+    if ridge:
+        return finst, wtinst
+    return finst, wtinst, time, freq, y
 
-    X = fft(x, N, axis=0)
-    X = np.conj(filt) * (np.ones((na+1,1)) @ X[None,:N//2])
-    y = np.zeros((na+1,N), dtype=complex)
-    for j in range(na+1):
-        y[j] = ifft(X[j], N)
 
-    y = y.T
-    mod = np.abs(y)
+class StreamingWT():
+    """Streaming Morlet wavelet ridge by overlap-save
 
-    imax = np.argmax(mod, axis=1)
-    wtinst = np.max(mod, axis=1)
-    finst = f00 / a[imax].squeeze()
-    finst = finst[:NX]
-    wtinst = wtinst[:NX]
-    y = y[:NX]
-    time = time[:NX]
+    Blocks of samples are added with :meth:`update`, which returns the
+    instantaneous frequency and amplitude of the samples that are finished.
+    The wavelets are truncated in time at `nsigma` standard deviations of
+    their envelope, ie. L samples to each side. A sample is finished when L
+    samples after it are received, and then at the latest after one more FFT
+    block. Memory is bounded by the FFT block and the filter bank.
 
-    return finst, wtinst, time, freq, y
+    The filters are evaluated on the FFT bins as in :func:`morletWT`, thus
+    away from the start and the end of the record, the result equals the
+    batch transform up to the truncation of the wavelets, which is below
+    rounding errors for `nsigma` larger than about 8.
+
+    Parameters
+    ----------
+    fs, f1, f2, nf, f00
+        See :func:`morletWT`
+    block : int, optional
+        FFT block size. Rounded up to a power of two of at least twice the
+        wavelet length. Larger blocks are faster, but increase the latency.
+    nsigma : float, optional
+        Truncation of the wavelets in standard deviations of their envelope.
+        The default 8 makes the truncation error negligible.
+    workers : int, optional
+        Number of threads for the FFTs, see :mod:`pyvib.fft_backend`
+
+    Examples
+    --------
+    >>> wt = StreamingWT(fs, f1, f2, nf, f00)
+    >>> for x in blocks:  # x: ndarray(nc, n) or ndarray(n)
+    ...     finst, wtinst = wt.update(x)
+    >>> finst, wtinst = wt.flush()
+    """
+
+    def __init__(self, fs, f1, f2, nf, f00, block=None, nsigma=8,
+                 workers=None):
+        self.fs = fs
+        self.workers = workers
+        df = (f2 - f1) / nf
+        self.freq = np.linspace(f1, f2, nf)
+        self.a = f00 / (f1 + np.arange(nf)*df)
+        self.f00 = f00
 
+        # half length of the wavelets. The envelope has std. a seconds
+        L = int(np.ceil(nsigma*self.a.max()*fs))
+        K = 2*L + 1
+        if block is None:
+            block = 4*K
+        N = 2**next_pow2(max(block, 2*K))
+        self.L, self.K, self.N = L, K, N
+        # new samples per block
+        self.S = N - K + 1
+
+        # Wavelets as in morletWT, sampled on the FFT bins of a block long
+        # enough to hold the truncated wavelets without aliasing.
+        Nk = 2**next_pow2(2*K)
+        omega = np.arange(Nk//2)*fs/Nk*2*np.pi
+        filt = np.sqrt(2*self.a[:,None]) * \
+            np.exp(-0.5*(self.a[:,None]*omega - 2*np.pi*f00)**2)
+        h = ifft(np.conj(filt), Nk, axis=1)
+        # centered on index L, ie. the output is delayed by L samples
+        h = np.roll(h, L, axis=1)[:,:K]
+        self.H = fft(h, N, axis=1)[:,:N//2]
+        self.reset()
+
+    def reset(self):
+        """Start a new record"""
+        self._buf = None
+        # number of samples received and returned
+        self.nin = 0
+        self.nout = 0
+
+    def _process(self, buf):
+        """Ridge of the S finished samples of the (nc, N) block"""
+        X = rfft(buf, axis=1, workers=self.workers)[:,None,:self.N//2]
+        y = ifft(self.H * X, self.N, axis=2, workers=self.workers)
+        mod = np.abs(y[...,self.K-1:])  # (nc, nf, S)
+        imax = np.argmax(mod, axis=1)
+        wtinst = np.take_along_axis(mod, imax[:,None], axis=1)[:,0]
+        return self.f00 / self.a[imax], wtinst
+
+    def update(self, x):
+        """Add samples
+
+        Parameters
+        ----------
+        x : ndarray(nc, n) or ndarray(n)
+            New samples of nc channels
+
+        Returns
+        -------
+        finst, wtinst : ndarray(nc, k) or ndarray(k)
+            Ridge of the k samples finished by this block. k may be zero.
+        """
+        self._squeeze = np.ndim(x) == 1
+        x = np.atleast_2d(x)
+        if self._buf is None:
+            # zeros before the start of the record, as in the batch transform
+            self._buf = np.zeros((x.shape[0], self.L))
+        self._buf = np.hstack((self._buf, x))
+        self.nin += x.shape[1]
+
+        finst, wtinst = [], []
+        while self._buf.shape[1] >= self.N:
+            res = self._process(self._buf[:,:self.N])
+            finst.append(res[0])
+            wtinst.append(res[1])
+            self._buf = self._buf[:,self.S:]
+        nc = x.shape[0]
+        finst = np.hstack(finst) if finst else np.empty((nc, 0))
+        wtinst = np.hstack(wtinst) if wtinst else np.empty((nc, 0))
+        self.nout += finst.shape[1]
+        return self._output(finst, wtinst)
+
+    def _output(self, finst, wtinst):
+        if self._squeeze:
+            return finst[0], wtinst[0]
+        return finst, wtinst
+
+    def flush(self):
+        """Finish the remaining samples, assuming zeros after the record, and
+        start a new record.
+
+        Returns
+        -------
+        finst, wtinst
+            See :meth:`update`
+        """
+        if self._buf is None:
+            return np.empty(0), np.empty(0)
+        nc = self._buf.shape[0]
+        nin, nout = self.nin, self.nout
+        squeeze = self._squeeze
+        finst, wtinst = [np.empty((nc, 0))], [np.empty((nc, 0))]
+        while self.nout < nin:
+            res = self.update(np.zeros((nc, self.S)))
+            finst.append(res[0])
+            wtinst.append(res[1])
+        finst = np.hstack(finst)[:,:nin-nout]
+        wtinst = np.hstack(wtinst)[:,:nin-nout]
+        self._squeeze = squeeze
+        self.reset()
+        return self._output(finst, wtinst)
 
 def waveletPlot(finst, wtinst, time, freq, y, fss=None, sca=1, **kwargs):
 
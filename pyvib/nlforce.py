@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from copy import copy
+
 import numpy as np
 from scipy.sparse import coo_matrix
 from .interpolate import spline, piecewise_linear, piecewise_linear_der
@@ -36,9 +38,9 @@ class NL_force(object):
                 if i1 != -1:
                     nldofs.append(i1)
                 if i2 != -1:
-                    nldofs.append(i1)
-        # Get unique elements (could also be np.unique(np.asarray(nldofs)))
-        nldofs = np.asarray(list(set(nldofs)))
+                    nldofs.append(i2)
+        # sorted unique elements
+        nldofs = np.unique(np.asarray(nldofs, dtype=int))
         return nldofs
 
 
@@ -66,41 +68,38 @@ class NL_force(object):
         else:
             ndof, ns = x.shape
 
-        dfnl = np.zeros((ndof+1, ns*(ndof+1)))
-
-        if is_force:
-            for nl in self.dnls_force:
-                dfnl = nl.dcompute(x, xd, dfnl)
-        else:
-            for nl in self.dnls_damp:
-                dfnl = nl.dcompute(x, xd, dfnl)
-
         if ns == 1:
+            dfnl = np.zeros((ndof+1, ndof+1))
+            if is_force:
+                for nl in self.dnls_force:
+                    dfnl = nl.dcompute(x, xd, dfnl)
+            else:
+                for nl in self.dnls_damp:
+                    dfnl = nl.dcompute(x, xd, dfnl)
             return dfnl[:ndof,:ndof].squeeze()
 
-        # create sparse structure from dfnl
-        # TODO: dont create dfnl in the first place...:)
-        ind = np.arange(ns*(ndof+1))
-        ind = np.delete(ind, np.s_[ndof::ndof+1])
-        dfnl = dfnl[:ndof, ind]
-        dfnl = np.reshape(dfnl, (ndof**2,ns), order='F')
-        # dont ask...
-        ind = np.outer(np.ones(ndof), np.arange(ndof)) * ns*ndof + \
-            np.outer(np.arange(ndof), np.ones(ndof))
-        ind = np.outer(ind.T, np.ones(ns)) + \
-            ns*ndof * np.outer(np.ones(ndof**2), np.arange(0,(ns-1)*ndof+1, ndof)) + \
-            ndof * np.outer(np.ones(ndof**2), np.arange(ns))
-
-        ind = ind.ravel(order='F').astype('int')
-
-        #https://stackoverflow.com/questions/28995146/matlab-ind2sub-equivalent-in-python
-        arr = ns*ndof*np.array([1,1])
-        ii, jj = np.unravel_index(ind, tuple(arr), order='F')
-        dfnl_s = coo_matrix((dfnl.ravel(order='F'), (ii, jj)),
+        # the sparse structure is created from the derivatives of the
+        # nonlinear dofs only. The nonlinearities are evaluated on these dofs
+        # by renumbering their connections
+        dofs = self.nldofs()
+        m = len(dofs)
+        dfnl = np.zeros((m+1, ns*(m+1)))
+        nls = self.dnls_force if is_force else self.dnls_damp
+        xd = xd[dofs] if np.ndim(xd) else xd
+        for nl in nls:
+            nl = copy(nl)
+            nl.inl = np.where(nl.inl == -1, -1,
+                              np.searchsorted(dofs, nl.inl))
+            dfnl = nl.dcompute(x[dofs], xd, dfnl)
+
+        # dfnl[i, t*(m+1) + j] is ∂fᵢ/∂xⱼ at time t. The last row/column
+        # is ground.
+        dfnl = dfnl[:m].reshape(m, ns, m+1)[:,:,:m]
+        i, t, j = np.meshgrid(dofs, np.arange(ns), dofs, indexing='ij')
+        dfnl_s = coo_matrix((dfnl.ravel(), ((t*ndof + i).ravel(),
+                                            (t*ndof + j).ravel())),
                             shape=(ndof*ns, ndof*ns)).tocsr()
-
         return dfnl_s
-        # return dfnl
 
     def energy(self, x, xd):
         if x.ndim == 1:
@@ -2,13 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.fft import fft
 from scipy.interpolate import interp1d
+from scipy.sparse.linalg import LinearOperator
 from scipy.special import comb
 
 from .common import mmul_weight
-from .polynomial import multEdwdx, nl_terms, poly_deriv
-from .statespace import NonlinearStateSpace, StateSpaceIdent
+from .fft_backend import rfft
+from .kernels import adjoint, check_engine, pnlss_jac, pnlss_sim, tangent
+from .polynomial import MonomialPlan, multEdwdx, nl_terms, poly_deriv
+from .statespace import (NonlinearStateSpace, StateSpaceIdent, freq_weight,
+                         freq_weight_adjoint)
 
 
 """
@@ -37,6 +40,9 @@ class PNLSS(NonlinearStateSpace, StateSpaceIdent):
         self.n_ny = len(self.yactive)
         self.xdegree, self.ydegree = [None]*2
         self.xstructure, self.ystructure = [None]*2
+        # simulation engine used by dnlsim, see :func:`dnlsim`
+        self.engine = 'auto'
+        self._plan = None
 
     def __repr__(self):
         rep = super().__repr__()
@@ -60,6 +66,7 @@ class PNLSS(NonlinearStateSpace, StateSpaceIdent):
                 self.E = np.zeros((self.n, self.n_nx))
             # Compute the derivatives of the polynomials zeta and e
             self.xd_powers, self.xd_coeff = poly_deriv(self.xpowers)
+            self._plan = None
         elif eq in ('output', 'y'):
             self.ydegree = np.asarray(degree)
             self.ystructure = structure
@@ -70,12 +77,34 @@ class PNLSS(NonlinearStateSpace, StateSpaceIdent):
             if self.F.size == 0:
                 self.F = np.zeros((self.p, self.n_ny))
             self.yd_powers, self.yd_coeff = poly_deriv(self.ypowers)
+            self._plan = None
 
-    def output(self, u, t=None, x0=None):
-        return dnlsim(self, u, t=t, x0=x0)
+    @property
+    def plan(self):
+        """Evaluation plan for the monomials in ζ and η"""
+        if self._plan is None:
+            self._plan = MonomialPlan(self.n+self.m, self.xpowers, self.ypowers)
+        return self._plan
 
-    def jacobian(self, x0, weight=False):
-        return jacobian(x0, self, weight=weight)
+    def output(self, u, t=None, x0=None, engine=None):
+        if engine is None:
+            engine = self.engine
+        return dnlsim(self, u, t=t, x0=x0, engine=engine)
+
+    def output_batch(self, u, x0=None, params=None, engine=None):
+        if engine is None:
+            engine = self.engine
+        return dnlsim_batch(self, u, x0=x0, params=params, engine=engine)
+
+    def jacobian(self, x0, weight=False, engine=None):
+        if engine is None:
+            engine = self.engine
+        return jacobian(x0, self, weight=weight, engine=engine)
+
+    def jacobian_operator(self, x0, weight=False, engine=None):
+        if engine is None:
+            engine = self.engine
+        return jacobian_operator(x0, self, weight=weight, engine=engine)
 
 
 def combinations(n, degrees):
@@ -434,7 +463,7 @@ def select_active(structure,n,m,q,nx):
     return np.sort(active)
 
 # https://github.com/scipy/scipy/blob/master/scipy/signal/ltisys.py
-def dnlsim(system, u, t=None, x0=None):
+def dnlsim(system, u, t=None, x0=None, engine='auto'):
     """Simulate output of a discrete-time nonlinear system.
 
     Calculate the output and the states of a nonlinear state-space model.
@@ -445,6 +474,16 @@ def dnlsim(system, u, t=None, x0=None):
     input) in zeta or eta is given in max_nx and max_ny, respectively. The
     initial state is given in x0.
 
+    Parameters
+    ----------
+    engine : str {'auto', 'numba', 'numpy', 'loop'}, optional
+        'numba' and 'numpy' evaluate the monomials from a precomputed
+        :class:`pyvib.polynomial.MonomialPlan` and update states and output
+        with one product of the combined system matrix, see
+        :func:`sim_matrix`. 'numba' compiles the time loop. 'loop' is the
+        reference implementation, evaluating all powers at every sample.
+        'auto' uses numba if installed and numpy otherwise.
+
     """
     # if not isinstance(system, PNLSS):
     #     raise ValueError(f'System must be a PNLSS object {type(system)}')
@@ -485,6 +524,36 @@ def dnlsim(system, u, t=None, x0=None):
         u_dt_interp = interp1d(t, u.transpose(), copy=False, bounds_error=True)
         u_dt = u_dt_interp(tout).transpose()
 
+    engine = check_engine(engine)
+    if engine != 'loop':
+        plan = system.plan
+        M = sim_matrix(system, plan)
+        u_dt = np.ascontiguousarray(u_dt, dtype=float)
+        work = np.empty(plan.nwork)
+        if engine == 'numba':
+            pnlss_sim(M, plan.parent, plan.var, system.n, u_dt, xout, yout,
+                      work)
+            return tout, yout, xout
+
+        n = system.n
+        nvar = plan.nvar
+        work[nvar] = 1
+        out = np.empty(M.shape[0])
+        for i in range(0, out_samples - 1):
+            work[:n] = xout[i]
+            work[n:nvar] = u_dt[i]
+            plan.evaluate(work)
+            # [x(t+1); y(t)] = M*[x(t), u(t), 1, ζη(x(t),u(t))]
+            np.dot(M, work, out=out)
+            xout[i+1] = out[:n]
+            yout[i] = out[n:]
+
+        work[:n] = xout[-1]
+        work[n:nvar] = u_dt[-1]
+        plan.evaluate(work)
+        yout[-1] = M[n:] @ work
+        return tout, yout, xout
+
     # prepare nonlinear part
     repmat_x = np.ones(system.xpowers.shape[0])
     repmat_y = np.ones(system.ypowers.shape[0])
@@ -512,7 +581,131 @@ def dnlsim(system, u, t=None, x0=None):
 
     return tout, yout, xout
 
-def element_jacobian(samples, A_Edwdx, C_Fdwdx, active):
+def dnlsim_batch(system, u, x0=None, params=None, engine='auto'):
+    """Simulate several independent records of a PNLSS model in lock-step.
+
+    All records, and optionally several parameter vectors, are integrated at
+    once: the states are stored as a (n,K,R) matrix and each time step is one
+    matrix-matrix product with the combined system matrix, see
+    :func:`sim_matrix`, instead of R*K serial simulations.
+
+    Parameters
+    ----------
+    u : ndarray(R,N,m) or ndarray(N,m)
+        input of R records of N samples
+    x0 : ndarray, optional
+        initial state, broadcastable to (K,R,n). Default zero.
+    params : ndarray(K,npar), optional
+        flattened parameter vectors, see :meth:`flatten`. The records are
+        simulated for each parameter vector. Default is the current model.
+    engine : str {'auto', 'numba', 'numpy', 'loop'}, optional
+        'numpy' integrates in lock-step. 'numba' and 'loop' simulates each
+        record with the corresponding engine of :func:`dnlsim`. 'auto' is
+        'numba' if installed, as the compiled loop is faster than the
+        lock-step numpy integration for any number of records.
+
+    Returns
+    -------
+    yout : ndarray(R,N,p) or ndarray(K,R,N,p) if params are given
+    xout : ndarray(R,N,n) or ndarray(K,R,N,n) if params are given
+    """
+    u = np.ascontiguousarray(u, dtype=float)
+    if u.ndim == 2:
+        u = u[None]
+    R, N, m = u.shape
+    n, p = system.n, system.p
+    engine = check_engine(engine)
+    plan = system.plan
+
+    # combined system matrix for each parameter vector
+    if params is None:
+        M = sim_matrix(system, plan)[None]
+    else:
+        params = np.atleast_2d(params)
+        x_orig = system.flatten()
+        M = np.empty((len(params), n+p, plan.nwork))
+        for k, par in enumerate(params):
+            system._copy(*system.extract(par))
+            M[k] = sim_matrix(system, plan)
+        system._copy(*system.extract(x_orig))
+    K = M.shape[0]
+
+    x0 = np.broadcast_to(np.zeros(n) if x0 is None else x0, (K, R, n))
+    if engine != 'numpy':
+        xout = np.empty((K, R, N, n))
+        yout = np.empty((K, R, N, p))
+        work = np.empty(plan.nwork)
+        for k in range(K):
+            if engine == 'loop':
+                x_orig = system.flatten()
+                if params is not None:
+                    system._copy(*system.extract(params[k]))
+            for r in range(R):
+                if engine == 'numba':
+                    xout[k,r,0] = x0[k,r]
+                    pnlss_sim(M[k], plan.parent, plan.var, n, u[r],
+                              xout[k,r], yout[k,r], work)
+                else:
+                    _, yout[k,r], xout[k,r] = dnlsim(system, u[r], x0=x0[k,r],
+                                                     engine='loop')
+            if engine == 'loop':
+                system._copy(*system.extract(x_orig))
+    else:
+        nvar = plan.nvar
+        # monomials along the first axis, records along the last
+        work = np.empty((plan.nwork, K, R))
+        work[nvar] = 1
+        work_t = work.transpose((1,0,2))  # (K,nwork,R) view
+        out = np.empty((K, n+p, R))
+        xb = np.empty((N, n, K, R))
+        yb = np.empty((N, p, K, R))
+        ub = u.transpose((1,2,0))[:,:,None]  # (N,m,1,R)
+        xb[0] = x0.transpose((2,0,1))
+        for i in range(N):
+            work[:n] = xb[i]
+            work[n:nvar] = ub[i]
+            plan.evaluate(work)
+            # [x(t+1); y(t)] = M*[x(t), u(t), 1, ζη(x(t),u(t))] for all records
+            np.matmul(M, work_t, out=out)
+            if i < N-1:
+                xb[i+1] = out[:,:n].transpose((1,0,2))
+            yb[i] = out[:,n:].transpose((1,0,2))
+        xout = xb.transpose((2,3,0,1))
+        yout = yb.transpose((2,3,0,1))
+
+    if params is None:
+        return yout[0], xout[0]
+    return yout, xout
+
+def sim_matrix(system, plan):
+    """Combined system matrix acting on the work vector of `plan`
+
+    Returns M such that ``[x(t+1); y(t)] = M @ work(t)`` where
+    ``work(t) = [x(t), u(t), 1, monomials(x(t),u(t))]``, ie.::
+
+        M = [A B 0 E
+             C D 0 F]
+
+    with the columns of E and F placed at the position of their monomial.
+
+    Returns
+    -------
+    M : ndarray(n+p, nwork)
+    """
+    n, m, p = system.n, system.m, system.p
+    M = np.zeros((n+p, plan.nwork))
+    M[:n,:n] = system.A
+    M[:n,n:n+m] = system.B
+    M[n:,:n] = system.C
+    M[n:,n:n+m] = system.D
+    # use add.at in case a monomial is linear and shares column with A, B.
+    if system.E.size:
+        np.add.at(M, (np.s_[:n], plan.idx[0]), system.E)
+    if system.F.size:
+        np.add.at(M, (np.s_[n:], plan.idx[1]), system.F)
+    return M
+
+def element_jacobian(samples, A_Edwdx, C_Fdwdx, active, engine='auto'):
     """Compute Jacobian of the output y wrt. A, B, and E
 
     The Jacobian is calculated by filtering an alternative state-space model
@@ -533,6 +726,10 @@ def element_jacobian(samples, A_Edwdx, C_Fdwdx, active):
     active : ndarray
        Array with index of active elements. For JA: np.arange(n**2), JB: n*m or
        JE: xactive
+    engine : str {'auto', 'numba', 'numpy', 'loop'}, optional
+       'numba' and 'numpy' propagate the alternative states of all active
+       elements together, see :func:`sensitivities`. 'loop' filters one
+       element at a time.
 
     Returns
     -------
@@ -546,12 +743,18 @@ def element_jacobian(samples, A_Edwdx, C_Fdwdx, active):
     N, npar = samples.shape
     nactive = len(active)  # Number of active parameters in A, B, or E
 
+    # Which column in A, B, or E matrix
+    cols = np.mod(active, npar)
+    # Which row in A, B, or E matrix
+    rows = (active-cols)//npar
+    engine = check_engine(engine)
+    if engine != 'loop':
+        return sensitivities(samples, A_Edwdx, C_Fdwdx, rows, cols, engine)
+
     out = np.zeros((p,N,nactive))
     for k, activ in enumerate(active):
-        # Which column in A, B, or E matrix
-        j = np.mod(activ, npar)
-        # Which row in A, B, or E matrix
-        i = (activ-j)//npar
+        j = cols[k]
+        i = rows[k]
         # partial derivative of x(0) wrt. A(i,j), B(i,j), or E(i,j)
         Jprev = np.zeros(n)
         for t in range(1,N):
@@ -567,30 +770,75 @@ def element_jacobian(samples, A_Edwdx, C_Fdwdx, active):
 
     return out
 
-def jacobian(x0, system, weight=False):
-    """Compute the Jacobians of a steady state nonlinear state-space model
+def sensitivities(samples, A_Edwdx, C_Fdwdx, rows, cols, engine='auto'):
+    """Propagate the alternative states of several parameters together
 
-    Jacobians of a nonlinear state-space model
+    The alternative states of all parameters are collected in one matrix
+    J(t) ∈ (n,nactive), such that each time step is one matrix product
 
-        x(t+1) = A x(t) + B u(t) + E zeta(x(t),u(t))
-        y(t)   = C x(t) + D u(t) + F eta(x(t),u(t))
+    J(t+1) = (A + E*∂ζ∂x)(t) J(t) + S(t)
+    ∂y(t) = (C + F*∂η∂x)(t) J(t)
 
-    i.e. the partial derivatives of the modeled output w.r.t. the active
-    elements in the A, B, E, F, D, and C matrices, fx: JA = ∂y/∂Aᵢⱼ
+    where the only nonzero element in column k of S(t) is
+    ``S[rows[k],k] = samples[t,cols[k]]``, ie. parameter k is element
+    (rows[k], cols[k]) of the matrix multiplying ``samples``.
 
-    x0 : ndarray
-        flattened array of state space matrices
+    Parameters
+    ----------
+    samples : ndarray(NT,nsamples)
+       fx. [x, u, zeta] for the elements in A, B and E
+    A_Edwdx : ndarray (n,n,NT)
+       The result of ``A + E*∂ζ∂x``
+    C_Fdwdx : ndarray (p,n,NT)
+       The result of ``C + F*∂η∂x``
+    rows, cols : ndarray(nactive)
+       row in the parameter matrix and column in `samples` of each parameter
+    engine : str {'auto', 'numba', 'numpy'}, optional
+       'numba' compiles the time loop
 
+    Returns
+    -------
+    out : ndarray(p,NT,nactive)
     """
-    n, m, p = system.n, system.m, system.p
-    R, p, npp = system.signal.R, system.signal.p, system.signal.npp
-    nfd = npp//2
-    # total number of points
-    N = R*npp  # system.signal.um.shape[0]
-    without_T2 = system.without_T2
+    p, n, NT = C_Fdwdx.shape
+    nactive = len(rows)
+    # time along the first axis for contiguous access
+    A_t = np.ascontiguousarray(A_Edwdx.transpose((2,0,1)))
+    C_t = np.ascontiguousarray(C_Fdwdx.transpose((2,0,1)))
+    samples = np.ascontiguousarray(samples, dtype=float)
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+
+    out = np.zeros((p,NT,nactive))
+    J = np.zeros((n,nactive))
+    engine = check_engine(engine)
+    if engine == 'numba':
+        pnlss_jac(A_t, C_t, samples, rows, cols, out, J, np.empty_like(J))
+        return out
+
+    k = np.arange(nactive)
+    for t in range(1,NT):
+        J = A_t[t-1] @ J
+        J[rows,k] += samples[t-1,cols]
+        np.matmul(C_t[t], J, out=out[:,t])
 
-    A, B, C, D, E, F = system.extract(x0)
+    return out
 
+def linearize(system, A, C, E, F):
+    """Linearize the model along the last simulated trajectory
+
+    Returns
+    -------
+    x_trans, u_trans : ndarray(NT,n), ndarray(NT,m)
+        States and inputs with prepended transient samples
+    zeta, eta : ndarray(NT,n_nx), ndarray(NT,n_ny)
+        Monomials along the trajectory
+    A_EdwxIdx : ndarray(n,n,NT)
+        ``A + E*∂ζ∂x``
+    FdwyIdx : ndarray(p,n,NT)
+        ``C + F*∂η∂x``
+    """
+    n = system.n
     # Collect states and outputs with prepended transient sample
     x_trans = system.x_mod[system.idx_trans]
     u_trans = system.signal.um[system.idx_trans]
@@ -599,7 +847,7 @@ def jacobian(x0, system, weight=False):
 
     # E∂ₓζ + A(n,n,NT)
     if E.size == 0:
-        FdwyIdx = np.zeros(shape=(*A.shape,n_trans))
+        A_EdwxIdx = np.zeros(shape=(*A.shape,n_trans))
     else:
         A_EdwxIdx = multEdwdx(contrib,system.xd_powers,np.squeeze(system.xd_coeff),
                           E,n)
@@ -615,6 +863,110 @@ def jacobian(x0, system, weight=False):
     # Add C to F∂ₓη for all samples at once
     FdwyIdx += C[...,None]
     eta = nl_terms(contrib, system.ypowers).T  # (NT,n_ny)
+    return x_trans, u_trans, zeta, eta, A_EdwxIdx, FdwyIdx
+
+def jacobian_operator(x0, system, weight=False, engine='auto'):
+    """Jacobian of the (weighted) error as a matrix-free linear operator
+
+    The Jacobian in :func:`jacobian` is (p*N, npar) and thus often too large
+    to store for long records. The operator instead computes
+    Jacobian-vector products by filtering the parameter perturbation through
+    the linearized model (tangent model), and vector-Jacobian products by
+    filtering backwards through its adjoint. Memory scales with N + npar.
+
+    The model must have been simulated with the parameters `x0`, ie. as done
+    by :func:`costfcn_time`.
+
+    Returns
+    -------
+    J : scipy.sparse.linalg.LinearOperator
+        Same as ``jacobian(x0, system, weight)``, such that ``J @ v`` and
+        ``J.T @ e`` are the Jacobian-vector and vector-Jacobian products.
+    """
+    n, m, p = system.n, system.m, system.p
+    R, npp = system.signal.R, system.signal.npp
+    xact, yact = system.xactive, system.yactive
+    engine = check_engine(engine)
+    if engine == 'loop':
+        engine = 'numpy'
+
+    A, B, C, D, E, F = system.extract(x0)
+    x_trans, u_trans, zeta, eta, A_EdwxIdx, FdwyIdx = \
+        linearize(system, A, C, E, F)
+    NT = u_trans.shape[0]
+    A_t = np.ascontiguousarray(A_EdwxIdx.transpose((2,0,1)))
+    C_t = np.ascontiguousarray(FdwyIdx.transpose((2,0,1)))
+    # rows of the (p,NT) output kept in the Jacobian, see :func:`jacobian`
+    rowidx = np.arange(p*NT)[system.idx_remtrans][system.without_T2]
+    # parameter split, same order as :meth:`flatten`
+    split = np.cumsum([n**2, n*m, p*n, p*m, len(xact)])
+    fweight = weight is not False and system.freq_weight
+    if weight is not False and not system.freq_weight:
+        raise ValueError('Time weighting not possible')
+    nrows = len(rowidx)
+    if fweight:
+        nrows = 2*(npp//2)*R*p
+
+    def matvec(v):
+        dA, dB, dC, dD, dE, dF = np.split(np.ravel(v), split)
+        Ef = np.zeros_like(E)
+        Ef.flat[xact] = dE
+        Ff = np.zeros_like(F)
+        Ff.flat[yact] = dF
+        d = (x_trans @ dA.reshape(n,n).T + u_trans @ dB.reshape(n,m).T +
+             zeta @ Ef.T)
+        out = tangent(A_t, C_t, d, engine)
+        out += (x_trans @ dC.reshape(p,n).T + u_trans @ dD.reshape(p,m).T +
+                eta @ Ff.T)
+        out = out.T.ravel()[rowidx]
+        if fweight:
+            out = freq_weight(out, weight, npp, R, p)
+        return out
+
+    def rmatvec(e):
+        e = np.ravel(e)
+        if fweight:
+            e = freq_weight_adjoint(e, weight, npp, R, p)
+        g = np.zeros(p*NT)
+        g[rowidx] = e
+        g = g.reshape(p,NT).T
+        lam = adjoint(A_t, C_t, g, engine)
+        return np.hstack(((lam.T @ x_trans).ravel(), (lam.T @ u_trans).ravel(),
+                          (g.T @ x_trans).ravel(), (g.T @ u_trans).ravel(),
+                          (lam.T @ zeta).flat[xact], (g.T @ eta).flat[yact]))
+
+    return LinearOperator((nrows, len(x0)), matvec=matvec, rmatvec=rmatvec,
+                          dtype=float)
+
+def jacobian(x0, system, weight=False, engine='auto'):
+    """Compute the Jacobians of a steady state nonlinear state-space model
+
+    Jacobians of a nonlinear state-space model
+
+        x(t+1) = A x(t) + B u(t) + E zeta(x(t),u(t))
+        y(t)   = C x(t) + D u(t) + F eta(x(t),u(t))
+
+    i.e. the partial derivatives of the modeled output w.r.t. the active
+    elements in the A, B, E, F, D, and C matrices, fx: JA = ∂y/∂Aᵢⱼ
+
+    x0 : ndarray
+        flattened array of state space matrices
+    engine : str {'auto', 'numba', 'numpy', 'loop'}, optional
+        Except for 'loop', JA, JB and JE are computed in one pass, see
+        :func:`sensitivities`.
+
+    """
+    n, m, p = system.n, system.m, system.p
+    R, p, npp = system.signal.R, system.signal.p, system.signal.npp
+    nfd = npp//2
+    # total number of points
+    N = R*npp  # system.signal.um.shape[0]
+    without_T2 = system.without_T2
+
+    A, B, C, D, E, F = system.extract(x0)
+    x_trans, u_trans, zeta, eta, A_EdwxIdx, FdwyIdx = \
+        linearize(system, A, C, E, F)
+    n_trans = u_trans.shape[0]  # NT
 
     # calculate jacobians wrt state space matrices
     JC = np.kron(np.eye(p), system.x_mod)  # (p*N,p*n)
@@ -626,21 +978,41 @@ def jacobian(x0, system, weight=False):
     else:
         JF = np.array([]).reshape(p*N,0)
 
-    # calculate Jacobian by filtering an alternative state-space model
-    JA = element_jacobian(x_trans, A_EdwxIdx, FdwyIdx, np.arange(n**2))
-    JA = JA.transpose((1,0,2)).reshape((p*n_trans, n**2))
-    JA = JA[system.idx_remtrans]  # (p*N,n**2)
-
-    JB = element_jacobian(u_trans, A_EdwxIdx, FdwyIdx, np.arange(n*m))
-    JB = JB.transpose((1,0,2)).reshape((p*n_trans, n*m))
-    JB = JB[system.idx_remtrans]  # (p*N,n*m)
-
-    if system.xactive.size:
-        JE = element_jacobian(zeta, A_EdwxIdx, FdwyIdx, system.xactive)
-        JE = JE.transpose((1,0,2)).reshape((p*n_trans, len(system.xactive)))
-        JE = JE[system.idx_remtrans]  # (p*N,nactiveE)
+    engine = check_engine(engine)
+    if engine != 'loop':
+        # filter the alternative state-space models of all elements in A, B
+        # and E at once. The alternative inputs are [x, u, zeta].
+        n_nx = zeta.shape[1]
+        colsE = np.mod(system.xactive, n_nx)
+        rows = np.r_[np.arange(n**2)//n, np.arange(n*m)//m,
+                     (system.xactive-colsE)//n_nx].astype(int)
+        cols = np.r_[np.mod(np.arange(n**2), n), n + np.mod(np.arange(n*m), m),
+                     n + m + colsE].astype(int)
+        J = sensitivities(np.hstack((x_trans, u_trans, zeta)), A_EdwxIdx,
+                          FdwyIdx, rows, cols, engine=engine)
+        J = J.transpose((1,0,2)).reshape((p*n_trans, len(rows)))
+        J = J[system.idx_remtrans]
+        JA, JB, JE = np.split(J, [n**2, n**2+n*m], axis=1)
     else:
-        JE = np.array([]).reshape(p*N,0)
+        # calculate Jacobian by filtering an alternative state-space model
+        JA = element_jacobian(x_trans, A_EdwxIdx, FdwyIdx, np.arange(n**2),
+                              engine)
+        JA = JA.transpose((1,0,2)).reshape((p*n_trans, n**2))
+        JA = JA[system.idx_remtrans]  # (p*N,n**2)
+
+        JB = element_jacobian(u_trans, A_EdwxIdx, FdwyIdx, np.arange(n*m),
+                              engine)
+        JB = JB.transpose((1,0,2)).reshape((p*n_trans, n*m))
+        JB = JB[system.idx_remtrans]  # (p*N,n*m)
+
+        if system.xactive.size:
+            JE = element_jacobian(zeta, A_EdwxIdx, FdwyIdx, system.xactive,
+                                  engine)
+            JE = JE.transpose((1,0,2)).reshape((p*n_trans,
+                                                len(system.xactive)))
+            JE = JE[system.idx_remtrans]  # (p*N,nactiveE)
+        else:
+            JE = np.array([]).reshape(p*N,0)
 
     jac = np.hstack((JA, JB, JC, JD, JE, JF))[without_T2]
     npar = jac.shape[1]
@@ -652,7 +1024,7 @@ def jacobian(x0, system, weight=False):
                           order='F').swapaxes(1,2).reshape((-1,p,R*npar),
                                                            order='F')
         # select only the positive half of the spectrum
-        jac = fft(jac, axis=0)[:nfd]
+        jac = rfft(jac, axis=0)[:nfd]
         jac = mmul_weight(jac, weight)
         # (nfd,p,R*npar) -> (nfd,p,R,npar) -> (nfd,R,p,npar) -> (nfd*R*p,npar)
         jac = jac.reshape((-1,p,R,npar),
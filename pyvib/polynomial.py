@@ -170,6 +170,123 @@ def nl_terms(contrib,power):
 
     return out
 
+class MonomialPlan():
+    """Evaluation plan for the monomials of one or more polynomials.
+
+    Instead of computing each monomial as ``np.prod(contrib**power)``, every
+    monomial of degree d is formed as the product of a monomial of degree d-1
+    and one variable. Monomials that are needed as intermediate results, but
+    are not part of any of the polynomials, are added to the plan. The
+    monomials of several polynomials (fx. ζ and η of a PNLSS model) share the
+    products of lower degree.
+
+    All values are stored in one work vector with the layout::
+
+        work = [contrib (nvar), 1, monomials sorted by degree (nmon)]
+
+    where the constant one is used for monomials of degree zero.
+
+    Parameters
+    ----------
+    nvar : int
+        number of variables, ie. n+m for a PNLSS model
+    *powers : ndarray(nterms,nvar)
+        the exponents of each polynomial, see :func:`nl_terms`
+
+    Attributes
+    ----------
+    nwork : int
+        length of the work vector
+    parent, var : ndarray(nmon)
+        ``work[nvar+1+k] = work[parent[k]] * work[var[k]]``
+    levels : list of tuples
+        (start, stop, parent, var) for each degree. All monomials of one degree
+        can be computed at once, as they only depend on lower degrees.
+    idx : list of ndarray(nterms)
+        position of the terms of each polynomial in the work vector
+
+    Examples
+    --------
+    >>> powers = np.array([[2,0],[1,1],[0,3]])
+    >>> plan = MonomialPlan(2, powers)
+    >>> work = plan.work(np.array([2., 3.]))
+    >>> work[plan.idx[0]]
+    array([ 4.,  6., 27.])
+    """
+
+    def __init__(self, nvar, *powers):
+        self.nvar = nvar
+        one = nvar
+        # position of each monomial in the work vector. Degree one is the
+        # variables themselves, degree zero is the constant.
+        pos = {tuple(row): j for j, row in enumerate(np.eye(nvar, dtype=int))}
+        pos[(0,)*nvar] = one
+
+        # collect all monomials and their intermediate products
+        need = set()
+        for power in powers:
+            for row in np.atleast_2d(power).astype(int):
+                row = tuple(row)
+                while sum(row) > 1 and row not in need:
+                    need.add(row)
+                    # remove one factor of the first variable present
+                    j = next(i for i, e in enumerate(row) if e > 0)
+                    row = row[:j] + (row[j]-1,) + row[j+1:]
+
+        mons = sorted(need, key=lambda row: (sum(row), tuple(-e for e in row)))
+        nmon = len(mons)
+        self.parent = np.empty(nmon, dtype=int)
+        self.var = np.empty(nmon, dtype=int)
+        for k, row in enumerate(mons):
+            pos[row] = nvar + 1 + k
+            j = next(i for i, e in enumerate(row) if e > 0)
+            self.parent[k] = pos[row[:j] + (row[j]-1,) + row[j+1:]]
+            self.var[k] = j
+
+        # monomials of equal degree are contiguous
+        self.levels = []
+        degree = np.array([sum(row) for row in mons], dtype=int)
+        for d in np.unique(degree):
+            k = np.where(degree == d)[0]
+            start, stop = nvar + 1 + k[0], nvar + 1 + k[-1] + 1
+            self.levels.append((start, stop, self.parent[k], self.var[k]))
+
+        self.nmon = nmon
+        self.nwork = nvar + 1 + nmon
+        self.idx = [np.array([pos[tuple(row)] for row in
+                              np.atleast_2d(power).astype(int)], dtype=int)
+                    for power in powers]
+
+    def work(self, contrib, out=None):
+        """Evaluate all monomials for the variables in `contrib`
+
+        Parameters
+        ----------
+        contrib : ndarray(nvar,...)
+            samples of the variables. Trailing dimensions are broadcasted,
+            ie. all samples (nvar,N) can be evaluated at once.
+        out : ndarray(nwork,...), optional
+            preallocated work array
+
+        Returns
+        -------
+        work : ndarray(nwork,...)
+        """
+        contrib = np.asarray(contrib)
+        if out is None:
+            out = np.empty((self.nwork,) + contrib.shape[1:])
+        out[:self.nvar] = contrib
+        out[self.nvar] = 1
+        self.evaluate(out)
+        return out
+
+    def evaluate(self, work):
+        """Compute the monomials in place, given that the variables are set in
+        ``work[:nvar]``"""
+        for start, stop, parent, var in self.levels:
+            np.multiply(work[parent], work[var], out=work[start:stop])
+        return work
+
 
 class NL_force(object):
 
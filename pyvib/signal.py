@@ -1,18 +1,50 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
+import mmap
+import os
+
 import matplotlib.pylab as plt
 import numpy as np
-from numpy.fft import fft
 from scipy.signal import decimate
 
 from .common import db, prime_factor
+from .fft_backend import fft, fft_lines, rfft
 from .filter import differentiate, integrate
 from .frf import bla_periodic, covariance
 from .helper.plotting import periodicity
 
 class Signal():
-    def __init__(self, u, y, yd=None, fs=1):
+    def __init__(self, u, y, yd=None, fs=1, chunk=None, cache_dir=None):
+        """Periodic input/output data
+
+        Parameters
+        ----------
+        u : ndarray(npp,m,R,P)
+            input signal
+        y : ndarray(npp,p,R,P)
+            output signal
+        yd : ndarray(npp,p,R,P), optional
+            output velocity
+        fs : float, optional
+            sampling frequency
+        chunk : int, optional
+            Number of periods read at a time in :meth:`average`, :meth:`bla`
+            and :attr:`covY`. Used for memory-mapped data, see
+            :meth:`from_npy`, so only `chunk` periods of a realization are in
+            memory at once. Default is all at once.
+        cache_dir : str, optional
+            Directory where the spectra are stored, see :meth:`cached`.
+
+        Notes
+        -----
+        The spectra of the data are computed when first needed and cached, see
+        :meth:`spectra`, :meth:`mean_spectra` and :attr:`covY`. The cache is
+        cleared when `u`, `y`, `yd` or `lines` are set, or when
+        :meth:`average` updates `um` and `ym`. Changing the data in-place is
+        not detected; call :meth:`clear_cache` afterwards.
+        """
         # in case there is only one realization, ie. (npp,m,P)
         if len(u.shape) == 3:
             u = u[:,:,None]
@@ -20,15 +52,108 @@ class Signal():
             y = y[:,:,None]
         if yd is not None and len(yd.shape) == 3:
             yd = yd[:,:,None]
+        self._cache = {}
+        self.cache_dir = cache_dir
         self.u = u
         self.y = y
-        self._yd = yd
-        self._ydm = None
+        self.yd = yd
         self.fs = fs
+        self.chunk = chunk
         self.npp, self.m, self.R, self.P = u.shape
         self.npp, self.p, self.R, self.P = y.shape
         self._lines = None
-        self._covY = None
+
+    @property
+    def u(self):
+        return self._u
+
+    @u.setter
+    def u(self, u):
+        self._u = u
+        self.clear_cache()
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, y):
+        self._y = y
+        self.clear_cache()
+
+    @property
+    def yd(self):
+        return self._yd
+
+    @yd.setter
+    def yd(self, yd):
+        self._yd = yd
+        self._ydm = None
+        self.clear_cache()
+
+    def clear_cache(self, *keys):
+        """Clear all cached spectra, or the entries starting with `keys`"""
+        if not keys:
+            self._cache.clear()
+        for key in [k for k in self._cache if k[0] in keys]:
+            del self._cache[key]
+
+    def cached(self, key, fun, *data):
+        """Cached result of ``fun()``
+
+        The result is stored under `key` until the cache is cleared. If
+        `cache_dir` is set, the result is also saved to disk in a file named
+        by a hash of `key` and the arrays in `data`, and reused by later
+        Signals with the same data. Memory-mapped arrays are identified by
+        their file instead of their content, see :func:`_hash`.
+        """
+        if key in self._cache:
+            return self._cache[key]
+        if self.cache_dir is None:
+            res = fun()
+        else:
+            fname = os.path.join(self.cache_dir,
+                                 f'{key[0]}_{_hash(key, *data)}.npy')
+            if os.path.exists(fname):
+                res = np.load(fname)
+            else:
+                res = fun()
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # write to a temporary file, such that a killed job does not
+                # leave a partial file
+                tmp = f'{fname}.tmp'
+                with open(tmp, 'wb') as f:
+                    np.save(f, res)
+                os.replace(tmp, fname)
+        self._cache[key] = res
+        return res
+
+    @classmethod
+    def from_npy(cls, u, y, yd=None, fs=1, chunk=1, mmap_mode='r'):
+        """Signal from memory-mapped .npy files
+
+        The data is not loaded; it is read `chunk` periods at a time when
+        needed.
+
+        Parameters
+        ----------
+        u, y, yd : str
+            filenames of .npy files with the shapes given in :class:`Signal`
+        chunk : int, optional
+            Number of periods read at a time
+        mmap_mode : str, optional
+            see :func:`numpy.load`
+        """
+        u = np.load(u, mmap_mode=mmap_mode)
+        y = np.load(y, mmap_mode=mmap_mode)
+        if yd is not None:
+            yd = np.load(yd, mmap_mode=mmap_mode)
+        return cls(u, y, yd, fs=fs, chunk=chunk)
+
+    def _chunks(self):
+        """Slices of periods for reading data in chunks"""
+        chunk = self.P if self.chunk is None else self.chunk
+        return [slice(i, i+chunk) for i in range(0, self.P, chunk)]
 
     @property
     def lines(self):
@@ -37,14 +162,56 @@ class Signal():
     @lines.setter
     def lines(self, lines):
         self._lines = lines
+        self.clear_cache('lines')
         self.F = len(lines)
         self.norm_freq = lines/self.npp  # Excited frequencies (normalized)
 
+    def spectra(self, name):
+        """Spectra of the data `name` ('u', 'y' or 'yd') at the excited lines,
+        (n,R,P,F). Cached."""
+        x = getattr(self, name)
+        return self.cached(('lines', name), lambda: self._spectra(x), x,
+                           self.lines)
+
+    def _spectra(self, x):
+        if self.chunk is None:
+            nfd = int(self.npp/2)
+            if np.max(self.lines) < nfd:
+                X = self.half_spectra(x)[self.lines]
+            else:
+                X = fft_lines(x, self.lines)
+            return X.transpose((1,2,3,0))
+        npp, n, R, P = x.shape
+        X = np.empty((n,R,P,self.F), dtype=complex)
+        for r in range(R):
+            for sl in self._chunks():
+                X[:,r,sl] = fft_lines(x[:,:,r,sl], self.lines).transpose(
+                    (1,2,0))
+        return X
+
+    def half_spectra(self, x):
+        """Spectra of x(npp,n,R,P) in the positive half of the spectrum,
+        (nfd,n,R,P). Cached if x is `u` or `y` and in memory. The spectra of
+        memory-mapped data are as large as the data, and are not kept."""
+        nfd = int(self.npp/2)
+        if not isinstance(x, np.memmap):
+            for name in ('u', 'y'):
+                if x is getattr(self, name):
+                    return self.cached(('half', name),
+                                       lambda: rfft(x, axis=0)[:nfd], x)
+        return rfft(x, axis=0)[:nfd]
+
+    def mean_spectra(self, name):
+        """Spectra of the averaged data `name` ('um', 'ym' or 'ydm'),
+        (npp*R,n). Cached."""
+        x = getattr(self, name)
+        return self.cached(('mean', name), lambda: fft(x, axis=0), x)
+
     def bla(self):
         """Get best linear approximation"""
         # TODO bla expects  m, R, P, F = U.shape
-        self.U = fft(self.u, axis=0)[self.lines].transpose((1,2,3,0))
-        self.Y = fft(self.y, axis=0)[self.lines].transpose((1,2,3,0))
+        self.U = self.spectra('u')
+        self.Y = self.spectra('y')
         self.G, self.covG, self.covGn = bla_periodic(self.U, self.Y)
         self.G = self.G.transpose((2,0,1))
         if self.covG is not None:
@@ -55,9 +222,21 @@ class Signal():
 
     @property
     def covY(self):
-        if self._covY is None:
-            self._covY = covariance(self.y)
-        return self._covY
+        if self.chunk is None:
+            fun = lambda: covariance(self.y, Y=self.half_spectra(self.y))
+        else:
+            fun = lambda: covariance(self.y, chunk=self.chunk)
+        return self.cached(('covY',), fun, self.y)
+
+    def _mean(self, x):
+        """Average over periods, read in chunks"""
+        if self.chunk is None:
+            return x.mean(axis=-1)
+        xm = np.zeros(x.shape[:-1])
+        for r in range(x.shape[2]):
+            for sl in self._chunks():
+                xm[:,:,r] += x[:,:,r,sl].sum(axis=-1)
+        return xm / x.shape[-1]
 
     def average(self, u=None, y=None):
         """Average over periods and flatten over realizations"""
@@ -70,17 +249,19 @@ class Signal():
         if y is None:
             y = self.y
             savey = True
-        um = u.mean(axis=-1)  # (npp,m,R)
-        ym = y.mean(axis=-1)
+        um = self._mean(u)  # (npp,m,R)
+        ym = self._mean(y)
         um = um.swapaxes(1,2).reshape(-1,self.m, order='F')  # (npp*R,m)
         ym = ym.swapaxes(1,2).reshape(-1,self.p, order='F')  # (npp*R,p)
 
         if saveu:
             self.um = um
+            self.clear_cache('mean')
             # number of samples after average over periods
             self.mns = um.shape[0]  # mns = npp*R
         if savey:
             self.ym = ym
+            self.clear_cache('mean')
 
         return um, ym
 
@@ -90,7 +271,7 @@ class Signal():
             # TODO do some numerical differentiation
             pass
         if self._ydm is None:
-            ydm = self._yd.mean(axis=-1)
+            ydm = self._mean(self._yd)
             self._ydm = ydm.swapaxes(1,2).reshape(-1,self.p, order='F')
         return self._ydm  # (npp*R,m)
 
@@ -100,6 +281,25 @@ class Signal():
         return periodicity(y=self.y, fs=self.fs, dof=dof, R=R, P=P, n=n,
                            fig=fig, ax=ax, **kwargs)
 
+def _hash(key, *data):
+    """Hash of `key` and the arrays in `data`
+
+    An array memory-mapped by :meth:`Signal.from_npy` is identified by its
+    file name, offset, size and modification time, so the file is not read.
+    Other arrays are identified by their content.
+    """
+    h = hashlib.sha1(repr(key).encode())
+    for x in data:
+        if isinstance(x, np.memmap) and isinstance(x.base, mmap.mmap):
+            st = os.stat(x.filename)
+            h.update(repr((x.filename, x.offset, x.shape, x.strides,
+                           x.dtype.str, st.st_size, st.st_mtime_ns)).encode())
+        else:
+            x = np.asarray(x)
+            h.update(repr((x.shape, x.dtype.str)).encode())
+            h.update(np.ascontiguousarray(x).view(np.uint8))
+    return h.hexdigest()
+
 def downsample(y, u, n, nsper=None, keep=False):
     """Filter and downsample signals
 
@@ -3,15 +3,18 @@
 
 
 from copy import deepcopy
+from functools import partial
 
 import numpy as np
-from numpy.fft import fft
+from numpy.linalg import norm
 from scipy.optimize import least_squares
 from scipy.signal.lti_conversion import abcd_normalize
 from scipy.signal.ltisys import dlsim
 
-from pyvib.common import lm, mmul_weight, weightfcn
+from pyvib.common import (column_norms, lbfgs, lm, load_checkpoint,
+                          mmul_weight, weightfcn)
 
+from .fft_backend import irfft, rfft
 from .lti_conversion import discrete2cont, ss2phys
 from .modal import modal_ac
 
@@ -30,6 +33,8 @@ class StateSpace():
         self._dt = None
         self.T1, self.T2 = [None]*2
         self.n, self.m, self.p = [0]*3
+        # simulate realizations in lock-step, see :meth:`simulate`
+        self.batch = False
 
         sys = system
         dt = kwargs.pop('dt', True)
@@ -184,13 +189,51 @@ class StateSpace():
         system = self._get_system()
         return dlsim(system, u, t=t, x0=x0)
 
-    def simulate(self, u, t=None, x0=None, T1=None, T2=None):
+    def output_batch(self, u, x0=None):
+        """Simulate several independent records.
+
+        Parameters
+        ----------
+        u : ndarray(R,N,m)
+            input of R records of N samples
+        x0 : ndarray(n) or ndarray(R,n), optional
+            initial state of the records
+
+        Returns
+        -------
+        y : ndarray(R,N,p)
+        x : ndarray(R,N,n)
+        """
+        R, N, _ = u.shape
+        x0 = np.broadcast_to(np.zeros(self.n) if x0 is None else x0,
+                             (R, self.n))
+        y = np.empty((R, N, self.p))
+        x = np.empty((R, N, self.n))
+        for r in range(R):
+            _, y[r], x[r] = self.output(u[r], x0=x0[r])
+        return y, x
+
+    def simulate(self, u, t=None, x0=None, T1=None, T2=None, batch=None,
+                 **kwargs):
         """
         Return the response of the discrete-time system to input `u` with
         transient handling.
 
-        See :func:`scipy.signal.dlsim` for details.
+        See :func:`scipy.signal.dlsim` for details. Additional keyword
+        arguments, fx. the simulation `engine` of nonlinear models, are passed
+        on to :meth:`output`.
+
+        If `batch` is True (default is the attribute `batch`), the
+        realizations given by T1 are simulated independently and in lock-step
+        with :meth:`output_batch`, each starting from `x0` and with its own
+        transient samples prepended. In the default serial simulation, the
+        realizations are concatenated and each realization starts from the
+        final state of the previous. If the transient is long enough, both
+        give the same steady state output. Batch simulation requires
+        realizations of equal length.
         """
+        if batch is None:
+            batch = self.batch
 
         # Number of samples
         u = np.atleast_1d(u)
@@ -205,10 +248,16 @@ class StateSpace():
         else:
             idx = transient_indices_periodic(T1, ns)
 
+        if T1 is not None and batch:
+            t, y, x = self._simulate_batch(u, T1, idx, x0=x0, **kwargs)
+            self.x_mod = x
+            self.y_mod = y
+            return t, y, x
+
         if T1 is not None:
             # Prepend transient samples to the input
             u = u[idx]
-        t, y, x = self.output(u, t=t, x0=x0)
+        t, y, x = self.output(u, t=t, x0=x0, **kwargs)
 
         if T1 is not None:
             # remove transient samples. p=1 is correct. TODO why?
@@ -222,6 +271,28 @@ class StateSpace():
         self.y_mod = y
         return t, y, x
 
+    def _simulate_batch(self, u, T1, idx, x0=None, **kwargs):
+        """Simulate the realizations in T1 as a batch, see :meth:`simulate`"""
+        ns, m = u.shape
+        T1 = np.atleast_1d(np.asarray(T1, dtype=int))
+        ntrans = T1[0]
+        starts = T1[1:] if len(T1) > 1 else np.zeros(1, dtype=int)
+        nr = np.diff(np.append(starts, ns))
+        if np.any(nr != nr[0]):
+            raise ValueError('Batch simulation requires realizations of equal'
+                             f' length. Starting samples are {starts}')
+        R, nr = len(starts), nr[0]
+
+        # (R*(ntrans+nr),m) -> (R,ntrans+nr,m)
+        ub = u[idx].reshape(R, ntrans+nr, m)
+        y, x = self.output_batch(ub, x0=x0, **kwargs)
+        # remove transient samples and stack the realizations
+        y = y[:,ntrans:].reshape(R*nr, -1)
+        x = x[:,ntrans:].reshape(R*nr, -1)
+        t = (np.arange(R*(ntrans+nr)) * self.dt)[
+            remove_transient_indices_periodic(T1, ns, p=1)]
+        return t, y, x
+
     def to_cont(self, method='zoh', alpha=None):
         """convert to cont. time. Only A and B changes"""
         self.Ac, self.Bc, *_ = \
@@ -383,9 +454,72 @@ class StateSpaceIdent():
         # TODO maybe divide by 2 to match scipy's implementation of minpack
         return np.dot(err, err)
 
+    def gradient(self, x0=None, weight=False):
+        """Cost and its gradient wrt. the parameters
+
+        The gradient ``2*Jᵀe`` is computed by filtering the error backwards
+        through the adjoint of the linearized model, see
+        :meth:`jacobian_operator`. The cost of one gradient is one simulation
+        and one backward pass, independent of the number of parameters.
+
+        Returns
+        -------
+        cost : float
+        grad : ndarray(npar)
+        """
+        if weight is True:
+            weight = self.weight
+        if x0 is None:
+            x0 = self.flatten()
+        err = self.costfcn(x0, weight=weight)
+        jac = self.jacobian_operator(x0, weight=weight)
+        return np.dot(err, err), 2*jac.rmatvec(err)
+
+    def _structure(self):
+        """Model structure saved with the optimization checkpoints"""
+        empty = np.array([], dtype=int)
+        return {'model': self.__class__.__name__, 'n': self.n, 'm': self.m,
+                'p': self.p, 'xactive': getattr(self, 'xactive', empty),
+                'yactive': getattr(self, 'yactive', empty)}
+
     def optimize(self, method=None, weight=True, info=2, nmax=50, lamb=None,
-                 ftol=1e-12, xtol=1e-12, gtol=1e-12, copy=False):
-        """Optimize the estimated the nonlinear state space matrices"""
+                 ftol=1e-12, xtol=1e-12, gtol=1e-12, copy=False,
+                 matfree=False, solver='svd', workers=None, checkpoint=None,
+                 checkpoint_every=1, resume=None):
+        """Optimize the estimated the nonlinear state space matrices
+
+        method : {None, 'lbfgs', 'lm'}, optional
+            None uses the Levenberg-Marquardt in :func:`pyvib.common.lm`.
+            'lbfgs' uses the quasi-Newton L-BFGS method with the adjoint
+            gradient, see :meth:`gradient`, and never forms the Jacobian.
+            'lm' uses scipy's least_squares.
+        matfree : bool, optional
+            Use the matrix-free Jacobian, see :meth:`jacobian_operator`. Only
+            Jacobian-vector products are computed, such that memory scales
+            with N + npar instead of N*npar. Only for the default `method`.
+        solver : {'svd', 'qr', 'chol'}, optional
+            Factorization of the Jacobian used by :func:`pyvib.common.lm`.
+            'qr' and 'chol' are faster for tall Jacobians, see
+            :func:`pyvib.common.lm_factorize`.
+        workers : int, optional
+            Number of processes evaluating a ladder of damping factors λ in
+            parallel, see :func:`pyvib.common.lm`.
+        checkpoint : str, optional
+            npz file where the state of the optimization and the model
+            structure is saved every `checkpoint_every` iteration. Only for
+            the default `method`.
+        resume : str, optional
+            Continue the optimization from this checkpoint. The model
+            structure must be the same. Only for the default `method`.
+        """
+        if ((matfree or method == 'lbfgs') and
+                not hasattr(self, 'jacobian_operator')):
+            raise ValueError(f'{self.__class__.__name__} has no matrix-free '
+                             'Jacobian')
+        if method is not None and (checkpoint is not None or
+                                   resume is not None):
+            raise ValueError('checkpoint and resume are only supported for '
+                             'the default method')
         if weight is True:
             weight = self.weight
 
@@ -398,10 +532,33 @@ class StateSpaceIdent():
 
         x0 = self.flatten()
         kwargs = {'weight':weight}
+        structure = self._structure()
+        if resume is not None:
+            saved = load_checkpoint(resume)
+            for key, val in structure.items():
+                if not np.array_equal(saved.get(key), val):
+                    raise ValueError(f'The model structure ({key}) differs '
+                                     f'from the checkpoint {resume}')
         if method is None:
-            res = lm(fun=self.costfcn, x0=x0, jac=self.jacobian, info=info,
+            jac = self.jacobian_operator if matfree else self.jacobian
+            if isinstance(self, NonlinearStateSpace):
+                # the Jacobians use the states of the last simulation
+                jac = partial(_jacobian_simulated, self, jac)
+            res = lm(fun=self.costfcn, x0=x0, jac=jac, info=info,
                      nmax=nmax, lamb=lamb, ftol=ftol, xtol=xtol, gtol=gtol,
+                     solver=solver, workers=workers, checkpoint=checkpoint,
+                     checkpoint_every=checkpoint_every,
+                     checkpoint_data=structure, resume=resume,
                      kwargs=kwargs)
+        elif method == 'lbfgs':
+            # scale the parameters by the estimated column norms of J,
+            # relative to the norm of the error. Then the first step of unit
+            # length changes the error by roughly its own size.
+            err = self.costfcn(x0, weight=weight)
+            scaling = column_norms(self.jacobian_operator(x0, weight=weight))
+            scaling /= norm(err)
+            res = lbfgs(fun=self.gradient, x0=x0, info=info, nmax=nmax,
+                        ftol=ftol, gtol=gtol, scaling=scaling, kwargs=kwargs)
         else:
             res = least_squares(self.costfcn, x0, self.jacobian, method='lm',
                                 x_scale='jac', kwargs=kwargs)
@@ -449,6 +606,16 @@ class StateSpaceIdent():
         self._copy(*self.extract(ss))
         return err_rms
 
+def _jacobian_simulated(system, jac, x0, **kwargs):
+    """Jacobian at `x0`, simulating `x0` first if needed
+
+    The last simulation is not at `x0` if the step was simulated by a worker
+    of :func:`pyvib.common.lm`, or if the last step was rejected.
+    """
+    if not np.array_equal(x0, system.flatten()):
+        system.costfcn(x0, **kwargs)
+    return jac(x0, **kwargs)
+
 def costfcn_time(x0, system, weight=False):
     """Compute the vector of residuals such that the function to mimimize is
 
@@ -462,7 +629,6 @@ def costfcn_time(x0, system, weight=False):
     # p is the actual number of output in the signal, not the system output
     R, p, npp = system.signal.R, system.signal.p, system.signal.npp
     p = system.p
-    nfd = npp//2
     # without_T2 = system.without_T2
 
     # update the state space matrices from x0
@@ -482,13 +648,7 @@ def costfcn_time(x0, system, weight=False):
 
     err = y_mod - ym  #[without_T2, :p] - system.signal.ym[without_T2]
     if weight is not False and system.freq_weight:
-        err = err.reshape((npp,R,p),order='F').swapaxes(1,2)
-        # Select only the positive half of the spectrum
-        err = fft(err, axis=0)[:nfd]
-        err = mmul_weight(err, weight)
-        #cost = np.vdot(err, err).real
-        err = err.swapaxes(1,2).ravel(order='F')
-        err_w = np.hstack((err.real.squeeze(), err.imag.squeeze()))
+        err_w = freq_weight(err.ravel(order='F'), weight, npp, R, p)
     elif weight is not False:
         # TODO time domain weighting. Does not work
         err_w = err * weight  # [without_T2]
@@ -500,6 +660,48 @@ def costfcn_time(x0, system, weight=False):
 
     return err_w
 
+def freq_weight(err, weight, npp, R, p):
+    """Frequency weighting of a time domain error vector
+
+    The positive half of the spectrum of each realization is weighted, ie.
+    ``e_W(f) = W(f,:,:)*e(f)``, and the real and imaginary parts are stacked.
+
+    Parameters
+    ----------
+    err : ndarray(p*N)
+        Error ordered as ``err.ravel(order='F')`` for ``err`` of shape (N,p)
+    weight : ndarray(nfd,p,p)
+        Square inverse of the output covariance, see :func:`weightfcn`
+
+    Returns
+    -------
+    err_w : ndarray(2*nfd*R*p)
+    """
+    nfd = npp//2
+    err = err.reshape((npp,R,p),order='F').swapaxes(1,2)
+    # Select only the positive half of the spectrum
+    err = rfft(err, axis=0)[:nfd]
+    err = mmul_weight(err, weight)
+    err = err.swapaxes(1,2).ravel(order='F')
+    return np.hstack((err.real, err.imag))
+
+def freq_weight_adjoint(err_w, weight, npp, R, p):
+    """Adjoint (transpose) of :func:`freq_weight`
+
+    Needed for vector-Jacobian products of the weighted error. The transpose
+    of the truncated DFT is a zero padded inverse DFT times npp. The real
+    part of the inverse DFT of the positive half spectrum is the inverse real
+    DFT with the non-zero frequencies halved.
+    """
+    nfd = npp//2
+    L = nfd*R*p
+    err = err_w[:L] + 1j*err_w[L:]
+    err = err.reshape((nfd,R,p),order='F').swapaxes(1,2)
+    err = mmul_weight(err, weight.conj().swapaxes(1,2))
+    err[1:] /= 2
+    err = npp*irfft(err, n=npp, axis=0)
+    return err.swapaxes(1,2).ravel(order='F')
+
 def transient_indices_periodic(T1,N):
     """Computes indices for transient handling of periodic signals.
 
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+from copy import copy
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 from numpy import kron
 # qr(mode='r') returns r in economic form. This is not the case for scipy
@@ -9,10 +14,10 @@ from numpy.linalg import qr, solve, svd
 from scipy.linalg import logm, lstsq, norm, pinv
 from scipy.signal import dlsim
 
-from .common import (matrix_square_inv, mmul_weight, normalize_columns,
-                     weightfcn)
+from .common import (load_checkpoint, matrix_square_inv, mmul_weight,
+                     normalize_columns, save_checkpoint, weightfcn)
 from .helper.modal_plotting import plot_subspace_info, plot_subspace_model
-from .lti_conversion import is_stable, ss2frf
+from .lti_conversion import eig_resolvent, is_stable, ss2frf
 from .modal import modal_ac
 from .statespace import StateSpace, StateSpaceIdent
 
@@ -21,10 +26,25 @@ from .statespace import StateSpace, StateSpaceIdent
 
 class Subspace(StateSpace, StateSpaceIdent):
 
-    def __init__(self, signal, *system, **kwargs):
+    def __init__(self, signal, *system, frf_method='solve', **kwargs):
+        """Frequency-domain subspace identification
+
+        Parameters
+        ----------
+        frf_method : str {'solve', 'auto', 'eig', 'hess'}, optional
+            Evaluation of the FRF of the model in :meth:`costfcn`,
+            :meth:`estimate` and :meth:`plot_models`, see
+            :func:`~pyvib.lti_conversion.ss2frf`. 'auto' diagonalizes A
+            once per evaluation if A is well conditioned, which is faster for
+            many frequencies. Except for 'solve', this also applies to
+            :meth:`jacobian`, see :func:`jacobian_freq`.
+        """
         self.signal = signal
+        self.frf_method = frf_method
         kwargs['dt'] = 1/signal.fs
         super().__init__(*system, **kwargs)
+        # factorizations reused for all n, see :meth:`estimate`
+        self.cache = FactorizationCache()
 
     @property
     def weight(self):
@@ -43,15 +63,21 @@ class Subspace(StateSpace, StateSpaceIdent):
         return jacobian(x0, self, weight=weight)
 
     def estimate(self, n, r, weight=False, copy=False):
-        """Subspace estimation"""
+        """Subspace estimation
+
+        The factorization of the data matrices only depends on r and the
+        weighting, and is kept in :attr:`cache` for estimates with other n.
+        """
 
         self.n = n
         self.r = r
         signal = self.signal
         if weight is True:
             weight = signal.covG
+        fac = self.cache.get(signal.G, weight, signal.norm_freq, r)
         A, B, C, D, z, stable = \
-            subspace(signal.G, weight, signal.norm_freq, n, r)
+            subspace(signal.G, weight, signal.norm_freq, n, r, fac=fac,
+                     frf_method=self.frf_method)
 
         self.A, self.B, self.C, self.D, self.z, self.stable = \
             A, B, C, D, z, stable
@@ -59,23 +85,63 @@ class Subspace(StateSpace, StateSpaceIdent):
         return A, B, C, D, z, stable
 
     def scan(self, nvec, maxr, optimize=True, method=None, weight=False,
-             info=2, nmax=50, lamb=None, ftol=1e-8, xtol=1e-8, gtol=1e-8):
+             info=2, nmax=50, lamb=None, ftol=1e-8, xtol=1e-8, gtol=1e-8,
+             workers=None, checkpoint=None, resume=False):
+        """Scan the model orders n in `nvec` and r from n+1 to `maxr`
+
+        For each (n, r) a model is estimated and optionally optimized. The
+        best stable model for each n is saved in `models`.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of processes. The (n, r) jobs are distributed on a process
+            pool and the results are collected as they complete. The model,
+            including the FRF and its covariance, is sent once to each
+            worker. Default is to run serially.
+        checkpoint : str, optional
+            File name. `models` and `infodict` are saved after each job, see
+            :func:`~pyvib.common.save_checkpoint`.
+        resume : bool, optional
+            Continue a partial scan, skipping the (n, r) pairs already done.
+            The partial scan is read from `checkpoint` if the file exists,
+            otherwise the attributes `models` and `infodict`, which are
+            updated after each job, are used. If nothing is stored, the scan
+            starts from scratch.
+
+        Notes
+        -----
+        After the scan the model of the last (n, r) job is kept in A, B, C, D,
+        regardless of `workers`.
+
+        Returns
+        -------
+        models : dict
+            Best model for each n
+        infodict : dict of dict
+            Cost and stability for each n and r
+        """
 
-        F = self.signal.F
         nvec = np.atleast_1d(nvec)
         maxr = maxr
         if weight is True:
             weight = self.weight
 
-        infodict = {}
-        models = {}
+        models, infodict = {}, {}
+        if resume and checkpoint is not None and os.path.exists(checkpoint):
+            models, infodict = _scan_load(checkpoint)
+        elif resume:
+            models = getattr(self, 'models', None) or {}
+            infodict = getattr(self, 'infodict', None) or {}
+        self.models, self.infodict = models, infodict
+
         if info:
             print('Starting subspace scanning')
             print(f"n: {nvec.min()}-{nvec.max()}. r: {maxr}")
+        jobs = []
         for n in nvec:
             minr = n + 1
 
-            cost_old = np.inf
             if isinstance(maxr, (list, np.ndarray)):
                 rvec = maxr[maxr >= minr]
                 if len(rvec) == 0:
@@ -83,39 +149,88 @@ class Subspace(StateSpace, StateSpaceIdent):
             else:
                 rvec = range(minr, maxr+1)
 
-            infodict[n] = {}
-            for r in rvec:
+            infodict.setdefault(n, {})
+            jobs.extend((n, r) for r in rvec if r not in infodict[n])
+
+        opts = {'optimize': optimize, 'method': method, 'weight': weight,
+                'info': info, 'nmax': nmax, 'lamb': lamb, 'ftol': ftol,
+                'xtol': xtol, 'gtol': gtol}
+        if workers is None or workers <= 1:
+            for n, r in jobs:
                 if info:
                     print(f"n:{n:3d} | r:{r:3d}")
-
-                self.estimate(n, r)
-                # normalize with frequency lines to comply with matlab pnlss
-                cost_sub = self.cost(weight=weight)/F
-                stable_sub = self.stable
-
-                if optimize:
-                    self.optimize(method=method, weight=weight, info=info,
-                                  nmax=nmax, lamb=lamb, ftol=ftol, xtol=xtol,
-                                  gtol=gtol, copy=False)
-
-                cost = self.cost(weight=weight)/F
-                stable = is_stable(self.A, domain='z')
-                infodict[n][r] = {'cost_sub':cost_sub, 'stable_sub':stable_sub,
-                                  'cost': cost, 'stable': stable}
-                if cost < cost_old and stable:
-                    # TODO instead of dict of dict, maybe use __slots__ method
-                    # of class. Slots defines attributes names that are
-                    # reserved for the use as attributes for the instances of
-                    # the class.
-                    print(f"New best r: {r}")
-                    cost_old = cost
-                    models[n] = {'A': self.A, 'B': self.B, 'C': self.C, 'D':
-                                 self.D, 'r':r, 'cost':cost, 'stable': stable}
-
-            self.models = models
-            self.infodict = infodict
+                self._scan_collect(n, r, self._scan_job(n, r, **opts))
+                if checkpoint is not None:
+                    _scan_save(checkpoint, models, infodict)
+            return models, infodict
+
+        # the optimization output of the workers would be interleaved
+        opts['info'] = 0
+        # the workers only need the signal and the system. Each worker builds
+        # its own factorizations, so the cache is not sent
+        model = copy(self)
+        model.cache = FactorizationCache(self.cache.maxbytes)
+        model.models, model.infodict = None, None
+        with ProcessPoolExecutor(workers, initializer=_scan_init,
+                                 initargs=(model, opts)) as pool:
+            futures = {pool.submit(_scan_run, n, r): (n, r) for n, r in jobs}
+            for future in as_completed(futures):
+                n, r = futures[future]
+                res = future.result()
+                if info:
+                    print(f"n:{n:3d} | r:{r:3d} | cost: {res['cost']:12.8g}")
+                self._scan_collect(n, r, res)
+                if checkpoint is not None:
+                    _scan_save(checkpoint, models, infodict)
+                if (n, r) == jobs[-1]:
+                    last = res
+        if jobs:
+            # same final state as the serial scan
+            self.n, self.r = jobs[-1]
+            self.A, self.B, self.C, self.D, self.z = \
+                last['A'], last['B'], last['C'], last['D'], last['z']
+            self.stable = last['stable_sub']
         return models, infodict
 
+    def _scan_job(self, n, r, optimize, method, weight, info, nmax, lamb,
+                  ftol, xtol, gtol):
+        """Estimate and optimize one model of the scan"""
+        F = self.signal.F
+        self.estimate(n, r)
+        # normalize with frequency lines to comply with matlab pnlss
+        cost_sub = self.cost(weight=weight)/F
+        stable_sub = self.stable
+
+        if optimize:
+            self.optimize(method=method, weight=weight, info=info,
+                          nmax=nmax, lamb=lamb, ftol=ftol, xtol=xtol,
+                          gtol=gtol, copy=False)
+
+        cost = self.cost(weight=weight)/F
+        stable = is_stable(self.A, domain='z')
+        return {'cost_sub':cost_sub, 'stable_sub':stable_sub, 'cost': cost,
+                'stable': stable, 'A': self.A, 'B': self.B, 'C': self.C,
+                'D': self.D, 'z': self.z}
+
+    def _scan_collect(self, n, r, res):
+        """Save the result of one scan job in infodict and models"""
+        self.infodict[n][r] = {k: res[k] for k in
+                               ('cost_sub', 'stable_sub', 'cost', 'stable')}
+        best = self.models.get(n)
+        # the results arrive in any order. For equal cost the lowest r wins,
+        # as for a serial scan.
+        if res['stable'] and (best is None or res['cost'] < best['cost'] or
+                              (res['cost'] == best['cost'] and
+                               r < best['r'])):
+            # TODO instead of dict of dict, maybe use __slots__ method
+            # of class. Slots defines attributes names that are
+            # reserved for the use as attributes for the instances of
+            # the class.
+            print(f"New best r: {r}")
+            self.models[n] = {'A': res['A'], 'B': res['B'], 'C': res['C'],
+                              'D': res['D'], 'r':r, 'cost':res['cost'],
+                              'stable': res['stable']}
+
     def plot_info(self, fig=None, ax=None):
         """Plot summary of subspace identification"""
         return plot_subspace_info(self.infodict, fig, ax)
@@ -124,7 +239,7 @@ class Subspace(StateSpace, StateSpaceIdent):
         """Plot identified subspace models"""
         return plot_subspace_model(self.models, self.signal.G,
                                    self.signal.covG, self.signal.norm_freq,
-                                   self.signal.fs)
+                                   self.signal.fs, method=self.frf_method)
 
     def extract_model(self, y=None, u=None, models=None, n=None, t=None, x0=None):
         """extract the best model using validation data"""
@@ -151,7 +266,53 @@ class Subspace(StateSpace, StateSpaceIdent):
         return err_vec
 
 
-def jacobian_freq(A,B,C,z):
+# model and options used by the workers of Subspace.scan
+_scan_model = None
+_scan_opts = None
+
+def _scan_init(model, opts):
+    global _scan_model, _scan_opts
+    _scan_model, _scan_opts = model, opts
+
+def _scan_run(n, r):
+    return _scan_model._scan_job(n, r, **_scan_opts)
+
+_scan_info = ('cost_sub', 'stable_sub', 'cost', 'stable')
+
+def _scan_save(fname, models, infodict):
+    """Save a partial scan with :func:`~pyvib.common.save_checkpoint`
+
+    The nested dicts are flattened to arrays named ``info_<n>_<r>`` and
+    ``model_<n>_<key>``.
+    """
+    state = {}
+    for n, d in infodict.items():
+        for r, v in d.items():
+            state[f'info_{n}_{r}'] = np.array([v[k] for k in _scan_info],
+                                              dtype=float)
+    for n, m in models.items():
+        for k, v in m.items():
+            state[f'model_{n}_{k}'] = v
+    # keep the n without any finished r
+    state['nvec'] = np.array(list(infodict), dtype=int)
+    save_checkpoint(fname, **state)
+
+def _scan_load(fname):
+    """Load a partial scan saved by :func:`_scan_save`"""
+    state = load_checkpoint(fname)
+    models, infodict = {}, {n: {} for n in state.pop('nvec').tolist()}
+    for key, v in state.items():
+        name, n, k = key.split('_', 2)
+        n = int(n)
+        if name == 'info':
+            infodict.setdefault(n, {})[int(k)] = {
+                i: bool(x) if i.startswith('stable') else float(x)
+                for i, x in zip(_scan_info, v)}
+        else:
+            models.setdefault(n, {})[k] = v if v.ndim else v.item()
+    return models, infodict
+
+def jacobian_freq(A,B,C,z,method='solve'):
     """Compute Jacobians of the unweighted errors wrt. model parameters.
 
     Computes the Jacobians of the unweighted errors ``e(f) = Ĝ(f) - G(f)``
@@ -180,16 +341,21 @@ def jacobian_freq(A,B,C,z):
     z : ndarray(F)
         ``z = exp(2j*pi*freq)``, where freq is a vector of normalized
         frequencies at which the Jacobians are computed (0 < freq < 0.5)
+    method : str {'solve', 'eig'}, optional
+        'solve' solves ``(z(f)*I - A)`` for all frequencies in one batched
+        call. 'eig' diagonalizes A once, such that the resolvent is closed
+        form at each frequency. If A is defective, 'solve' is used.
 
     Returns
     -------
     JA : ndarray(F,p,m,n*n)
         JA(f,:,:,i) contains the partial derivative of the unweighted error
         e(f) at frequency f wrt. A(k,l)
-    JB : ndarray(p,m,n*m,F)
+    JB : ndarray(F,p,m,n*m)
         JB(f,:,:,i) contains the partial derivative of e(f) w.r.t. B(k,l)
-    JC : ndarray(p,m,p*n,F)
+    JC : ndarray(F,p,m,p*n)
         JC(f,:,:,i) contains the partial derivative of e(f) w.r.t. C(k,l)
+    JD : ndarray(F,p,m,p*m)
 
     Notes
     -----
@@ -202,50 +368,41 @@ def jacobian_freq(A,B,C,z):
     m = np.shape(B)[1]  # Number of inputs
     p = np.shape(C)[0]  # Number of outputs
 
-    JA = np.empty((F,p,m,n*n),dtype=complex)
-    JB = np.empty((F,p,m,n*m),dtype=complex)
-    JC = np.empty((F,p,m,n*p),dtype=complex)
-
-    # get rows and columns in A for a given index: A(i)=A(k(i),ell(i))
-    k, ell = np.unravel_index(np.arange(n**2), (n,n))
-    # Note that using inv(A) implicitly calls solve and creates an identity
-    # matrix. Thus it is faster to allocate In once and then call solve.
-    In = np.eye(n)
-    Im = np.eye(m)
-    Ip = np.eye(p)
-    # TODO must vectorize...
-    # see for calling lapack routines directly
-    # https://stackoverflow.com/a/11999063/1121523
-    # see for multicasting
-    # https://docs.scipy.org/doc/numpy/reference/routines.linalg.html#linear-algebra-on-several-matrices-at-once
-    for f in range(F):
-        temp1 = solve((z[f]*In - A),In)
+    # temp2 = C*(z(f)*I - A)^(-1) and temp3 = (z(f)*I - A)^(-1)*B for all
+    # frequencies at once.
+    eigA = eig_resolvent(A) if method == 'eig' else None
+    if eigA is None:
+        In = np.eye(n)
+        temp1 = solve(z[:,None,None]*In - A, np.broadcast_to(In, (F,n,n)))
         temp2 = C @ temp1
         temp3 = temp1 @ B
-
-        # Jacobian w.r.t. all elements in A, A(i)=A(k(i),ell(i))
-        # Note that the partial derivative of e(f) w.r.t. A(k(i),ell(i)) is
-        # equal to temp2*fOne(n,n,i)*temp3, and thus
-        # JA(:,:,i,f) = temp2(:,k(i))*temp3(ell(i),:)
-        for i in range(n**2): # Loop over all elements in A
-            JA[f,:,:,i] = np.outer(temp2[:,k[i]], temp3[ell[i],:])
-
-        # Jacobian w.r.t. all elements in B
-        # Note that the partial derivative of e(f) w.r.t. B(k,l) is equal to
-        # temp2*fOne(n,m,sub2ind([n m],k,l)), and thus
-        # JB(:,l,sub2ind([n m],k,l),f) = temp2(:,k)
-        JB[f] = np.reshape(kron(Im, temp2), (p,m,m*n))
-
-        # Jacobian w.r.t. all elements in C
-        # Note that the partial derivative of e(f) w.r.t. C(k,l) is equal to
-        # fOne(p,n,sub2ind([p n],k,l))*temp3, and thus
-        # JC(k,:,sub2ind([p n],k,l),f) = temp3(l,:)
-        JC[f] = np.reshape(kron(temp3.T, Ip), (p,m,n*p))
+    else:
+        # (z(f)*I - A)^(-1) = V*diag(1/(z(f) - λ))*V^(-1)
+        lam, V, Vinv = eigA
+        d = 1/(z[:,None] - lam)
+        temp2 = ((C @ V) * d[:,None,:]) @ Vinv
+        temp3 = V @ (d[:,:,None] * (Vinv @ B))
+
+    # Jacobian w.r.t. all elements in A, A(i)=A(k(i),ell(i))
+    # Note that the partial derivative of e(f) w.r.t. A(k(i),ell(i)) is
+    # equal to temp2*fOne(n,n,i)*temp3, and thus
+    # JA(f,:,:,i) = temp2(f,:,k(i))*temp3(f,ell(i),:)
+    JA = np.einsum('fik,flj->fijkl', temp2, temp3).reshape(F,p,m,n*n)
+
+    # Jacobian w.r.t. all elements in B
+    # Note that the partial derivative of e(f) w.r.t. B(k,l) is equal to
+    # temp2*fOne(n,m,sub2ind([n m],k,l)), and thus
+    # JB(f,:,l,sub2ind([n m],k,l)) = temp2(f,:,k)
+    JB = np.einsum('fik,jl->fijkl', temp2, np.eye(m)).reshape(F,p,m,n*m)
+
+    # Jacobian w.r.t. all elements in C
+    # Note that the partial derivative of e(f) w.r.t. C(k,l) is equal to
+    # fOne(p,n,sub2ind([p n],k,l))*temp3, and thus
+    # JC(f,k,:,sub2ind([p n],k,l)) = temp3(f,l,:)
+    JC = np.einsum('ik,flj->fijkl', np.eye(p), temp3).reshape(F,p,m,p*n)
 
     # JD does not change over iterations
-    JD = np.zeros((p,m,p*m))
-    for f in range(p*m):
-        np.put(JD[...,f], f, 1)
+    JD = np.einsum('ik,jl->ijkl', np.eye(p), np.eye(m)).reshape(p,m,p*m)
     JD = np.tile(JD, (F,1,1,1))
 
     return JA, JB, JC, JD
@@ -285,8 +442,153 @@ def modal_list(G, covG, freq, nvec, r, fs, U=None, Y=None):
 
     return md
 
+class Factorization():
+    """The part of the subspace estimate that does not depend on the order n
+
+    Constructs the data matrices for the given number of block rows `r`, and
+    computes the QR and SVD decompositions, step 1.a-h in :func:`subspace`,
+    and the weight used for the BD estimation. See :func:`subspace` for the
+    parameters.
+    """
+    def __init__(self, G, covG, freq, r, U=None, Y=None, bd_method='nr'):
+        # the data is kept to check the cache, see FactorizationCache
+        self.data = (G, covG, freq, U, Y)
+        self.r = r
+        self.bd_method = bd_method
+
+        # number of outputs/inputs and number of frequencies
+        # When using G as input, _m reflects that G is 3d: (F,p,m), ie U: (F,m)
+        if U is None and Y is None:
+            F,p,m = G.shape
+            is_frf = True
+            _m = m
+        else:
+            F = len(freq)
+            p = Y.shape[1]
+            m = U.shape[1]
+            is_frf = False
+            _m = 1
+
+        # 1.a. Construct Wr with z
+        z = np.exp(2j*np.pi*freq)
+        # if B,D is calculated explicit, we need an additional p and m rows in Gmat
+        # and Umat. See eq (30) in noel2013.
+        expl = 0
+        if bd_method == 'explicit':
+            expl = 1
+
+        Wr = (z[:,None]**np.arange(r+expl)).T
+        # 1.b. and 1.c. Construct Gmat and Umat
+        # The shape depends on the method, ie if Y,U or G is supplied
+        Gmat = np.empty(((r+expl)*p,F*_m), dtype=complex)
+        Umat = np.empty(((r+expl)*m,F*_m), dtype=complex)
+        if U is None and Y is None:
+            for f in range(F):
+                Gmat[:,f*m:(f+1)*m] = kron(Wr[:,f,None], G[f])
+                Umat[:,f*m:(f+1)*m] = kron(Wr[:,f,None], np.eye(m))
+        else:
+            for f in range(F):
+                Gmat[:,f] = kron(Wr[:,f], Y[f])
+                Umat[:,f] = kron(Wr[:,f], U[f])
+
+        # 1.e. and 1.f: split into real and imag part and stack into Z
+        # we do it in a memory efficient way and avoids intermediate memory copies.
+        # (Just so you know: It is more efficient to stack the result in a new
+        # memory location, than overwriting the old). Ie.
+        # Gre = np.hstack([Gmat.real, Gmat.imag]) is more efficient than
+        # Gmat = np.hstack([Gmat.real, Gmat.imag])
+        Z = np.empty(((r+expl)*(p+m), 2*F*_m))
+        Z[:(r+expl)*m,:F*_m] = Umat.real
+        Z[:(r+expl)*m,F*_m:] = Umat.imag
+        Z[(r+expl)*m:,:F*_m] = Gmat.real
+        Z[(r+expl)*m:,F*_m:] = Gmat.imag
+
+        # 1.f. Calculate CY from σ²_G
+        if covG is False or covG is None:
+            CY = np.eye(p*r)
+            # covG = np.tile(np.eye(p*m), (F,1,1))
+        else:
+            CY = np.zeros((p*r,p*r))
+            for f in range(F):
+                # Take sum over the diagonal blocks of cov(vec(H)) (see
+                # paduart2008(5-93))
+                temp = np.zeros((p,p),dtype=complex)
+                for i in range(m):
+                    temp += covG[f, i*p:(i+1)*p, i*p:(i+1)*p]
+                    CY += np.real(kron(np.outer(Wr[:r,f], Wr[:r,f].conj()),temp))
+
+        # 1.g. QR decomposition of Z.T, Z=R.T*Q.T, to eliminate U from Z.
+        R = qr(Z.T, mode='r')
+        RT = R.T
+        if bd_method == 'explicit':
+            RT22 = RT[-(r+1)*p:-p,-(r+1)*p:-p]
+        else:
+            RT22 = RT[-r*p:,-r*p:]
+
+        # 1.h. CY^(-1/2)*RT22=USV', Calculate CY^(-1/2) using svd decomp.
+        UC, sc, _ = svd(CY, full_matrices=False)
+
+        # it is faster to work on the diagonal scy, than the full matrix SCY
+        # Note: We work with real matrices here, thus UC.conj().T -> UC.T
+        sqrtCY = UC * np.sqrt(sc) @ UC.conj().T
+        invsqrtCY = UC * 1/np.sqrt(sc) @ UC.conj().T
+
+        # Remove noise. By taking svd of CY^(-1/2)*RT22
+        Un, sn, _ = svd(invsqrtCY @ RT22)  # , full_matrices=False)
+
+        # Compute weight used for the BD estimation, W = sqrt(σ²_G^-1)
+        weight = False
+        if covG is not False and covG is not None:
+            weight = np.zeros_like(covG)  # .transpose((2,0,1))
+            for f in range(F):
+                weight[f] = matrix_square_inv(covG[f])
+
+        self.p, self.m, self.z, self.RT = p, m, z, RT
+        self.sqrtCY, self.Un, self.sn, self.weight = sqrtCY, Un, sn, weight
+
+    @property
+    def nbytes(self):
+        arrs = (self.z, self.RT, self.sqrtCY, self.Un, self.sn, self.weight)
+        return sum(arr.nbytes for arr in arrs if arr is not False)
+
+class FactorizationCache():
+    """LRU cache of subspace factorizations, keyed by (r, weighting)
+
+    For fixed r, the factorization is the same for all model orders n, see
+    :class:`Factorization`. The least recently used factorizations are
+    evicted when the memory used exceeds `maxbytes`.
+    """
+    def __init__(self, maxbytes=2**28):
+        self.maxbytes = maxbytes
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def nbytes(self):
+        return sum(fac.nbytes for fac in self._cache.values())
+
+    def clear(self):
+        self._cache.clear()
+
+    def get(self, G, covG, freq, r, U=None, Y=None, bd_method='nr'):
+        """Return the factorization, computing it if not cached"""
+        key = (r, covG is not False and covG is not None, bd_method)
+        fac = self._cache.get(key)
+        # the data might have changed, fx. by a new call to Signal.bla
+        data = (G, covG, freq, U, Y)
+        if fac is None or any(a is not b for a, b in zip(fac.data, data)):
+            fac = Factorization(G, covG, freq, r, U, Y, bd_method)
+            self._cache[key] = fac
+        self._cache.move_to_end(key)
+        # evict the least recently used, but keep the one returned
+        while self.nbytes > self.maxbytes and len(self._cache) > 1:
+            self._cache.popitem(last=False)
+        return fac
+
 def subspace(G, covG, freq, n, r, U=None, Y=None, bd_method='nr',
-             modal=False):
+             modal=False, fac=None, frf_method='solve'):
     """Estimate state-space model from Frequency Response Function (or Matrix)
 
     The linear state-space model is estimated from samples of the frequency
@@ -312,6 +614,12 @@ def subspace(G, covG, freq, n, r, U=None, Y=None, bd_method='nr',
         Method used for BD estimation
     modal : bool {false}, optional
         Return
+    fac : Factorization, optional
+        The factorization of the data matrices for this `r`. It does not
+        depend on `n` and can be reused, see :class:`FactorizationCache`.
+    frf_method : str, optional
+        Evaluation of the FRF in the BD estimation, see
+        :func:`~pyvib.lti_conversion.ss2frf`
 
     Returns
     -------
@@ -374,85 +682,10 @@ def subspace(G, covG, freq, n, r, U=None, Y=None, bd_method='nr',
        systems. MSSP, doi:10.1016/j.ymssp.2013.06.034
 
     """
-    # number of outputs/inputs and number of frequencies
-    # When using G as input, _m reflects that G is 3d: (F,p,m), ie U: (F,m)
-    if U is None and Y is None:
-        F,p,m = G.shape
-        is_frf = True
-        _m = m
-    else:
-        F = len(freq)
-        p = Y.shape[1]
-        m = U.shape[1]
-        is_frf = False
-        _m = 1
-
-    # 1.a. Construct Wr with z
-    z = np.exp(2j*np.pi*freq)
-    # if B,D is calculated explicit, we need an additional p and m rows in Gmat
-    # and Umat. See eq (30) in noel2013.
-    expl = 0
-    if bd_method == 'explicit':
-        expl = 1
-
-    Wr = (z[:,None]**np.arange(r+expl)).T
-    # 1.b. and 1.c. Construct Gmat and Umat
-    # The shape depends on the method, ie if Y,U or G is supplied
-    Gmat = np.empty(((r+expl)*p,F*_m), dtype=complex)
-    Umat = np.empty(((r+expl)*m,F*_m), dtype=complex)
-    if U is None and Y is None:
-        for f in range(F):
-            Gmat[:,f*m:(f+1)*m] = kron(Wr[:,f,None], G[f])
-            Umat[:,f*m:(f+1)*m] = kron(Wr[:,f,None], np.eye(m))
-    else:
-        for f in range(F):
-            Gmat[:,f] = kron(Wr[:,f], Y[f])
-            Umat[:,f] = kron(Wr[:,f], U[f])
-
-    # 1.e. and 1.f: split into real and imag part and stack into Z
-    # we do it in a memory efficient way and avoids intermediate memory copies.
-    # (Just so you know: It is more efficient to stack the result in a new
-    # memory location, than overwriting the old). Ie.
-    # Gre = np.hstack([Gmat.real, Gmat.imag]) is more efficient than
-    # Gmat = np.hstack([Gmat.real, Gmat.imag])
-    Z = np.empty(((r+expl)*(p+m), 2*F*_m))
-    Z[:(r+expl)*m,:F*_m] = Umat.real
-    Z[:(r+expl)*m,F*_m:] = Umat.imag
-    Z[(r+expl)*m:,:F*_m] = Gmat.real
-    Z[(r+expl)*m:,F*_m:] = Gmat.imag
-
-    # 1.f. Calculate CY from σ²_G
-    if covG is False or covG is None:
-        CY = np.eye(p*r)
-        # covG = np.tile(np.eye(p*m), (F,1,1))
-    else:
-        CY = np.zeros((p*r,p*r))
-        for f in range(F):
-            # Take sum over the diagonal blocks of cov(vec(H)) (see
-            # paduart2008(5-93))
-            temp = np.zeros((p,p),dtype=complex)
-            for i in range(m):
-                temp += covG[f, i*p:(i+1)*p, i*p:(i+1)*p]
-                CY += np.real(kron(np.outer(Wr[:r,f], Wr[:r,f].conj()),temp))
-
-    # 1.g. QR decomposition of Z.T, Z=R.T*Q.T, to eliminate U from Z.
-    R = qr(Z.T, mode='r')
-    RT = R.T
-    if bd_method == 'explicit':
-        RT22 = RT[-(r+1)*p:-p,-(r+1)*p:-p]
-    else:
-        RT22 = RT[-r*p:,-r*p:]
-
-    # 1.h. CY^(-1/2)*RT22=USV', Calculate CY^(-1/2) using svd decomp.
-    UC, sc, _ = svd(CY, full_matrices=False)
-
-    # it is faster to work on the diagonal scy, than the full matrix SCY
-    # Note: We work with real matrices here, thus UC.conj().T -> UC.T
-    sqrtCY = UC * np.sqrt(sc) @ UC.conj().T
-    invsqrtCY = UC * 1/np.sqrt(sc) @ UC.conj().T
-
-    # Remove noise. By taking svd of CY^(-1/2)*RT22
-    Un, sn, _ = svd(invsqrtCY @ RT22)  # , full_matrices=False)
+    if fac is None:
+        fac = Factorization(G, covG, freq, r, U, Y, bd_method)
+    p, m, z, RT = fac.p, fac.m, fac.z, fac.RT
+    sqrtCY, Un, sn, weight = fac.sqrtCY, fac.Un, fac.sn, fac.weight
 
     if modal:
         # in case we want to calculate A, C for different n's
@@ -475,17 +708,10 @@ def subspace(G, covG, freq, n, r, U=None, Y=None, bd_method='nr',
     #     Or[j*p:(j+1)*p,:] = Or[(j-1)*p:j*p,:] @ A
 
     # 3. Estimate B and D given A,C and H: (W)LS estimate
-    # Compute weight, W = sqrt(σ²_G^-1)
-    weight = False
-    if covG is not False and covG is not None:
-        weight = np.zeros_like(covG)  # .transpose((2,0,1))
-        for f in range(F):
-            weight[f] = matrix_square_inv(covG[f])
-
     if bd_method == 'explicit':
         B, D = bd_explicit(A,C,Or,n,r,m,p,RT)
     else:  # bd_method == 'nr':
-        B, D = bd_nr(A,C,G,freq,n,r,m,p,U,Y,weight)
+        B, D = bd_nr(A,C,G,freq,n,r,m,p,U,Y,weight,frf_method)
 
     # Check stability of the estimated model
     isstable = is_stable(A)
@@ -557,7 +783,7 @@ def bd_explicit(A,C,Or,n,r,m,p,RT):
 
     return B, D
 
-def bd_nr(A,C,G,freq,n,r,m,p,U=None,Y=None,weight=False):
+def bd_nr(A,C,G,freq,n,r,m,p,U=None,Y=None,weight=False,frf_method='solve'):
     """Estimate B, D using transfer function-based optimization
     (Newton-Raphson iterations)
 
@@ -570,7 +796,8 @@ def bd_nr(A,C,G,freq,n,r,m,p,U=None,Y=None,weight=False):
         if U is None and Y is None:
             cost = frf_costfcn(theta, G, weight)
         else:
-            cost = output_costfcn(theta,A,C,n,m,p,freq,U,Y,weight)
+            cost = output_costfcn(theta,A,C,n,m,p,freq,U,Y,weight,
+                                  frf_method)
         jac = frf_jacobian(theta,A,C,n,m,p,freq,U,weight)
 
         # Normalize columns of Jacobian with their rms value. Might increase
@@ -650,7 +877,7 @@ def frf_jacobian(x0,A,C,n,m,p,freq,U=None,weight=False):
 
     return jac
 
-def output_costfcn(x0,A,C,n,m,p,freq,U,Y,weight):
+def output_costfcn(x0,A,C,n,m,p,freq,U,Y,weight,frf_method='solve'):
     """Compute the cost, e = W*(Ŷ - Y)
 
     Ĝ(f) = C*inv(z(f)*I - A)*B + D and W = 1/σ_G.
@@ -659,7 +886,7 @@ def output_costfcn(x0,A,C,n,m,p,freq,U,Y,weight):
     B = x0[:n*m].reshape(n,m)
     D = x0[n*m:m*(n+p)].reshape(p,m)
 
-    Gss = ss2frf(A,B,C,D,freq)
+    Gss = ss2frf(A,B,C,D,freq,method=frf_method)
     Gss = np.random.rand(*Gss.shape)
     # fast way of doing: Ymodel[f] = U[f] @ Gss[f].T
     Ymodel = np.einsum('ij,ilj->il',U,Gss)
@@ -678,7 +905,9 @@ def jacobian(x0, system, weight=False):
     F = len(system.z)
 
     A, B, C, D = system.extract(x0)
-    JA, JB, JC, JD = jacobian_freq(A,B,C,system.z)
+    # jacobian_freq falls back to 'solve' if A is ill-conditioned
+    method = 'solve' if system.frf_method == 'solve' else 'eig'
+    JA, JB, JC, JD = jacobian_freq(A,B,C,system.z,method=method)
 
     tmp = np.empty((F,p,m,npar),dtype=complex)
     tmp[...,:n**2] = JA
@@ -709,7 +938,7 @@ def costfcn(x0, system, weight=False):
     A, B, C, D = system.extract(x0)
 
     # frf of the state space model
-    Gss = ss2frf(A,B,C,D,system.signal.norm_freq)
+    Gss = ss2frf(A,B,C,D,system.signal.norm_freq,method=system.frf_method)
     err = Gss - system.signal.G
     if weight is not False:
         err = mmul_weight(err, weight)
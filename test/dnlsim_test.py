@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyvib.fnsi import FNSI
+from pyvib.kernels import HAS_NUMBA
+from pyvib.pnlss import PNLSS
+from pyvib.signal import Signal
+
+"""Compare the simulation engines of pnlss.dnlsim against the reference loop.
+
+The engines evaluate the monomials and the state update in a different order,
+so the results agree to rounding errors.
+"""
+
+A = np.array([[0.73915535, -0.62433133],[0.6247377, 0.7364469]])
+B = np.array([[0.79287245], [-0.34515159]])
+C = np.array([[0.71165154, 0.34917771]])
+D = np.array([[0.04498052]])
+
+
+def get_model(xdegree=[2,3], ydegree=[2,3]):
+    np.random.seed(10)
+    model = PNLSS(A, B, C, D)
+    model.nlterms('x', xdegree, 'full')
+    model.nlterms('y', ydegree, 'full')
+    model.E = 0.1*np.random.randn(*model.E.shape)
+    model.F = 0.1*np.random.randn(*model.F.shape)
+    return model
+
+def engines():
+    return ['numpy', 'numba'] if HAS_NUMBA else ['numpy']
+
+def test_engines():
+    u = 0.05*np.random.RandomState(0).randn(2000)
+    for xdegree, ydegree in [([2,3], [2,3]), ([3], [2]), ([2,3,4], [3])]:
+        model = get_model(xdegree, ydegree)
+        _, yref, xref = model.simulate(u, engine='loop')
+        for engine in engines():
+            _, y, x = model.simulate(u, engine=engine)
+            npt.assert_allclose(y, yref, rtol=1e-12, atol=1e-14)
+            npt.assert_allclose(x, xref, rtol=1e-12, atol=1e-14)
+
+def test_engines_transient():
+    npp, R = 256, 2
+    u = 0.05*np.random.RandomState(1).randn(npp*R)
+    T1 = np.r_[npp, np.r_[0:(R-1)*npp+1:npp]]
+    model = get_model()
+    _, yref, _ = model.simulate(u, T1=T1, engine='loop')
+    for engine in engines():
+        _, y, _ = model.simulate(u, T1=T1, engine=engine)
+        npt.assert_allclose(y, yref, rtol=1e-12, atol=1e-14)
+
+def test_batch():
+    R, npp = 3, 256
+    u = 0.05*np.random.RandomState(2).randn(R, npp, 1)
+    model = get_model()
+    yref = np.array([model.simulate(u[r], engine='loop')[1] for r in range(R)])
+    for engine in engines():
+        y, _ = model.output_batch(u, engine=engine)
+        npt.assert_allclose(y, yref, rtol=1e-12, atol=1e-14)
+
+    # several parameter vectors
+    x0 = model.flatten()
+    x1 = x0.copy()
+    x1[-model.npar//2:] *= 0.5
+    y, _ = model.output_batch(u, params=np.vstack((x0, x1)))
+    npt.assert_allclose(y[0], yref, rtol=1e-12, atol=1e-14)
+    npt.assert_allclose(model.flatten(), x0)
+    model._copy(*model.extract(x1))
+    npt.assert_allclose(y[1], model.output_batch(u)[0], rtol=1e-12, atol=1e-14)
+
+def test_fnsi_batch():
+    R, npp = 3, 256
+    rng = np.random.RandomState(3)
+    u = 0.05*rng.randn(R, npp, 1)
+    ur = u.transpose(1,2,0)[...,None]
+    model = FNSI(Signal(ur, ur, fs=1), A, B, C, D)
+    model.nlterms('x', [[2],[3]])
+    model.E = 0.1*rng.randn(*model.E.shape)
+    yref = np.array([model.simulate(u[r])[1] for r in range(R)])
+    for engine in ['auto', 'numpy', 'loop']:
+        y, _ = model.output_batch(u, engine=engine)
+        npt.assert_allclose(y, yref, rtol=1e-12, atol=1e-14)
+    for engine in ['numba', 'fortran']:
+        with pytest.raises((ValueError, ImportError)):
+            model.output_batch(u, engine=engine)
+
+    # the engine is forwarded by simulate as for PNLSS. One period of
+    # transient is prepended to each realization.
+    T1 = np.r_[npp, np.r_[0:(R-1)*npp+1:npp]]
+    _, y, _ = model.simulate(u.reshape(-1,1), T1=T1, batch=True,
+                             engine='auto')
+    yref = np.array([model.simulate(np.tile(u[r], (2,1)))[1][npp:]
+                     for r in range(R)])
+    npt.assert_allclose(y, yref.reshape(-1,1), rtol=1e-12, atol=1e-14)
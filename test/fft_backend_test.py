@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyvib import fft_backend
+from pyvib.hb.hbcommon import fft_coeff, ifft_coeff
+
+"""Compare the FFT backends against numpy.fft."""
+
+
+@pytest.fixture
+def backends():
+    backend = fft_backend.get_backend()
+    names = ['numpy', 'scipy'] + (['pyfftw'] if fft_backend.HAS_PYFFTW else [])
+    yield names
+    fft_backend.set_backend(*backend)
+
+def test_backends(backends):
+    x = np.random.RandomState(0).randn(65, 3)
+    lines = np.arange(1, 20)
+    for backend in backends:
+        fft_backend.set_backend(backend, workers=-1)
+        npt.assert_allclose(fft_backend.fft_lines(x, lines),
+                            np.fft.fft(x, axis=0)[lines], atol=1e-12)
+        X = fft_backend.rfft(x, axis=0)
+        npt.assert_allclose(fft_backend.irfft(X, n=65, axis=0), x,
+                            atol=1e-12)
+
+def test_hb_coeff():
+    # fft_coeff is the inverse of ifft_coeff
+    n, nt, NH = 2, 32, 5
+    z = np.random.RandomState(1).randn(n*(2*NH+1))
+    npt.assert_allclose(fft_coeff(ifft_coeff(z, n, nt, NH), NH), z,
+                        atol=1e-12)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+
+from pyvib.frf import (StreamingBLA, StreamingCovariance, bla_periodic,
+                       bla_stream, covariance)
+
+"""Compare the BLA of periodic data against a loop over frequencies and
+experiment blocks."""
+
+
+def get_spectra(m=2, p=3, R=6, P=4, F=5):
+    rng = np.random.RandomState(0)
+    def rnd(*shape):
+        return rng.randn(*shape) + 1j*rng.randn(*shape)
+    return rnd(m,R,P,F), rnd(p,R,P,F)
+
+def bla_loop(U, Y):
+    m, R, P, F = U.shape
+    p = Y.shape[0]
+    M = R//m
+    # block k holds the realizations k, k+M, ..., k+(m-1)M
+    U = U.reshape(m,m,M,P,F)
+    Y = Y.reshape(p,m,M,P,F)
+    G = np.empty((p,m,F), dtype=complex)
+    covG = np.empty((p*m,p*m,F), dtype=complex)
+    covGn = np.zeros((p*m,p*m,F), dtype=complex)
+    for f in range(F):
+        Um = U[...,f].mean(3)
+        Ym = Y[...,f].mean(3)
+        Gm = [Ym[:,:,k] @ np.linalg.inv(Um[:,:,k]) for k in range(M)]
+        G[...,f] = np.mean(Gm, axis=0)
+        NG = [(Gk - G[...,f]).ravel(order='F') for Gk in Gm]
+        if M > 1:
+            covG[...,f] = sum(np.outer(v, v.conj()) for v in NG) / M/(M-1)
+        for k in range(M):
+            Uinv = np.linalg.inv(Um[:,:,k])
+            A = np.kron(Uinv.T, np.eye(p))
+            B = -np.kron(Uinv.T, Gm[k])
+            for i in range(P):
+                NU = (U[:,:,k,i,f] - Um[:,:,k]).ravel(order='F')
+                NY = (Y[:,:,k,i,f] - Ym[:,:,k]).ravel(order='F')
+                v = A @ NY + B @ NU
+                covGn[...,f] += np.outer(v, v.conj()) / max(P-1,1)/P/M**2
+    return G, covG, covGn
+
+def test_bla_periodic():
+    U, Y = get_spectra()
+    ref = bla_loop(U, Y)
+    for chunk in [None, 2]:
+        for a, b in zip(bla_periodic(U, Y, chunk=chunk), ref):
+            npt.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+
+    # only one period and one experiment block
+    U, Y = get_spectra(R=2, P=1)
+    G, covG, covGn = bla_periodic(U, Y)
+    assert covG is None and covGn is None
+    npt.assert_allclose(G, bla_loop(U, Y)[0])
+
+def test_streaming_bla():
+    rng = np.random.RandomState(1)
+    npp, p, R, P = 64, 2, 3, 4
+    lines = np.arange(1, 20)
+    u = rng.randn(npp,1,R,P)
+    y = rng.randn(npp,p,R,P)
+    U = np.fft.fft(u, axis=0)[lines].transpose((1,2,3,0))
+    Y = np.fft.fft(y, axis=0)[lines].transpose((1,2,3,0))
+    ref = bla_periodic(U, Y)
+
+    # one period at a time
+    bla = StreamingBLA(lines, 1, p)
+    for r in range(R):
+        for i in range(P):
+            bla.add(u[:,:,r,i], y[:,:,r,i])
+        bla.next_realization()
+    for a, b in zip(bla.result(), ref):
+        npt.assert_allclose(a, b.transpose((2,0,1)), rtol=1e-10, atol=1e-12)
+
+    # all periods of a realization at a time
+    res = bla_stream(((u[:,:,r], y[:,:,r]) for r in range(R)), lines, 1, p)
+    for a, b in zip(res, ref):
+        npt.assert_allclose(a, b.transpose((2,0,1)), rtol=1e-10, atol=1e-12)
+
+def test_bla_periodic_grouping():
+    # MIMO regression test: block k holds every M'th realization
+    m, p, R, P, F = 2, 1, 4, 3, 2
+    U, Y = get_spectra(m=m, p=p, R=R, P=P, F=F)
+    G, covG, _ = bla_periodic(U, Y)
+    Gm = [Y[:,[k,k+2]].mean(2)[...,f] @
+          np.linalg.inv(U[:,[k,k+2]].mean(2)[...,f])
+          for f in range(F) for k in range(2)]
+    Gm = np.array(Gm).reshape(F,2,p,m)
+    npt.assert_allclose(G, Gm.mean(1).transpose((1,2,0)), rtol=1e-12)
+
+def test_streaming_bla_mimo():
+    rng = np.random.RandomState(3)
+    npp, m, p, R, P = 64, 2, 2, 6, 4
+    lines = np.arange(1, 20)
+    u = rng.randn(npp,m,R,P)
+    y = rng.randn(npp,p,R,P)
+    U = np.fft.fft(u, axis=0)[lines].transpose((1,2,3,0))
+    Y = np.fft.fft(y, axis=0)[lines].transpose((1,2,3,0))
+    ref = bla_periodic(U, Y)
+
+    # The streaming BLA uses the same blocks and keeps the cross-covariances
+    # between the experiments of a block, thus it equals bla_periodic up to
+    # round-off.
+    bla = StreamingBLA(lines, m, p, R)
+    for r in range(R):
+        bla.add(u[:,:,r,:1], y[:,:,r,:1])
+        bla.add(u[:,:,r,1:], y[:,:,r,1:])
+        bla.next_realization()
+    assert bla.M == R//m
+    for a, b in zip(bla.result(), ref):
+        npt.assert_allclose(a, b.transpose((2,0,1)), rtol=1e-10, atol=1e-12)
+
+    res = bla_stream(((u[:,:,r], y[:,:,r]) for r in range(R)), lines, m, p,
+                     R)
+    for a, b in zip(res, ref):
+        npt.assert_allclose(a, b.transpose((2,0,1)), rtol=1e-10, atol=1e-12)
+
+    with npt.assert_raises(ValueError):
+        StreamingBLA(lines, m, p)
+
+def test_covariance():
+    npp, p, R, P = 65, 2, 3, 5
+    y = np.random.RandomState(2).randn(npp,p,R,P)
+    Y = np.fft.fft(y, axis=0)[:npp//2]
+    NY = Y - Y.mean(3, keepdims=True)
+    ref = np.zeros((npp//2,p,p), dtype=complex)
+    for f in range(npp//2):
+        for r in range(R):
+            ref[f] += (NY[f,:,r] @ NY[f,:,r].conj().T).T / (P-1)/P/R
+    npt.assert_allclose(covariance(y), ref, rtol=1e-10, atol=1e-10)
+
+    # running covariance, periods added in chunks of uneven length
+    cov = StreamingCovariance(npp, p, R)
+    cov.add(y[...,0])
+    cov.add(y[...,1:])
+    npt.assert_allclose(cov.covY, ref, rtol=1e-10, atol=1e-10)
+    npt.assert_allclose(covariance(y, chunk=2), ref, rtol=1e-10, atol=1e-10)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+from numpy.linalg import norm
+from scipy.sparse import diags
+
+from pyvib.forcing import sineForce, toMDOF
+from pyvib.hb.hb import HB
+from pyvib.hb.hbcommon import fft_coeff, hb_basis, hb_project
+from pyvib.nlforce import NL_force, NL_polynomial
+
+"""Harmonic balance of a 2DOF system with cubic springs to ground."""
+
+M = np.eye(2)
+C = 0.1*np.eye(2)
+K = np.array([[6, -5], [-5, 6]])
+inl = np.array([[0,-1], [1,-1]])
+enl = np.array([3,3,2,2])
+knl = np.array([1, 1])
+
+
+def get_hb(**kwargs):
+    nl = NL_force(NL_polynomial(inl, enl, knl))
+    return HB(M, C, K, nl, NH=3, npow2=6, anim=False, stability=False,
+              amp0=1e-4, **kwargs)
+
+def test_hjac():
+    omega = 0.6
+    hb = get_hb()
+    hb.periodic(omega/2/np.pi, 2, 0)
+    A = hb.assembleA(omega)
+    u, _ = sineForce(2, omega=omega, t=hb.assemblet(omega))
+    force = toMDOF(u, hb.n, 0)
+    z = np.random.RandomState(0).randn(hb.nz)
+    J = hb.hjac(z, A)
+
+    # finite differences of h(z)
+    h = 1e-6
+    H0 = hb.state_sys(z, A, force)
+    Jfd = np.array([(hb.state_sys(z + h*e, A, force) - H0)/h
+                    for e in np.eye(hb.nz)]).T
+    npt.assert_allclose(J, Jfd, atol=1e-4)
+    # Γ is only formed for jac='lsmr'
+    assert hb._basis is None
+    hb.jac = 'lsmr'
+    npt.assert_allclose(J, hb.hjac(z, A), atol=1e-12)
+    assert hb._basis.shape == (hb.nt*hb.n, hb.nz)
+
+def test_condense():
+    # chain with a cubic spring to ground at the last DOF
+    n = 5
+    K = 2*np.eye(n) - np.eye(n, k=1) - np.eye(n, k=-1)
+    C = 0.05*K + 0.02*np.eye(n)
+    z = []
+    for condense in [False, True]:
+        nl = NL_force(NL_polynomial(np.array([[n-1,-1]]), np.array([3,3]),
+                                    np.array([1])))
+        hb = HB(np.eye(n), C, K, nl, NH=5, npow2=7, anim=False,
+                stability=False, amp0=1e-3, condense=condense)
+        z.append(hb.periodic(0.05, 0.3, 0)[1])
+    assert hb.cond.nz == 11
+    npt.assert_allclose(z[1], z[0], atol=1e-12)
+
+def test_condense_continuation():
+    # the chain of test_condense with less damping, through the two folds
+    n, f_amp = 5, 0.2
+    K = 2*np.eye(n) - np.eye(n, k=1) - np.eye(n, k=-1)
+    C = 0.01*(K + np.eye(n))
+    nl = NL_force(NL_polynomial(np.array([[n-1,-1]]), np.array([3,3]),
+                                np.array([1])))
+    hb = HB(np.eye(n), C, K, nl, NH=5, npow2=7, anim=False, stability=True,
+            amp0=1e-3, condense=True)
+    hb.periodic(0.3/2/np.pi, f_amp, 0)
+    hb.continuation(0.3, 0.8, step=0.01, step_min=0.001, step_max=0.1,
+                    it_cont_max=200)
+    # the recovered coefficients of all DOFs solve the full HB equations
+    for omega, z in zip(hb.omega_vec, hb.z_vec):
+        A = hb.assembleA(omega)
+        u, _ = sineForce(f_amp, omega=omega, t=hb.assemblet(omega))
+        H = hb.state_sys(z, A, toMDOF(u, n, 0))
+        assert norm(H) < hb.tol_NR
+    # the branch between the folds, where ω decreases, is unstable
+    stab = np.array(hb.stab_vec)
+    inc = np.diff(hb.omega_vec) > 0
+    assert not stab.all() and stab[0] and stab[-1]
+    assert np.sum(stab[1:] != inc) <= 2
+
+def test_sparse():
+    res = []
+    for sparse in [False, True]:
+        hb = get_hb(sparse=sparse)
+        hb.stability = True
+        hb.periodic(0.6/2/np.pi, 2, 0)
+        hb.continuation(0.5, 1, step=0.01, step_min=0.001, step_max=0.05,
+                        it_cont_max=5)
+        res.append(hb)
+    npt.assert_allclose(res[1].z_vec, res[0].z_vec, atol=1e-12)
+    assert res[1].stab_vec == res[0].stab_vec
+
+def test_sparse_large():
+    # 500 DOFs, nz = 5500. The dense Hills matrix would be (11000, 11000)
+    n, f_amp = 500, 0.1
+    K = diags([-np.ones(n-1), 2*np.ones(n), -np.ones(n-1)], [-1,0,1])
+    C = 0.01*K + 0.001*diags(np.ones(n))
+    nl = NL_force(NL_polynomial(np.array([[n-1,-1]]), np.array([3,3]),
+                                np.array([1])))
+    hb = HB(diags(np.ones(n)), C, K, nl, NH=5, npow2=6, anim=False,
+            stability=False, amp0=1e-3, sparse=True)
+    hb.periodic(0.03/2/np.pi, f_amp, 0)
+    hb.continuation(0.03, 0.2, step=0.01, step_min=0.001, step_max=0.05,
+                    it_cont_max=10)
+    assert len(hb.z_vec) == 11 and hb.stab_vec == []
+    for omega, z in zip(hb.omega_vec, hb.z_vec):
+        A = hb.assembleA(omega)
+        u, _ = sineForce(f_amp, omega=omega, t=hb.assemblet(omega))
+        H = hb.state_sys(z, A, toMDOF(u, n, 0))
+        assert norm(H) / norm(z) < hb.tol_NR
+
+def test_basis():
+    n, NH, nt = 3, 4, 32
+    x = np.random.RandomState(1).randn(n, nt)
+    G = hb_basis(n, NH, nt).toarray()
+    z = hb_project(x, NH)
+    npt.assert_allclose(z, np.linalg.lstsq(G, x.T.ravel(), rcond=None)[0],
+                        atol=1e-12)
+    npt.assert_allclose(z, fft_coeff(x, NH), atol=1e-12)
+
+def test_adaptive():
+    hb = get_hb()
+    hb.stability = True
+    hb.periodic(0.6/2/np.pi, 2, 0)
+    hb.continuation(0.5, 1.5, step=0.05, step_min=0.001, step_max=0.1,
+                    it_cont_max=40, adapt={'tol_harm': 1e-4})
+    NH = [(len(z)//hb.n - 1)//2 for z in hb.z_vec]
+    # more harmonics around the resonance, fewer after
+    assert NH[0] == 3 and max(NH) > 4 and NH[-1] < max(NH)
+    t, omega, z, cnorm, *_ = hb.get_components(hb.omega_vec[-1],
+                                               hb.z_vec[-1])
+    assert cnorm.shape == (hb.n, NH[-1] + 1)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from pyvib.fnsi import FNSI
+from pyvib.kernels import HAS_NUMBA
+from pyvib.pnlss import PNLSS, element_jacobian, linearize
+from pyvib.signal import Signal
+
+"""Compare the matrix-free Jacobian of PNLSS and FNSI against the full
+Jacobian."""
+
+A = np.array([[0.73915535, -0.62433133],[0.6247377, 0.7364469]])
+B = np.array([[0.79287245], [-0.34515159]])
+C = np.array([[0.71165154, 0.34917771]])
+D = np.array([[0.04498052]])
+
+
+def get_model(npp=256, R=3, P=2):
+    rng = np.random.RandomState(10)
+    model = PNLSS(A, B, C, D)
+    model.nlterms('x', [2,3], 'full')
+    model.nlterms('y', [2,3], 'full')
+    model.E = 0.1*rng.randn(*model.E.shape)
+    model.F = 0.1*rng.randn(*model.F.shape)
+
+    # periodic data, equal periods
+    u = 0.05*rng.randn(npp,1,R,1).repeat(P, axis=3)
+    T1 = np.r_[npp, np.r_[0:(R-1)*P*npp+1:P*npp]]
+    _, y, _ = model.simulate(u.transpose(2,3,0,1).ravel(), T1=T1)
+    y = y.reshape(R,P,npp).transpose(2,0,1)[:,None]
+    y += 1e-4*rng.randn(*y.shape)
+    sig = Signal(u, y, fs=1)
+    sig.lines = np.arange(1,npp//2)
+    sig.average()
+
+    model.signal = sig
+    model.transient(T1=np.r_[npp, np.r_[0:(R-1)*npp+1:npp]])
+    return model
+
+def engines():
+    return ['numpy', 'numba'] if HAS_NUMBA else ['numpy']
+
+@pytest.mark.parametrize('engine', ['numba', 'numpy', 'loop'])
+def test_jacobian_engines(engine):
+    if engine == 'numba' and not HAS_NUMBA:
+        pytest.skip('numba is not installed')
+    model = get_model()
+    x0 = model.flatten()
+    n, m = model.n, model.m
+    for freq_weight in [False, True]:
+        model.freq_weight = freq_weight
+        weight = model.weight if freq_weight else False
+        model.costfcn(x0, weight=weight)
+        ref = model.jacobian(x0, weight=weight, engine='loop')
+        npt.assert_allclose(model.jacobian(x0, weight=weight, engine=engine),
+                            ref, rtol=1e-12, atol=1e-12*np.abs(ref).max())
+
+    x_trans, u_trans, zeta, _, A_Edwdx, C_Fdwdx = \
+        linearize(model, model.A, model.C, model.E, model.F)
+    for samples, active in [(x_trans, np.arange(n**2)),
+                            (u_trans, np.arange(n*m)),
+                            (zeta, model.xactive)]:
+        ref = element_jacobian(samples, A_Edwdx, C_Fdwdx, active, 'loop')
+        J = element_jacobian(samples, A_Edwdx, C_Fdwdx, active, engine)
+        npt.assert_allclose(J, ref, rtol=1e-12, atol=1e-12*np.abs(ref).max())
+
+def test_jacobian_operator():
+    model = get_model()
+    x0 = model.flatten()
+    rng = np.random.RandomState(0)
+    for freq_weight in [False, True]:
+        model.freq_weight = freq_weight
+        weight = model.weight if freq_weight else False
+        model.costfcn(x0, weight=weight)
+        jac = model.jacobian(x0, weight=weight)
+        v = rng.randn(jac.shape[1])
+        e = rng.randn(jac.shape[0])
+        for engine in engines():
+            op = model.jacobian_operator(x0, weight=weight, engine=engine)
+            assert op.shape == jac.shape
+            npt.assert_allclose(op.matvec(v), jac @ v, rtol=1e-10,
+                                atol=1e-12*np.abs(jac @ v).max())
+            npt.assert_allclose(op.rmatvec(e), e @ jac, rtol=1e-10,
+                                atol=1e-12*np.abs(e @ jac).max())
+
+def test_optimize_matfree():
+    model = get_model()
+    model.E *= 0.5
+    x0 = model.flatten()
+    # the first step is the same; later the column scaling differs.
+    model.optimize(weight=False, nmax=1, info=0)
+    x1 = model.flatten()
+    model._copy(*model.extract(x0))
+    model.optimize(weight=False, nmax=1, info=0, matfree=True)
+    npt.assert_allclose(model.flatten(), x1, rtol=1e-6, atol=1e-9)
+
+def test_fnsi_jacobian_operator():
+    model = get_model()
+    fnsi = FNSI(model.signal, A, B, C, D)
+    fnsi.nlterms('x', [[2],[3]])
+    fnsi.E = 0.05*np.random.RandomState(0).randn(*fnsi.E.shape)
+    fnsi.xactive = np.arange(fnsi.E.size)
+    # The Jacobian is linearized around the steady state samples x_mod, which
+    # requires the transient to die out. The poles of A are at |z|=0.97.
+    npp, R = model.signal.npp, model.signal.R
+    fnsi.transient(T1=np.r_[4*npp, np.r_[0:(R-1)*npp+1:npp]])
+    fnsi.freq_weight = False
+    x0 = fnsi.flatten()
+    fnsi.costfcn(x0)
+    jac = fnsi.jacobian(x0)
+    op = fnsi.jacobian_operator(x0)
+    # fnsi.jacobian neglects the influence of C and D through ζ(y)
+    v = np.random.RandomState(1).randn(len(x0))
+    v[A.size+B.size:A.size+B.size+C.size+D.size] = 0
+    npt.assert_allclose(op.matvec(v), jac @ v, rtol=1e-10,
+                        atol=1e-12*np.abs(jac @ v).max())
+
+    # the adjoint, e·(Jv) = (Jᵀe)·v, including the C and D entries
+    rng = np.random.RandomState(2)
+    for engine in engines():
+        op = fnsi.jacobian_operator(x0, engine=engine)
+        v = rng.randn(op.shape[1])
+        e = rng.randn(op.shape[0])
+        Jv = op.matvec(v)
+        npt.assert_allclose(e @ Jv, op.rmatvec(e) @ v, rtol=1e-10)
+
+    # C and D columns, with the influence through ζ(y), by central
+    # differences of the error
+    op = fnsi.jacobian_operator(x0)
+    h = 1e-6
+    for i in range(A.size+B.size, A.size+B.size+C.size+D.size):
+        dx = np.zeros(len(x0))
+        dx[i] = h
+        Jfd = (fnsi.costfcn(x0 + dx) - fnsi.costfcn(x0 - dx))/2/h
+        Ji = op.matvec(np.eye(len(x0))[i])
+        npt.assert_allclose(Ji, Jfd, rtol=1e-6, atol=1e-7*np.abs(Jfd).max())
+    fnsi.costfcn(x0)
+
+def test_optimize_lbfgs():
+    model = get_model()
+    model.E *= 0.5
+    cost = model.cost()
+    model.optimize(method='lbfgs', weight=False, nmax=50, info=0)
+    assert model.res['cost'] < 1e-3*cost
+    assert model.res['x_mat'].shape[0] == model.res['niter'] + 1
+
+def test_lm_solvers():
+    x = {}
+    for solver in ['svd', 'qr', 'chol']:
+        model = get_model()
+        model.E *= 0.5
+        model.optimize(weight=False, nmax=5, info=0, solver=solver)
+        x[solver] = model.flatten()
+    npt.assert_allclose(x['qr'], x['svd'], rtol=1e-8, atol=1e-12)
+    npt.assert_allclose(x['chol'], x['svd'], rtol=1e-6, atol=1e-10)
+
+def test_lm_workers():
+    model = get_model()
+    model.E *= 0.5
+    cost = model.cost()
+    model.optimize(weight=False, nmax=5, info=0, workers=2)
+    assert model.res['cost'] < 1e-3*cost
+    # the model is simulated with the accepted parameters, and the error of
+    # the accepted step is the one computed by the ladder
+    npt.assert_allclose(model.cost(), model.res['cost'])
+    npt.assert_allclose(model.costfcn(), model.res['fun'])
+
+def test_checkpoint_resume(tmp_path):
+    fname = str(tmp_path / 'lm.npz')
+    model = get_model()
+    model.E *= 0.5
+    x0 = model.flatten()
+    model.optimize(weight=False, nmax=6, info=0)
+    x6 = model.flatten()
+
+    model._copy(*model.extract(x0))
+    model.optimize(weight=False, nmax=3, info=0, checkpoint=fname)
+    model._copy(*model.extract(x0))
+    model.optimize(weight=False, nmax=6, info=0, resume=fname)
+    npt.assert_allclose(model.flatten(), x6, rtol=1e-12)
+    assert model.res['niter'] == 6
+
+def test_checkpoint_resume_smaller_nmax(tmp_path):
+    fname = str(tmp_path / 'lm.npz')
+    model = get_model()
+    model.E *= 0.5
+    model.optimize(weight=False, nmax=5, info=0, checkpoint=fname)
+    x5 = model.flatten()
+    # nothing left to do; the checkpoint is returned
+    model.optimize(weight=False, nmax=3, info=0, resume=fname)
+    npt.assert_allclose(model.flatten(), x5)
+    assert model.res['niter'] == 5
+    with npt.assert_raises(ValueError):
+        model.optimize(method='lbfgs', weight=False, nmax=3, info=0,
+                       checkpoint=fname)
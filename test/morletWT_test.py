@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+
+from pyvib.morletWT import StreamingWT, morletWT, morletWT_batch
+
+"""Compare the batched wavelet transform against the single channel one."""
+
+
+def morlet_loop(x, fs, f1, f2, nf, f00, pad=0):
+    """Reference: the original morletWT, one inverse FFT per frequency step,
+    with the filters on the FFT bins"""
+    df = (f2 - f1) / nf
+    a = f00 / (f1 + np.arange(nf)*df)
+    NX = len(x)
+    N = 2**pad * 2**int(np.ceil(np.log2(NX)))
+    omega = np.arange(N//2)*fs/N*2*np.pi
+    X = np.fft.fft(x, N)[:N//2]
+    y = np.zeros((nf,N), dtype=complex)
+    for j in range(nf):
+        filt = np.sqrt(2*a[j]) * np.exp(-0.5*(a[j]*omega - 2*np.pi*f00)**2)
+        y[j] = np.fft.ifft(np.conj(filt) * X, N)
+    y = y.T[:NX]
+    mod = np.abs(y)
+    return f00 / a[np.argmax(mod, axis=1)], np.max(mod, axis=1), y
+
+def test_morletWT_loop():
+    rng = np.random.RandomState(1)
+    fs = 100
+    t = np.arange(700)/fs
+    for x in [np.sin(2*np.pi*(5 + 0.5*t)*t), rng.randn(len(t))]:
+        for pad in [0, 1]:
+            finst, wtinst, _, _, y = morletWT(x, fs, 2, 20, 30, 10, pad)
+            rfinst, rwtinst, ry = morlet_loop(x, fs, 2, 20, 30, 10, pad)
+            npt.assert_allclose(y, ry, rtol=1e-10, atol=1e-12)
+            npt.assert_allclose(wtinst, rwtinst, rtol=1e-10)
+            npt.assert_array_equal(finst, rfinst)
+
+def test_morletWT_batch():
+    rng = np.random.RandomState(0)
+    fs = 100
+    t = np.arange(1000)/fs
+    x = np.vstack((np.sin(2*np.pi*(5 + 0.5*t)*t), rng.randn(len(t))))
+    # small batches
+    finst, wtinst, time, freq, y = morletWT_batch(x, fs, 2, 20, 30, 10,
+                                                  maxsize=3000)
+    rfinst, rwtinst = morletWT_batch(x, fs, 2, 20, 30, 10, ridge=True)
+    for c in range(len(x)):
+        ref = morletWT(x[c], fs, 2, 20, 30, 10)
+        npt.assert_allclose(finst[c], ref[0])
+        npt.assert_allclose(wtinst[c], ref[1])
+        npt.assert_allclose(y[c], ref[4])
+        npt.assert_allclose(rfinst[c], ref[0])
+        npt.assert_allclose(rwtinst[c], ref[1])
+
+def test_center_frequency():
+    # a sine on an FFT bin, at the center f00/a of the filter of 10 Hz
+    fs, f1, f2, nf, f00 = 64, 2, 20, 18, 10
+    t = np.arange(64)/fs
+    x = np.sin(2*np.pi*10*t)
+    finst, wtinst, _, _, y = morletWT(x, fs, f1, f2, nf, f00)
+    a = f00/10
+    npt.assert_allclose(finst, 10)
+    # the filter is one at its center, sqrt(2a) times the sine amplitude/2
+    npt.assert_allclose(wtinst, np.sqrt(2*a)/2, rtol=1e-12)
+    npt.assert_allclose(np.abs(y[:,8]), np.sqrt(2*a)/2, rtol=1e-12)
+
+def test_streaming_wt():
+    fs, f1, f2, nf, f00 = 100, 5, 30, 30, 10
+    t = np.arange(2**15)/fs
+    x = np.vstack((np.sin(2*np.pi*(8 + 0.02*t)*t),
+                   np.cos(2*np.pi*(20 - 0.02*t)*t)))
+    finst, wtinst, *_ = morletWT_batch(x, fs, f1, f2, nf, f00)
+
+    wt = StreamingWT(fs, f1, f2, nf, f00)
+    res = []
+    for i in range(0, x.shape[1], 7000):
+        res.append(wt.update(x[:,i:i+7000]))
+    res.append(wt.flush())
+    sfinst, swtinst = (np.hstack(r) for r in zip(*res))
+    assert sfinst.shape == finst.shape
+
+    # away from the start and end
+    sl = slice(wt.L, -wt.L)
+    npt.assert_allclose(swtinst[:,sl], wtinst[:,sl], rtol=1e-12)
+    npt.assert_array_equal(sfinst[:,sl], finst[:,sl])
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+
+from pyvib.signal import Signal, _hash
+
+"""Compare a Signal read from memory-mapped files in chunks against the
+in-memory Signal."""
+
+
+def test_from_npy(tmp_path):
+    rng = np.random.RandomState(0)
+    npp, m, p, R, P = 64, 2, 2, 4, 3
+    u = rng.randn(npp,m,R,P)
+    y = rng.randn(npp,p,R,P)
+    np.save(tmp_path / 'u.npy', u)
+    np.save(tmp_path / 'y.npy', y)
+    lines = np.arange(1, 20)
+
+    sig = Signal(u, y)
+    sig.lines = lines
+    msig = Signal.from_npy(tmp_path / 'u.npy', tmp_path / 'y.npy', chunk=2)
+    msig.lines = lines
+    assert isinstance(msig.y, np.memmap)
+
+    for a, b in zip(msig.average(), sig.average()):
+        npt.assert_allclose(a, b, rtol=1e-12)
+    for a, b in zip(msig.bla(), sig.bla()):
+        npt.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+    npt.assert_allclose(msig.covY, sig.covY, rtol=1e-10, atol=1e-12)
+
+def test_spectra_cache(tmp_path):
+    rng = np.random.RandomState(1)
+    u = rng.randn(64,1,2,3)
+    y = rng.randn(64,2,2,3)
+    sig = Signal(u, y, cache_dir=str(tmp_path))
+    sig.lines = np.arange(1, 20)
+    U = sig.spectra('u')
+    assert sig.spectra('u') is U
+    npt.assert_allclose(U, np.fft.fft(u, axis=0)[sig.lines].transpose(
+        (1,2,3,0)), rtol=1e-12, atol=1e-12)
+
+    # the cache is cleared when the lines change
+    sig.lines = np.arange(1, 10)
+    assert sig.spectra('u').shape[-1] == 9
+
+    # a new Signal with the same data reads the spectra from disk
+    covY = sig.covY
+    sig2 = Signal(u.copy(), y.copy(), cache_dir=str(tmp_path))
+    sig2.lines = sig.lines
+    files = set(tmp_path.iterdir())
+    npt.assert_allclose(sig2.spectra('u'), sig.spectra('u'))
+    npt.assert_allclose(sig2.covY, covY)
+    assert set(tmp_path.iterdir()) == files
+
+    # and recomputes them when the data differs
+    sig2.y = 2*y
+    npt.assert_allclose(sig2.covY, 4*covY)
+
+def test_mmap_cache(tmp_path):
+    rng = np.random.RandomState(2)
+    u = rng.randn(64,1,2,3)
+    y = rng.randn(64,2,2,3)
+    np.save(tmp_path / 'u.npy', u)
+    np.save(tmp_path / 'y.npy', y)
+    msig = Signal.from_npy(tmp_path / 'u.npy', tmp_path / 'y.npy', chunk=None)
+    msig.cache_dir = str(tmp_path / 'cache')
+    msig.lines = np.arange(1, 20)
+
+    # memory-mapped data is hashed by its file, not its content
+    np.save(tmp_path / 'u2.npy', u)
+    key = _hash('u', msig.u)
+    assert _hash('u', np.load(tmp_path / 'u.npy', mmap_mode='r')) == key
+    assert _hash('u', np.load(tmp_path / 'u2.npy', mmap_mode='r')) != key
+    assert _hash('u', u) != key
+
+    # the half spectra of memory-mapped data are not kept
+    U = msig.spectra('u')
+    assert not any(k[0] == 'half' for k in msig._cache)
+    npt.assert_allclose(U, np.fft.fft(u, axis=0)[msig.lines].transpose(
+        (1,2,3,0)), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import numpy.testing as npt
+
+from pyvib.signal import Signal
+from pyvib.lti_conversion import eig_resolvent, ss2frf
+from pyvib.subspace import Subspace, jacobian_freq, subspace
+
+"""Subspace identification of a linear model from its periodic response."""
+
+A = np.array([[0.73915535, -0.62433133],[0.6247377, 0.7364469]])
+B = np.array([[0.79287245], [-0.34515159]])
+C = np.array([[0.71165154, 0.34917771]])
+D = np.array([[0.04498052]])
+
+
+def get_signal(npp=512, R=4, P=2):
+    rng = np.random.RandomState(10)
+    u = rng.randn(npp,1,R,1).repeat(P, axis=3)
+    model = Subspace(Signal(u, u, fs=1), A, B, C, D)
+    T1 = np.r_[npp, np.r_[0:(R-1)*P*npp+1:P*npp]]
+    _, y, _ = model.simulate(u.transpose(2,3,0,1).ravel(), T1=T1)
+    y = y.reshape(R,P,npp).transpose(2,0,1)[:,None]
+    y += 1e-3*rng.randn(*y.shape)
+    sig = Signal(u, y, fs=1)
+    sig.lines = np.arange(1,npp//2)
+    sig.bla()
+    return sig
+
+def test_scan_parallel(tmp_path):
+    sig = get_signal()
+    smodel, pmodel = Subspace(sig), Subspace(sig)
+    models, infodict = smodel.scan([2,3], 5, info=0, nmax=5)
+    pmodels, pinfodict = pmodel.scan([2,3], 5, info=0, nmax=5, workers=2)
+    assert pinfodict == infodict
+    for n in models:
+        assert pmodels[n]['r'] == models[n]['r']
+        npt.assert_allclose(pmodels[n]['A'], models[n]['A'])
+    # both end with the model of the last job
+    assert (pmodel.n, pmodel.r) == (smodel.n, smodel.r)
+    npt.assert_allclose(pmodel.A, smodel.A)
+
+    # continue a partial scan
+    linmodel = Subspace(sig)
+    linmodel.scan([2], 5, info=0, nmax=5)
+    rmodels, rinfodict = linmodel.scan([2,3], 5, info=0, nmax=5, resume=True)
+    assert rinfodict == infodict
+    assert rmodels.keys() == models.keys()
+
+    # continue from a file on a fresh model. Without a file it starts over
+    fname = str(tmp_path / 'scan.npz')
+    Subspace(sig).scan([2], 5, info=0, nmax=5, checkpoint=fname)
+    rmodels, rinfodict = Subspace(sig).scan([2,3], 5, info=0, nmax=5,
+                                            checkpoint=fname, resume=True)
+    assert rinfodict == infodict
+    assert rmodels[2]['r'] == models[2]['r']
+    npt.assert_allclose(rmodels[2]['A'], models[2]['A'])
+    _, rinfodict = Subspace(sig).scan([2], 5, info=0, nmax=5, resume=True)
+    assert rinfodict[2] == infodict[2]
+
+def test_factorization_cache():
+    sig = get_signal()
+    linmodel = Subspace(sig)
+    for weight in [False, True]:
+        covG = sig.covG if weight else False
+        for n, r in [(2,5), (3,5), (2,8)]:
+            ref = subspace(sig.G, covG, sig.norm_freq, n, r)
+            est = linmodel.estimate(n, r, weight=weight)
+            for a, b in zip(est[:4], ref[:4]):
+                npt.assert_allclose(a, b)
+    # one factorization per (r, weighting)
+    assert len(linmodel.cache) == 4
+
+    # least recently used is evicted
+    linmodel.cache.maxbytes = linmodel.cache.nbytes - 1
+    linmodel.estimate(2, 5)
+    assert len(linmodel.cache) == 3
+    assert (5, False, 'nr') in linmodel.cache._cache
+
+def test_jacobian_freq():
+    rng = np.random.RandomState(0)
+    n, m, p = 3, 2, 2
+    A = 0.3*rng.randn(n,n)
+    B, C, D = rng.randn(n,m), rng.randn(p,n), rng.randn(p,m)
+    freq = np.linspace(0.01, 0.49, 5)
+    z = np.exp(2j*np.pi*freq)
+    J = jacobian_freq(A, B, C, z)
+    # finite differences of the FRF
+    G0 = ss2frf(A, B, C, D, freq)
+    h = 1e-7
+    for i, (X, Jx) in enumerate(zip([A, B, C, D], J)):
+        for k in range(X.size):
+            M = [A, B, C, D]
+            M[i] = X.copy()
+            M[i].flat[k] += h
+            npt.assert_allclose(Jx[...,k], (ss2frf(*M, freq) - G0)/h,
+                                rtol=1e-5, atol=1e-6)
+    for a, b in zip(jacobian_freq(A, B, C, z, method='eig'), J):
+        npt.assert_allclose(a, b, atol=1e-12)
+
+def test_ss2frf():
+    freq = np.linspace(0, 0.5, 50)
+    G = ss2frf(A, B, C, D, freq, method='solve')
+    for method in ['auto', 'eig', 'hess']:
+        npt.assert_allclose(ss2frf(A, B, C, D, freq, method=method), G,
+                            atol=1e-12)
+    # defective A falls back to the Hessenberg solve
+    Ad = np.array([[0.5, 1], [0, 0.5]])
+    npt.assert_allclose(ss2frf(Ad, B, C, D, freq, method='auto'),
+                        ss2frf(Ad, B, C, D, freq, method='solve'), atol=1e-12)
+    # as does an ill-conditioned A, cond(V) ~ 1e7
+    Ai = np.array([[0.5, 1], [0, 0.5 + 1e-7]])
+    assert eig_resolvent(Ai) is None
+    npt.assert_array_equal(ss2frf(Ai, B, C, D, freq, method='auto'),
+                           ss2frf(Ai, B, C, D, freq, method='hess'))
+    npt.assert_allclose(ss2frf(Ai, B, C, D, freq, method='auto'),
+                        ss2frf(Ai, B, C, D, freq), rtol=1e-10)
+
+def test_costfcn_frf_method():
+    sig = get_signal()
+    Ad = np.array([[0.5, 1], [0, 0.5]])
+    z = np.exp(2j*np.pi*sig.norm_freq)
+    for A_ in [A, Ad]:
+        ref = Subspace(sig, A_, B, C, D)
+        model = Subspace(sig, A_, B, C, D, frf_method='auto')
+        ref.z = model.z = z
+        x0 = ref.flatten()
+        npt.assert_allclose(model.costfcn(), ref.costfcn(), atol=1e-12)
+        # jacobian_freq uses the eigendecomposition, or falls back to solve
+        npt.assert_allclose(model.jacobian(x0), ref.jacobian(x0),
+                            atol=1e-10)
+    # the defective A is evaluated by the Hessenberg solve
+    assert eig_resolvent(Ad) is None
+    model.frf_method = 'hess'
+    npt.assert_array_equal(Subspace(sig, Ad, B, C, D,
+                                    frf_method='auto').costfcn(),
+                           model.costfcn())